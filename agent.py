@@ -10,6 +10,7 @@ from config import *
 from replay_buffer import *
 from networks import *
 from utilss import get_space_dims
+from utils.checkpoint import atomic_write
 
 np.random.seed(42)
 THETA=0.15
@@ -72,20 +73,15 @@ class Agent:
         self.target_critic.set_weights(critic_weights)
         
     def update_target_networks(self, tau):
-        actor_weights = self.actor.weights
-        target_actor_weights = self.target_actor.weights
-        for index in range(len(actor_weights)):
-            target_actor_weights[index] = tau * actor_weights[index] + (1 - tau) * target_actor_weights[index]
+        self._soft_update(tf.constant(tau, dtype=tf.float32))
 
-        self.target_actor.set_weights(target_actor_weights)
-        
-        critic_weights = self.critic.weights
-        target_critic_weights = self.target_critic.weights
-    
-        for index in range(len(critic_weights)):
-            target_critic_weights[index] = tau * critic_weights[index] + (1 - tau) * target_critic_weights[index]
-
-        self.target_critic.set_weights(target_critic_weights)
+    @tf.function
+    def _soft_update(self, tau):
+        # traced once per agent: the Polyak update runs as one graph on the
+        # variables instead of a get_weights/set_weights round trip through NumPy
+        for target, source in zip(self.target_actor.weights + self.target_critic.weights,
+                                  self.actor.weights + self.critic.weights):
+            target.assign(tau * source + (1 - tau) * target)
 
     
     def get_actions(self, actor_states,epsilon,evaluation=False):
@@ -108,10 +104,9 @@ class Agent:
         return actions
     
     def save(self, path_save):
-        self.actor.save_weights(f"{path_save}/{self.actor.net_name}.h5")
-        self.target_actor.save_weights(f"{path_save}/{self.target_actor.net_name}.h5")
-        self.critic.save_weights(f"{path_save}/{self.critic.net_name}.h5")
-        self.target_critic.save_weights(f"{path_save}/{self.target_critic.net_name}.h5")
+        # temporary file + rename, so an interrupted save keeps the old weights
+        for net in (self.actor, self.target_actor, self.critic, self.target_critic):
+            atomic_write(f"{path_save}/{net.net_name}.h5", net.save_weights)
         
     def load(self, path_load):
         self.actor.load_weights(f"{path_load}/{self.actor.net_name}.h5")
@@ -0,0 +1,231 @@
+import torch
+from torch.optim import Adam
+from utils.networks import StackedMLPNetwork
+from utils.misc import flatten_params, soft_update_flat, onehot_from_logits, gumbel_softmax
+
+NETWORKS = ('policy', 'critic', 'target_policy', 'target_critic')
+DEVICES = {'policy': 'pol_dev', 'critic': 'critic_dev',
+           'target_policy': 'trgt_pol_dev', 'target_critic': 'trgt_critic_dev'}
+
+
+class MADDPGEnsemble(object):
+    """
+    Independent MADDPG learners (e.g. one per seed) trained together: the
+    networks of all members and agents are stacked into one
+    StackedMLPNetwork per network type, so that an update round of the whole
+    ensemble is one forward/backward pass and one optimizer step per network
+    type, as update_fused is for the agents of one learner. The members do
+    not share anything but the kernels: each one is updated from its own
+    sample, and Adam and the gradient clipping are elementwise or per
+    network. The members' networks become views of the stacked parameters,
+    so acting, saving and loading work on each member as before.
+    """
+    def __init__(self, members):
+        """
+        Inputs:
+            members (list of MADDPG): Learners of the same task (same agents,
+                                      dimensions and hyperparameters), with
+                                      centralized critics and not fused
+        """
+        first = members[0]
+        for maddpg in members:
+            if maddpg.fused:
+                raise ValueError("Ensemble members must not be fused")
+            if any(alg != 'MADDPG' for alg in maddpg.alg_types):
+                raise ValueError("Ensembles need centralized (MADDPG) critics for all agents")
+            if maddpg.agent_init_params != first.agent_init_params:
+                raise ValueError("Ensemble members must have the same agents")
+        self.members = members
+        self.n_members = len(members)
+        self.nagents = first.nagents
+        self.discrete_action = first.discrete_action
+        self.gamma = first.gamma
+        self.tau = first.tau
+        # member-major: network m * nagents + a is agent a of member m
+        for kind in NETWORKS:
+            setattr(self, 'stacked_' + kind, StackedMLPNetwork(self._nets(kind)))
+        self.policy_optimizer = Adam(self.stacked_policy.parameters(), lr=first.lr)
+        self.critic_optimizer = Adam(self.stacked_critic.parameters(), lr=first.lr)
+        self._flat_params = None
+        self._member_policies = {}  # member -> (view network, stacked policy it views)
+
+    def _nets(self, kind):
+        return [getattr(a, kind) for maddpg in self.members for a in maddpg.agents]
+
+    def autocast(self, device):
+        return self.members[0].autocast(device)
+
+    def _joint(self, X):
+        """
+        (members, batch, dims) -> (batch, members * dims), the joint input of
+        the stacked networks
+        """
+        return X.transpose(0, 1).reshape(X.shape[1], -1)
+
+    def _split(self, X):
+        """
+        Inverse of _joint
+        """
+        return X.view(X.shape[0], self.n_members, -1).transpose(0, 1)
+
+    def _per_agent(self, X):
+        """
+        (members, batch, dims) -> (members * agents, batch, dims): the input
+        of each member repeated for its agents' critics
+        """
+        S, B, D = X.shape
+        return X.unsqueeze(1).expand(S, self.nagents, B, D).reshape(S * self.nagents, B, D)
+
+    def update(self, samples, weights=None):
+        """
+        One update round of every member from its own sample (as update_fused
+        for each member)
+        Inputs:
+            samples (list): One sample per member, as returned by
+                            ReplayBuffer.sample (same batch size)
+            weights (list of PyTorch Tensor): Importance weights of the
+                                              samples of each member
+        Outputs:
+            vf_losses, pol_losses (np.ndarray): Losses (members, agents)
+            td_errors (np.ndarray): Mean absolute TD error of each sample over
+                                    the agents (members, batch), only if
+                                    weights are given
+        """
+        with self.autocast(self.members[0].critic_dev):
+            return self._update(samples, weights)
+
+    def _update(self, samples, weights):
+        S, n = self.n_members, self.nagents
+        stack = lambda field: torch.stack([torch.cat(sample[field], dim=1) for sample in samples])
+        joint_obs, acs, joint_next_obs = stack(0), stack(1), stack(3)
+        rews = torch.stack([torch.stack(sample[2]) for sample in samples]).view(S * n, -1, 1)
+        dones = torch.stack([torch.stack(sample[4]) for sample in samples]).view(S * n, -1, 1)
+        pol, critic = self.stacked_policy, self.stacked_critic
+        trgt_pol = self.stacked_target_policy
+
+        self.critic_optimizer.zero_grad()
+        trgt_out = trgt_pol(trgt_pol.gather_inputs(self._joint(joint_next_obs)))
+        if self.discrete_action:
+            trgt_out = onehot_from_logits(trgt_pol.mask_logits(trgt_out))
+        trgt_acs = self._split(trgt_pol.scatter_outputs(trgt_out))
+        trgt_vf_in = self._per_agent(torch.cat((joint_next_obs, trgt_acs), dim=2))
+        target_value = (rews + self.gamma * self.stacked_target_critic(trgt_vf_in) *
+                        (1 - dones))
+        actual_value = critic(self._per_agent(torch.cat((joint_obs, acs), dim=2)))
+        sq_errors = (actual_value - target_value.detach()) ** 2
+        if weights is not None:
+            sq_errors = self._per_agent(torch.stack(weights).unsqueeze(-1)) * sq_errors
+        vf_losses = sq_errors.mean(dim=(1, 2))
+        vf_losses.sum().backward()
+        critic.clip_grad_norm_(0.5)
+        self.critic_optimizer.step()
+
+        self.policy_optimizer.zero_grad()
+        curr_pol_out = pol(pol.gather_inputs(self._joint(joint_obs)))
+        if self.discrete_action:
+            # see MADDPG.update for the Gumbel-Softmax trick
+            logits = pol.mask_logits(curr_pol_out)
+            curr_pol_vf_in = gumbel_softmax(logits, hard=True)
+            other_acs = onehot_from_logits(logits)
+        else:
+            curr_pol_vf_in = curr_pol_out
+            other_acs = curr_pol_out.detach()
+        # critic input of agent a of a member: its own differentiable action,
+        # the current policy actions of the member's other agents
+        own_outputs = pol.own_outputs[:n, :, :acs.shape[2]]
+        all_pol_acs = torch.where(own_outputs,
+                                  self._split(pol.scatter_outputs(curr_pol_vf_in)).unsqueeze(1),
+                                  self._split(pol.scatter_outputs(other_acs)).unsqueeze(1))
+        vf_in = torch.cat((joint_obs.unsqueeze(1).expand(-1, n, -1, -1), all_pol_acs), dim=3)
+        pol_losses = -critic(vf_in.reshape(S * n, *vf_in.shape[2:])).mean(dim=(1, 2))
+        # mean over the unpadded outputs of each agent
+        out_sizes = curr_pol_out.new_tensor(pol.out_dims) * curr_pol_out.shape[1]
+        pol_sq = (curr_pol_out * pol.out_mask.unsqueeze(1)) ** 2
+        pol_losses = pol_losses + pol_sq.sum(dim=(1, 2)) / out_sizes * 1e-3
+        pol_losses.sum().backward()
+        pol.clip_grad_norm_(0.5)
+        self.policy_optimizer.step()
+        vf_losses = vf_losses.detach().view(S, n).numpy()
+        pol_losses = pol_losses.detach().view(S, n).numpy()
+        if weights is not None:
+            td_errors = (target_value - actual_value).detach().abs().view(S, n, -1).mean(dim=1)
+            return vf_losses, pol_losses, td_errors.numpy()
+        return vf_losses, pol_losses
+
+    def _flatten(self):
+        """
+        See MADDPG._flatten
+        """
+        pairs = [(self.stacked_policy, self.stacked_target_policy),
+                 (self.stacked_critic, self.stacked_target_critic)]
+        online = flatten_params(p for net, _ in pairs for p in net.parameters())
+        target = flatten_params(p for _, net in pairs for p in net.parameters())
+        for kind in NETWORKS:
+            getattr(self, 'stacked_' + kind).link(self._nets(kind))
+        self._flat_params = (online, target)
+
+    def member_policy(self, m):
+        """
+        Stacked policy network of member m whose parameters are views of the
+        ensemble's stacked policy, e.g. for a PolicyEngine: the optimizer
+        steps the stacked parameters, which the members' own networks (views
+        through .data) do not register as modifications
+        """
+        view, source = self._member_policies.get(m, (None, None))
+        if source is not self.stacked_policy:
+            # first call, or the stacked policy was moved to another device
+            if view is None:
+                view = StackedMLPNetwork(self.members[m].policies, link=False)
+            view = view.to(self.stacked_policy.W1.device)
+            view.share(self.stacked_policy, m * self.nagents)
+            self._member_policies[m] = (view, self.stacked_policy)
+        return view
+
+    def update_all_targets(self):
+        """
+        Soft update of the target networks of all members
+        """
+        if self._flat_params is None:
+            self._flatten()
+        online, target = self._flat_params
+        soft_update_flat(target, online, self.tau)
+        for maddpg in self.members:
+            maddpg.niter += 1
+
+    def _move(self, kinds, device):
+        """
+        Move the stacked networks of the given types (with the members'
+        networks, their views) to device
+        """
+        if device == 'gpu':
+            fn = lambda x: x.cuda()
+        else:
+            fn = lambda x: x.cpu()
+        for kind in kinds:
+            if all(getattr(maddpg, DEVICES[kind]) == device for maddpg in self.members):
+                continue
+            stacked = fn(getattr(self, 'stacked_' + kind))
+            setattr(self, 'stacked_' + kind, stacked)
+            stacked.link(self._nets(kind))
+            for maddpg in self.members:
+                setattr(maddpg, DEVICES[kind], device)
+            self._flat_params = None
+
+    def prep_training(self, device='gpu'):
+        for kind in NETWORKS:
+            for net in self._nets(kind):
+                net.train()
+        self._move(NETWORKS, device)
+
+    def prep_rollouts(self, device='cpu'):
+        for net in self._nets('policy'):
+            net.eval()
+        self._move(('policy',), device)
+
+    def scale_noise(self, scale):
+        for maddpg in self.members:
+            maddpg.scale_noise(scale)
+
+    def reset_noise(self):
+        for maddpg in self.members:
+            maddpg.reset_noise()
@@ -1,12 +1,26 @@
+import functools
 import torch
 import torch.nn.functional as F
+from torch.optim import Adam
 from gym.spaces import Box, Discrete
-from utils.networks import MLPNetwork
-from utils.misc import soft_update, average_gradients, onehot_from_logits, gumbel_softmax
+from utils.networks import MLPNetwork, StackedMLPNetwork
+from utils.misc import (soft_update, soft_update_flat, flatten_params, average_gradients,
+                        onehot_from_logits, gumbel_softmax, clone_to_cpu)
+from utils.checkpoint import save_file
 from utils.agents import DDPGAgent
 
 MSELoss = torch.nn.MSELoss()
 
+def _autocast_update(update):
+    """
+    Run an update method under the learner's autocast setting
+    """
+    @functools.wraps(update)
+    def wrapper(self, *args, **kwargs):
+        with self.autocast(self.critic_dev):
+            return update(self, *args, **kwargs)
+    return wrapper
+
 class MADDPG(object):
     """
     Wrapper class for DDPG-esque (i.e. also MADDPG) agents in multi-agent task
@@ -45,6 +59,33 @@ class MADDPG(object):
         self.trgt_pol_dev = 'cpu'  # device for target policies
         self.trgt_critic_dev = 'cpu'  # device for target critics
         self.niter = 0
+        # set by fuse()
+        self.stacked_policy = None
+        self.stacked_critic = None
+        self.stacked_target_policy = None
+        self.stacked_target_critic = None
+        # contiguous (online, target) parameter buffers of the whole team,
+        # built lazily by update_all_targets
+        self._flat_params = None
+        # lower-precision type of the matrix products in updates and rollouts
+        # (e.g. torch.bfloat16), None for full precision
+        self.autocast_dtype = None
+
+    @property
+    def fused(self):
+        return self.stacked_policy is not None
+
+    def autocast(self, device):
+        """
+        Autocast context for computations on device ('cpu' or 'gpu'). The
+        parameters stay float32 (master weights) and the networks return
+        float32, so losses, targets and action sampling are computed in full
+        precision. bfloat16 has the exponent range of float32, so no loss
+        scaling is needed.
+        """
+        return torch.autocast('cuda' if device == 'gpu' else 'cpu',
+                              dtype=self.autocast_dtype or torch.bfloat16,
+                              enabled=self.autocast_dtype is not None)
 
     @property
     def policies(self):
@@ -77,10 +118,12 @@ class MADDPG(object):
         Outputs:
             actions: List of actions for each agent
         """
-        return [a.step(obs, explore=explore) for a, obs in zip(self.agents,
-                                                                 observations)]
+        with self.autocast(self.pol_dev):
+            return [a.step(obs, explore=explore) for a, obs in zip(self.agents,
+                                                                     observations)]
 
-    def update(self, sample, agent_i, parallel=False, logger=None):
+    @_autocast_update
+    def update(self, sample, agent_i, parallel=False, logger=None, weights=None):
         """
         Update parameters of agent model based on sample from replay buffer
         Inputs:
@@ -92,6 +135,10 @@ class MADDPG(object):
             parallel (bool): If true, will average gradients across threads
             logger (SummaryWriter from Tensorboard-Pytorch):
                 If passed in, important quantities will be logged
+            weights (PyTorch Tensor): Importance weights of the samples (from
+                                      a PrioritizedReplayBuffer). If given, the
+                                      absolute TD errors of the agent's critic
+                                      on each sample are returned as well.
         """
         obs, acs, rews, next_obs, dones = sample
         curr_agent = self.agents[agent_i]
@@ -125,7 +172,7 @@ class MADDPG(object):
         else:  # DDPG
             vf_in = torch.cat((obs[agent_i], acs[agent_i]), dim=1)
         actual_value = curr_agent.critic(vf_in)
-        vf_loss = MSELoss(actual_value, target_value.detach())
+        vf_loss = self._critic_loss(actual_value, target_value.detach(), weights)
         vf_loss.backward()
         if parallel:
             average_gradients(curr_agent.critic)
@@ -170,18 +217,261 @@ class MADDPG(object):
                                {'vf_loss': vf_loss,
                                 'pol_loss': pol_loss},
                                self.niter)
+        if weights is not None:
+            td_errors = (target_value - actual_value).detach().abs().view(-1).numpy()
+            return vf_loss.detach().numpy(), pol_loss.detach().numpy(), td_errors
         return vf_loss.detach().numpy(), pol_loss.detach().numpy()
 
+    @staticmethod
+    def _critic_loss(actual_value, target_value, weights=None):
+        """
+        MSE of the critic, weighted per sample with importance weights
+        """
+        if weights is None:
+            return MSELoss(actual_value, target_value)
+        return (weights.view(-1, 1) * (actual_value - target_value) ** 2).mean()
+
+    @_autocast_update
+    def update_round(self, sample, parallel=False, logger=None, weights=None):
+        """
+        Update all agents from one sample, computing what update() would
+        recompute for every agent only once: the target policy actions, the
+        current policy actions and the centralized critic inputs. As with
+        update_fused, every policy loss sees the other agents' policies as
+        they were before this round.
+        Inputs:
+            sample: tuple of (observations, actions, rewards, next
+                    observations, and episode end masks) sampled randomly from
+                    the replay buffer. Each is a list with entries
+                    corresponding to each agent
+            parallel (bool): If true, will average gradients across threads
+            logger (SummaryWriter from Tensorboard-Pytorch):
+                If passed in, important quantities will be logged
+            weights (PyTorch Tensor): Importance weights of the samples
+        Outputs:
+            vf_losses, pol_losses (list): Losses of each agent
+            td_errors (np.ndarray): Mean absolute TD error of each sample over
+                                    the agents (only if weights are given)
+        """
+        obs, acs, rews, next_obs, dones = sample
+        if self.discrete_action:
+            all_trgt_acs = [onehot_from_logits(pi(nobs)) for pi, nobs in
+                            zip(self.target_policies, next_obs)]
+        else:
+            all_trgt_acs = [pi(nobs) for pi, nobs in zip(self.target_policies,
+                                                         next_obs)]
+        joint_trgt_vf_in = torch.cat((*next_obs, *all_trgt_acs), dim=1)
+        joint_vf_in = torch.cat((*obs, *acs), dim=1)
+        all_pol_out = [pi(ob) for pi, ob in zip(self.policies, obs)]
+        if self.discrete_action:
+            all_pol_acs = [onehot_from_logits(out) for out in all_pol_out]
+        else:
+            all_pol_acs = [out.detach() for out in all_pol_out]
+
+        vf_losses, pol_losses = [], []
+        td_errors = 0
+        for agent_i, curr_agent in enumerate(self.agents):
+            centralized = self.alg_types[agent_i] == 'MADDPG'
+            curr_agent.critic_optimizer.zero_grad()
+            if centralized:
+                trgt_vf_in = joint_trgt_vf_in
+                vf_in = joint_vf_in
+            else:  # DDPG
+                trgt_vf_in = torch.cat((next_obs[agent_i], all_trgt_acs[agent_i]), dim=1)
+                vf_in = torch.cat((obs[agent_i], acs[agent_i]), dim=1)
+            target_value = (rews[agent_i].view(-1, 1) + self.gamma *
+                            curr_agent.target_critic(trgt_vf_in) *
+                            (1 - dones[agent_i].view(-1, 1)))
+            actual_value = curr_agent.critic(vf_in)
+            vf_loss = self._critic_loss(actual_value, target_value.detach(), weights)
+            td_errors += (target_value - actual_value).detach().abs().view(-1) / self.nagents
+            vf_loss.backward()
+            if parallel:
+                average_gradients(curr_agent.critic)
+            torch.nn.utils.clip_grad_norm(curr_agent.critic.parameters(), 0.5)
+            curr_agent.critic_optimizer.step()
+
+            curr_agent.policy_optimizer.zero_grad()
+            curr_pol_out = all_pol_out[agent_i]
+            if self.discrete_action:
+                curr_pol_vf_in = gumbel_softmax(curr_pol_out, hard=True)
+            else:
+                curr_pol_vf_in = curr_pol_out
+            if centralized:
+                pol_acs = list(all_pol_acs)
+                pol_acs[agent_i] = curr_pol_vf_in
+                vf_in = torch.cat((*obs, *pol_acs), dim=1)
+            else:  # DDPG
+                vf_in = torch.cat((obs[agent_i], curr_pol_vf_in), dim=1)
+            pol_loss = -curr_agent.critic(vf_in).mean()
+            pol_loss += (curr_pol_out**2).mean() * 1e-3
+            pol_loss.backward()
+            if parallel:
+                average_gradients(curr_agent.policy)
+            torch.nn.utils.clip_grad_norm(curr_agent.policy.parameters(), 0.5)
+            curr_agent.policy_optimizer.step()
+            if logger is not None:
+                logger.add_scalars('agent%i/losses' % agent_i,
+                                   {'vf_loss': vf_loss,
+                                    'pol_loss': pol_loss},
+                                   self.niter)
+            vf_losses.append(vf_loss.detach().numpy())
+            pol_losses.append(pol_loss.detach().numpy())
+        if weights is not None:
+            return vf_losses, pol_losses, td_errors.numpy()
+        return vf_losses, pol_losses
+
+    def fuse(self):
+        """
+        Stack the networks of all agents for update_fused. The agents' own
+        networks become views of the stacked parameters, so acting, target
+        updates, saving and loading work as before.
+        """
+        if any(alg != 'MADDPG' for alg in self.alg_types):
+            raise ValueError("Fused updates need centralized (MADDPG) critics for all agents")
+        self.stacked_policy = StackedMLPNetwork(self.policies)
+        self.stacked_critic = StackedMLPNetwork([a.critic for a in self.agents])
+        self.stacked_target_policy = StackedMLPNetwork(self.target_policies)
+        self.stacked_target_critic = StackedMLPNetwork([a.target_critic for a in self.agents])
+        # Adam is elementwise, so one optimizer over the stacked parameters
+        # behaves like one optimizer per agent
+        self.fused_policy_optimizer = Adam(self.stacked_policy.parameters(), lr=self.lr)
+        self.fused_critic_optimizer = Adam(self.stacked_critic.parameters(), lr=self.lr)
+        self._flat_params = None
+
+    @_autocast_update
+    def update_fused(self, sample, parallel=False, logger=None, weights=None):
+        """
+        Update the critics and policies of all agents from one sample with a
+        single forward/backward pass and one optimizer step per network type
+        (requires fuse()). Unlike calling update for each agent in turn, all
+        policy losses see the other agents' policies as they were before this
+        update.
+        Inputs:
+            sample: tuple of (observations, actions, rewards, next
+                    observations, and episode end masks) sampled randomly from
+                    the replay buffer. Each is a list with entries
+                    corresponding to each agent
+            parallel (bool): If true, will average gradients across threads
+            logger (SummaryWriter from Tensorboard-Pytorch):
+                If passed in, important quantities will be logged
+            weights (PyTorch Tensor): Importance weights of the samples
+        Outputs:
+            vf_losses, pol_losses (np.ndarray): Losses of each agent
+            td_errors (np.ndarray): Mean absolute TD error of each sample over
+                                    the agents (only if weights are given)
+        """
+        obs, acs, rews, next_obs, dones = sample
+        pol, critic = self.stacked_policy, self.stacked_critic
+        joint_obs = torch.cat(obs, dim=1)
+        joint_next_obs = torch.cat(next_obs, dim=1)
+        rews = torch.stack(rews).unsqueeze(-1)
+        dones = torch.stack(dones).unsqueeze(-1)
+
+        self.fused_critic_optimizer.zero_grad()
+        trgt_out = self.stacked_target_policy(
+            self.stacked_target_policy.gather_inputs(joint_next_obs))
+        if self.discrete_action:
+            trgt_out = onehot_from_logits(self.stacked_target_policy.mask_logits(trgt_out))
+        trgt_vf_in = torch.cat((joint_next_obs,
+                                self.stacked_target_policy.scatter_outputs(trgt_out)), dim=1)
+        target_value = (rews + self.gamma * self.stacked_target_critic(trgt_vf_in) *
+                        (1 - dones))
+        actual_value = critic(torch.cat((joint_obs, *acs), dim=1))
+        sq_errors = (actual_value - target_value.detach()) ** 2
+        if weights is not None:
+            sq_errors = weights.view(1, -1, 1) * sq_errors
+        vf_losses = sq_errors.mean(dim=(1, 2))
+        vf_losses.sum().backward()
+        if parallel:
+            average_gradients(critic)
+        critic.clip_grad_norm_(0.5)
+        self.fused_critic_optimizer.step()
+
+        self.fused_policy_optimizer.zero_grad()
+        curr_pol_out = pol(pol.gather_inputs(joint_obs))
+        if self.discrete_action:
+            # see update() for the Gumbel-Softmax trick
+            logits = pol.mask_logits(curr_pol_out)
+            curr_pol_vf_in = gumbel_softmax(logits, hard=True)
+            other_acs = onehot_from_logits(logits)
+        else:
+            curr_pol_vf_in = curr_pol_out
+            other_acs = curr_pol_out.detach()
+        # critic input of agent a: its own differentiable action, the others'
+        # current policy actions
+        all_pol_acs = torch.where(pol.own_outputs,
+                                  pol.scatter_outputs(curr_pol_vf_in).unsqueeze(0),
+                                  pol.scatter_outputs(other_acs).unsqueeze(0))
+        vf_in = torch.cat((joint_obs.unsqueeze(0).expand(self.nagents, -1, -1),
+                           all_pol_acs), dim=2)
+        pol_losses = -critic(vf_in).mean(dim=(1, 2))
+        # mean over the unpadded outputs of each agent
+        out_sizes = curr_pol_out.new_tensor(pol.out_dims) * curr_pol_out.shape[1]
+        pol_sq = (curr_pol_out * pol.out_mask.unsqueeze(1)) ** 2
+        pol_losses = pol_losses + pol_sq.sum(dim=(1, 2)) / out_sizes * 1e-3
+        pol_losses.sum().backward()
+        if parallel:
+            average_gradients(pol)
+        pol.clip_grad_norm_(0.5)
+        self.fused_policy_optimizer.step()
+        vf_losses = vf_losses.detach().numpy()
+        pol_losses = pol_losses.detach().numpy()
+        if logger is not None:
+            for agent_i in range(self.nagents):
+                logger.add_scalars('agent%i/losses' % agent_i,
+                                   {'vf_loss': vf_losses[agent_i],
+                                    'pol_loss': pol_losses[agent_i]},
+                                   self.niter)
+        if weights is not None:
+            td_errors = (target_value - actual_value).detach().abs().mean(dim=(0, 2))
+            return vf_losses, pol_losses, td_errors.numpy()
+        return vf_losses, pol_losses
+
+    def _flatten(self):
+        """
+        Put the parameters of all online networks into one contiguous buffer
+        and those of all target networks into another (in the same order), so
+        that the soft update of the whole team is a single operation
+        """
+        if self.fused:
+            pairs = [(self.stacked_policy, self.stacked_target_policy),
+                     (self.stacked_critic, self.stacked_target_critic)]
+        else:
+            pairs = ([(a.policy, a.target_policy) for a in self.agents] +
+                     [(a.critic, a.target_critic) for a in self.agents])
+        online = flatten_params(p for net, _ in pairs for p in net.parameters())
+        target = flatten_params(p for _, net in pairs for p in net.parameters())
+        if self.fused:
+            # the agents' networks are views of the stacked parameters
+            self.stacked_policy.link(self.policies)
+            self.stacked_critic.link([a.critic for a in self.agents])
+            self.stacked_target_policy.link(self.target_policies)
+            self.stacked_target_critic.link([a.target_critic for a in self.agents])
+        self._flat_params = (online, target)
+
     def update_all_targets(self):
         """
         Update all target networks (called after normal updates have been
         performed for each agent)
         """
-        for a in self.agents:
-            soft_update(a.target_critic, a.critic, self.tau)
-            soft_update(a.target_policy, a.policy, self.tau)
+        if self._flat_params is None:
+            self._flatten()
+        online, target = self._flat_params
+        soft_update_flat(target, online, self.tau)
         self.niter += 1
 
+    def _move_stacked(self, name, nets, fn):
+        """
+        Move a stacked network and re-link the agents' networks to it
+        """
+        stacked = getattr(self, name)
+        if stacked is not None:
+            stacked = fn(stacked)
+            setattr(self, name, stacked)
+            stacked.link(nets)
+        self._flat_params = None
+
     def prep_training(self, device='gpu'):
         for a in self.agents:
             a.policy.train()
@@ -195,18 +485,23 @@ class MADDPG(object):
         if not self.pol_dev == device:
             for a in self.agents:
                 a.policy = fn(a.policy)
+            self._move_stacked('stacked_policy', self.policies, fn)
             self.pol_dev = device
         if not self.critic_dev == device:
             for a in self.agents:
                 a.critic = fn(a.critic)
+            self._move_stacked('stacked_critic', [a.critic for a in self.agents], fn)
             self.critic_dev = device
         if not self.trgt_pol_dev == device:
             for a in self.agents:
                 a.target_policy = fn(a.target_policy)
+            self._move_stacked('stacked_target_policy', self.target_policies, fn)
             self.trgt_pol_dev = device
         if not self.trgt_critic_dev == device:
             for a in self.agents:
                 a.target_critic = fn(a.target_critic)
+            self._move_stacked('stacked_target_critic',
+                               [a.target_critic for a in self.agents], fn)
             self.trgt_critic_dev = device
 
     def prep_rollouts(self, device='cpu'):
@@ -220,16 +515,27 @@ class MADDPG(object):
         if not self.pol_dev == device:
             for a in self.agents:
                 a.policy = fn(a.policy)
+            self._move_stacked('stacked_policy', self.policies, fn)
             self.pol_dev = device
 
-    def save(self, filename):
+    def save(self, filename, writer=None, links=()):
         """
-        Save trained parameters of all agents into one file
+        Save trained parameters of all agents into one file. The parameters
+        are copied to CPU memory (without moving the networks) and written to
+        a temporary file that is renamed to filename.
+        Inputs:
+            filename (str): File to save to
+            writer (CheckpointWriter): If given, the file is written in the
+                                       background
+            links (list of str): Further paths to hard-link to the file
         """
-        self.prep_training(device='cpu')  # move parameters to CPU before saving
         save_dict = {'init_dict': self.init_dict,
-                     'agent_params': [a.get_params() for a in self.agents]}
-        torch.save(save_dict, filename)
+                     'agent_params': clone_to_cpu([a.get_params() for a in self.agents])}
+        write_fn = lambda path: torch.save(save_dict, path)
+        if writer is None:
+            save_file(filename, write_fn, links=links)
+        else:
+            writer.submit(save_file, filename, write_fn, links)
 
     @classmethod
     def init_from_env(cls, env, agent_alg="MADDPG", adversary_alg="MADDPG",
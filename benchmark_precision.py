@@ -0,0 +1,136 @@
+"""
+Compare float32 and bfloat16 (autocast) MADDPG training on CPU:
+
+    python benchmark_precision.py                   # learner updates per second
+    python benchmark_precision.py --returns         # plus full training runs
+
+The update benchmark runs on a replay buffer of random transitions with the
+dimensions of the SUMO task, so it needs no simulator. With --returns, both
+precisions are trained with training_main.py (same seeds) and the final
+smoothed returns are compared.
+"""
+import argparse
+import copy
+import glob
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+from algorithms.maddpg import MADDPG
+from utils.buffer import ReplayBuffer
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+def make_maddpg(obs_dims, ac_dims, hidden_dim, update_mode):
+    critic_in = sum(obs_dims) + sum(ac_dims)
+    maddpg = MADDPG([{'num_in_pol': o, 'num_out_pol': a, 'num_in_critic': critic_in}
+                     for o, a in zip(obs_dims, ac_dims)],
+                    ['MADDPG'] * len(obs_dims), hidden_dim=hidden_dim, discrete_action=True)
+    if update_mode == 'fused':
+        maddpg.fuse()
+    return maddpg
+
+
+def fill_buffer(obs_dims, ac_dims, n):
+    buffer = ReplayBuffer(n, len(obs_dims), obs_dims, ac_dims)
+    eye = [np.eye(a, dtype=np.float32) for a in ac_dims]
+    for _ in range(n // 64):
+        buffer.push([np.random.randn(64, o) for o in obs_dims],
+                    [e[np.random.randint(len(e), size=64)] for e in eye],
+                    np.random.randn(64, len(obs_dims)),
+                    [np.random.randn(64, o) for o in obs_dims],
+                    np.random.rand(64, len(obs_dims)) < 0.01)
+    return buffer
+
+
+def update_round(maddpg, sample, update_mode):
+    if update_mode == 'per_agent':
+        losses = [maddpg.update(sample, a_i) for a_i in range(maddpg.nagents)]
+        vf_losses = [vf for vf, _ in losses]
+    else:
+        update = maddpg.update_fused if maddpg.fused else maddpg.update_round
+        vf_losses = update(sample)[0]
+    maddpg.update_all_targets()
+    return np.mean(vf_losses)
+
+
+def benchmark_updates(config):
+    obs_dims = [int(d) for d in config.obs_dims.split(',')]
+    ac_dims = [int(d) for d in config.ac_dims.split(',')]
+    torch.manual_seed(config.seed)
+    np.random.seed(config.seed)
+    base = make_maddpg(obs_dims, ac_dims, config.hidden_dim, config.update_mode)
+    buffer = fill_buffer(obs_dims, ac_dims, config.buffer_length)
+    samples = [tuple([t.clone() for t in field] for field in buffer.sample(config.batch_size))
+               for _ in range(config.n_updates)]
+    print('CPU capability: %s, threads: %i' % (torch.backends.cpu.get_cpu_capability(),
+                                               torch.get_num_threads()))
+    results = {}
+    for name, dtype in PRECISIONS.items():
+        maddpg = copy.deepcopy(base)
+        maddpg.autocast_dtype = dtype
+        maddpg.prep_training(device='cpu')
+        for sample in samples[:config.n_warmup]:
+            update_round(maddpg, sample, config.update_mode)
+        maddpg = copy.deepcopy(base)  # same starting point for the losses
+        maddpg.autocast_dtype = dtype
+        maddpg.prep_training(device='cpu')
+        start = time.time()
+        losses = [update_round(maddpg, sample, config.update_mode) for sample in samples]
+        elapsed = time.time() - start
+        results[name] = np.array(losses)
+        print('%s: %7.1f update rounds/s, final critic loss %.4f'
+              % (name, config.n_updates / elapsed, np.mean(losses[-10:])))
+    drift = np.abs(results['bf16'] - results['fp32']) / np.abs(results['fp32'])
+    print('relative critic loss difference bf16 vs fp32: mean %.2e, max %.2e'
+          % (drift.mean(), drift.max()))
+
+
+def benchmark_returns(config):
+    finals = {}
+    for name in PRECISIONS:
+        finals[name] = []
+        for seed in config.seeds.split(','):
+            model_name = 'precision_%s' % name
+            subprocess.check_call([sys.executable, 'training_main.py',
+                                   '--precision', name, '--seed', seed,
+                                   '--batch_size', str(config.batch_size),
+                                   '--n_episodes', str(config.n_episodes),
+                                   '--env_id', config.env_id, '--model_name', model_name]
+                                  + config.train_args.split())
+            pattern = os.path.join('models', config.env_id, model_name,
+                                   'maddpg_*_%s*' % seed, 'scores.csv')
+            scores = np.atleast_1d(np.loadtxt(sorted(glob.glob(pattern))[-1]))
+            finals[name].append(np.mean(scores[-10:]))
+    for name, values in finals.items():
+        print('%s: final smoothed return %.3f +- %.3f over %i seeds'
+              % (name, np.mean(values), np.std(values), len(values)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=1024, type=int)
+    parser.add_argument("--n_updates", default=200, type=int,
+                        help="Timed update rounds per precision")
+    parser.add_argument("--n_warmup", default=20, type=int)
+    parser.add_argument("--update_mode", default="per_agent", type=str,
+                        choices=['per_agent', 'round', 'fused'])
+    parser.add_argument("--hidden_dim", default=64, type=int)
+    parser.add_argument("--obs_dims", default="4,4,11", type=str)
+    parser.add_argument("--ac_dims", default="5,9,2", type=str)
+    parser.add_argument("--buffer_length", default=int(1e5), type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--returns", action='store_true',
+                        help="Also train both precisions with training_main.py")
+    parser.add_argument("--seeds", default="42,43,44", type=str)
+    parser.add_argument("--n_episodes", default=300, type=int)
+    parser.add_argument("--env_id", default="simple", type=str)
+    parser.add_argument("--train_args", default="", type=str,
+                        help="Further training_main.py arguments")
+    config = parser.parse_args()
+    benchmark_updates(config)
+    if config.returns:
+        benchmark_returns(config)
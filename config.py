@@ -25,6 +25,8 @@ ACTOR_LR = 0.0001
 CRITIC_LR = 0.0001
 GAMMA = 0.95
 TAU = 0.01
+# compile the SuperAgent training step with XLA
+JIT_COMPILE = False
 
 MAX_GAMES = 300
 TRAINING_STEP = MAX_GAMES/20
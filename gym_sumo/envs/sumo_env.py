@@ -15,6 +15,18 @@ from itertools import combinations, product
 from utilss import get_space_dims
 from scipy.spatial.distance import cdist
 
+# density thresholds of the agent 2 reward evaluated in the paper (run_tests.py)
+DENSITY_THRESHOLDS = (1.75, 4.87, 9.27, 16.69, 35.64)
+
+
+def normalize_density_threshold(density_threshold):
+    """
+    Map a density threshold to [0, 1] on a log scale over DENSITY_THRESHOLDS
+    (the thresholds are roughly geometrically spaced)
+    """
+    low, high = np.log(DENSITY_THRESHOLDS[0]), np.log(DENSITY_THRESHOLDS[-1])
+    return float(np.clip((np.log(density_threshold) - low) / (high - low), 0, 1))
+
 
 class Agent:
     def __init__(self, env, n_agent, edge_agent=None):
@@ -572,11 +584,22 @@ class SUMOEnv(gym.Env):
                  observation_callback=None, info_callback=None,
                  done_callback=None, shared_viewer=True,mode='gui',
                  edges=['E0', '-E1','-E2', '-E3'], simulation_end=36000,
-                 joint_agents=False, density_threshold=4.87, load_state=False):
-        self.pid = os.getpid()
+                 joint_agents=False, density_threshold=4.87, load_state=False,
+                 label=None, density_thresholds=None, condition_on_density=False):
+        # label: name of the TraCI connection. Set it to run several envs in
+        # one process; the pid then also carries the label so that generated
+        # network/state files do not clash between envs of the same process.
+        self.label = label
+        self.pid = os.getpid() if label is None else f'{os.getpid()}_{label}'
         self.load_state = load_state
         # self.sumoCMD = []
         self.density_threshold = density_threshold
+        # density_thresholds: if given, the threshold of each training episode
+        # is drawn from them. condition_on_density: append the (normalized)
+        # threshold to every observation, so that one model can be trained
+        # for and evaluated at any threshold.
+        self.density_thresholds = density_thresholds
+        self.condition_on_density = condition_on_density
         self.modeltype = 'model'
         self.joint_agents = joint_agents
         self.generatedFiles = []
@@ -653,7 +676,7 @@ class SUMOEnv(gym.Env):
             num_agent_factor = 1
         self.n = self._num_lane_agents*num_agent_factor
         self.agents = self.createNAgents(self.edge_agents)
-        self._num_observation = [len(Agent(self, i, self.edge_agents[j]).getState()) for j in range(num_agent_factor) for i in range(self._num_lane_agents)]
+        self._num_observation = [len(Agent(self, i, self.edge_agents[j]).getState()) + int(self.condition_on_density) for j in range(num_agent_factor) for i in range(self._num_lane_agents)]
         self._num_actions = [len(carLane_width_actions), len(bikeLane_width_actions),2]*num_agent_factor
         self.action_space = []
         self.observation_space = []
@@ -767,6 +790,8 @@ class SUMOEnv(gym.Env):
             edge_agent.resetAllVariables()
 
         if self._scenario=="Train":
+            if self.density_thresholds is not None:
+                self.density_threshold = np.random.choice(self.density_thresholds)
             self._slotId = np.random.randint(1,120)
             #Adapt Route File for continous change
             # self._slotId = 3 # temporary
@@ -847,6 +872,8 @@ class SUMOEnv(gym.Env):
     # get observation for a particular agent
     def _get_obs(self, agent):
         state = agent.getState()
+        if self.condition_on_density:
+            state = np.append(state, normalize_density_threshold(self.density_threshold))
         return state
         # return self.getState(agent)
 
@@ -1167,7 +1194,8 @@ class SUMOEnv(gym.Env):
         return self._carQueueLength, self._bikeQueueLength, self._pedQueueLength
 
     def initSimulator(self,withGUI,portnum):
-        if self.withGUI:
+        if self.withGUI or self.label is not None:
+            # libsumo only supports a single simulation per process
             import traci
         else:
             try:
@@ -1194,6 +1222,9 @@ class SUMOEnv(gym.Env):
                             '-r', 'gym_sumo/envs/sumo_configs/intersection.rou.xml']
 
         # Initialize the simulation
+        if self.label is not None:
+            traci.start([sumoBinary] + self.sumoCMD + sumoStartArgs, label=self.label)
+            return traci.getConnection(self.label)
         traci.start([sumoBinary] + self.sumoCMD + sumoStartArgs)
         return traci
 
@@ -5,10 +5,13 @@ import sys
 sys.path.append("../src")
 from config import *
 from utilss import get_space_dims
+from utils.storage import Minibatch, TransitionStorage
+from utils.checkpoint import atomic_write
 
 np.random.seed(42)
 class ReplayBuffer():
-    def __init__(self, env, buffer_capacity=BUFFER_CAPACITY, batch_size=BATCH_SIZE, min_size_buffer=MIN_SIZE_BUFFER):
+    def __init__(self, env, buffer_capacity=BUFFER_CAPACITY, batch_size=BATCH_SIZE, min_size_buffer=MIN_SIZE_BUFFER,
+                 dtype=np.float32, memmap_dir=None):
         self.buffer_capacity = buffer_capacity
         self.batch_size = batch_size
         self.min_size_buffer = min_size_buffer
@@ -18,97 +21,82 @@ class ReplayBuffer():
         self.list_actors_dimension = [get_space_dims(env.observation_space[index]) for index in range(self.n_agents)]
         self.critic_dimension = sum(self.list_actors_dimension)        
         self.list_actor_n_actions = [get_space_dims(env.action_space[index]) for index in range(self.n_agents)]
-        
-        self.states = np.zeros((self.buffer_capacity, self.critic_dimension))
-        self.rewards = np.zeros((self.buffer_capacity, self.n_agents))
-        self.next_states = np.zeros((self.buffer_capacity, self.critic_dimension))
-        self.dones = np.zeros((self.buffer_capacity, self.n_agents), dtype=bool)
 
-        self.list_actors_states = []
-        self.list_actors_next_states = []
-        self.list_actors_actions = []
-        
-        for n in range(self.n_agents):
-            self.list_actors_states.append(np.zeros((self.buffer_capacity, self.list_actors_dimension[n])))
-            self.list_actors_next_states.append(np.zeros((self.buffer_capacity, self.list_actors_dimension[n])))
-            self.list_actors_actions.append(np.zeros((self.buffer_capacity, self.list_actor_n_actions[n])))
+        # the critic state is the concatenation of the actor states, so each
+        # observation is stored once (as a joint row) and the actor states are
+        # column slices of it; next states share the rows of the following record
+        self.storage = TransitionStorage(self.buffer_capacity, self.list_actors_dimension,
+                                         self.list_actor_n_actions, dtype=dtype,
+                                         memmap_dir=memmap_dir)
+        # float32 arrays the minibatches are gathered into, reused every call
+        self.minibatch = Minibatch(self.storage, self.batch_size)
+        obs_slices, ac_slices = self.storage.obs_slices, self.storage.ac_slices
+        self.actors_state = [self.minibatch.obs[:, obs_slices[index]] for index in range(self.n_agents)]
+        self.actors_next_state = [self.minibatch.next_obs[:, obs_slices[index]] for index in range(self.n_agents)]
+        self.actors_action = [self.minibatch.acs[:, ac_slices[index]] for index in range(self.n_agents)]
             
     def __len__(self):
         return self.buffer_counter
         
     def check_buffer_size(self):
-        return self.buffer_counter >= self.batch_size and self.buffer_counter >= self.min_size_buffer
+        return len(self.storage) >= self.batch_size and len(self.storage) >= self.min_size_buffer
     
     def update_n_games(self):
         self.n_games += 1
           
     def add_record(self, actor_states, actor_next_states, actions, state, next_state, reward, done):
-        
-        index = self.buffer_counter % self.buffer_capacity
+        self.add_records(actor_states, actor_next_states,
+                         [np.reshape(action, (1, -1)) for action in actions],
+                         np.reshape(state, (1, -1)), np.reshape(next_state, (1, -1)),
+                         np.reshape(reward, (1, -1)), np.reshape(done, (1, -1)))
 
-        for agent_index in range(self.n_agents):
-            self.list_actors_states[agent_index][index] = actor_states[agent_index]
-            self.list_actors_next_states[agent_index][index] = actor_next_states[agent_index]
-            self.list_actors_actions[agent_index][index] = actions[agent_index]
+    def add_records(self, actors_states, actors_next_states, actions, states, next_states, rewards, dones,
+                    env_ids=None):
+        """
+        Add one record per env in one storage write. The actor states are
+        not stored separately: they are column slices of the (joint) states.
 
-        self.states[index] = state
-        self.next_states[index] = next_state
-        self.rewards[index] = reward
-        self.dones[index] = done
-            
-        self.buffer_counter += 1
+        actions: per-agent arrays (n_envs, n_actions)
+        states, next_states: (n_envs, critic dimension)
+        rewards, dones: (n_envs, n_agents)
+        env_ids: env of each row, used to share observations between
+                 consecutive records of an env (default: row i is env i)
+        """
+        states = np.asarray(states)
+        self.storage.push(states,
+                          np.concatenate([np.reshape(action, (len(states), -1)) for action in actions], axis=1),
+                          np.reshape(rewards, (len(states), -1)),
+                          np.asarray(next_states),
+                          np.reshape(dones, (len(states), -1)),
+                          env_ids=env_ids)
+        self.buffer_counter += len(states)
             
     def get_minibatch(self):
-        # If the counter is less than the capacity we don't want to take zeros records, 
-        # if the cunter is higher we don't access the record using the counter 
-        # because older records are deleted to make space for new one
-        buffer_range = min(self.buffer_counter, self.buffer_capacity)
-
-        batch_index = np.random.choice(buffer_range, self.batch_size, replace=False)
+        batch_index = self.storage.sample_indices(self.batch_size)
 
-        # Take indices
-        state = self.states[batch_index]
-        reward = self.rewards[batch_index]
-        next_state = self.next_states[batch_index]
-        done = self.dones[batch_index]
-            
-        actors_state = [self.list_actors_states[index][batch_index] for index in range(self.n_agents)]
-        actors_next_state = [self.list_actors_next_states[index][batch_index] for index in range(self.n_agents)]
-        actors_action = [self.list_actors_actions[index][batch_index] for index in range(self.n_agents)]
+        state, actions, reward, next_state, done = self.storage.gather(batch_index, self.minibatch)
 
-        return state, reward, next_state, done, actors_state, actors_next_state, actors_action
+        # float32 views of the same arrays, overwritten by the next call
+        return state, reward, next_state, done, self.actors_state, self.actors_next_state, self.actors_action
     
-    def save(self, folder_path):
+    def save(self, folder_path, writer=None):
         """
-        Save the replay buffer
+        Save the replay buffer (in the background if a CheckpointWriter is given)
         """
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         
-        np.save(folder_path + '/states.npy', self.states)
-        np.save(folder_path + '/rewards.npy', self.rewards)
-        np.save(folder_path + '/next_states.npy', self.next_states)
-        np.save(folder_path + '/dones.npy', self.dones)
-        
-        for index in range(self.n_agents):
-            np.save(folder_path + '/states_actor_{}.npy'.format(index), self.list_actors_states[index])
-            np.save(folder_path + '/next_states_actor_{}.npy'.format(index), self.list_actors_next_states[index])
-            np.save(folder_path + '/actions_actor_{}.npy'.format(index), self.list_actors_actions[index])
+        self.storage.save(folder_path, writer=writer)
             
         dict_info = {"buffer_counter": self.buffer_counter, "n_games": self.n_games}
         
-        with open(folder_path + '/dict_info.json', 'w') as f:
-            json.dump(dict_info, f)
+        def write_info(path):
+            with open(path, 'w') as f:
+                json.dump(dict_info, f)
+        atomic_write(folder_path + '/dict_info.json', write_info)
             
     def load(self, folder_path):
-        self.states = np.load(folder_path + '/states.npy')
-        self.rewards = np.load(folder_path + '/rewards.npy')
-        self.next_states = np.load(folder_path + '/next_states.npy')
-        self.dones = np.load(folder_path + '/dones.npy')
-        
-        self.list_actors_states = [np.load(folder_path + '/states_actor_{}.npy'.format(index)) for index in range(self.n_agents)]
-        self.list_actors_next_states = [np.load(folder_path + '/next_states_actor_{}.npy'.format(index)) for index in range(self.n_agents)]
-        self.list_actors_actions = [np.load(folder_path + '/actions_actor_{}.npy'.format(index)) for index in range(self.n_agents)]
+        self.storage.load(folder_path)
         
         with open(folder_path + '/dict_info.json', 'r') as f:
             dict_info = json.load(f)
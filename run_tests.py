@@ -12,6 +12,10 @@ densities = [1.75,
 # for density in densities:
 #     os.system(f"python testing_main.py --density {density} --num_seeds {10}")
 
+# one density-conditioned model (training_main.py --density_thresholds 1.75,4.87,9.27,16.69,35.64)
+# for density in densities:
+#     os.system(f"python testing_main.py --density {density} --num_seeds {10} --density_conditioned")
+
 # density = 4.87
 # modeltypes = ['heuristic', 'static']
 
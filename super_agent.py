@@ -10,7 +10,7 @@ from replay_buffer import *
 from agent import *
 
 class SuperAgent:
-    def __init__(self, env, path_save=PATH_SAVE_MODEL, path_load=PATH_LOAD_FOLDER):
+    def __init__(self, env, path_save=PATH_SAVE_MODEL, path_load=PATH_LOAD_FOLDER, jit_compile=JIT_COMPILE):
         self.path_save = path_save
         self.path_load = path_load
         self.replay_buffer = ReplayBuffer(env)
@@ -18,9 +18,16 @@ class SuperAgent:
         self.agents = [Agent(env, agent) for agent in range(self.n_agents)]
         date_now = time.strftime("%Y%m%d%H%M")
         self.full_path = f"{self.path_save}/save_agent_{date_now}_{env.pid}"
+        # the whole MADDPG step (all agents' losses, gradient steps and target
+        # updates) runs as one graph, traced on the first call; the minibatch
+        # shapes are fixed, so it is never retraced
+        self._train_step = tf.function(self._train_step, jit_compile=jit_compile)
+        # all actors in one graph; the batch size (number of envs) may vary
+        self._actors_forward = tf.function(self._actors_forward, reduce_retracing=True)
 
     def get_actions(self, agents_states,epsilon,evaluation):
-        list_actions = [self.agents[index].get_actions(agents_states[index],epsilon,evaluation) for index in range(self.n_agents)]
+        list_actions = self.get_actions_batch([np.reshape(states, (1, -1)) for states in agents_states], epsilon, evaluation)
+        list_actions = [actions[0] for actions in list_actions]
         # list_actions = []
         # for index in range(self.n_agents):
         #     states = agents_states[index]
@@ -29,16 +36,39 @@ class SuperAgent:
         #     act = self.agents[index].get_actions(states,epsilon,evaluation)
         #     list_actions.append(act)
         return list_actions
+
+    def get_actions_batch(self, agents_states, epsilon, evaluation=False):
+        """
+        Actions of every agent for a batch of envs, from one graph execution.
+        Outside of evaluation, each (env, agent) pair explores with
+        probability epsilon by adding Gaussian noise, as Agent.get_actions.
+
+        agents_states: per-agent arrays (n_envs, actor dimension)
+        returns: per-agent arrays (n_envs, n_actions)
+        """
+        list_actions = [actions.numpy() for actions in
+                        self._actors_forward([tf.convert_to_tensor(states, dtype=tf.float32) for states in agents_states])]
+        if not evaluation:
+            # .numpy() may share the (read-only) tensor memory, so no in-place add
+            list_actions = [actions + (np.random.random((len(actions), 1)) < epsilon) *
+                            np.random.randn(*actions.shape).astype(np.float32) * agent.noise_sigma
+                            for agent, actions in zip(self.agents, list_actions)]
+        return [np.clip(actions, 0.1, 0.9) for actions in list_actions]
+
+    def _actors_forward(self, agents_states):
+        return [self.agents[index].actor(agents_states[index]) for index in range(self.n_agents)]
     
-    def save(self):
+    def save(self, writer=None):
         full_path = self.full_path
         if not os.path.isdir(full_path):
             os.makedirs(full_path)
         
+        # the weights are small and written right away; the replay buffer is
+        # snapshotted and written by the CheckpointWriter, if given
         for agent in self.agents:
             agent.save(full_path)
             
-        self.replay_buffer.save(full_path)
+        self.replay_buffer.save(full_path, writer=writer)
     
     def load(self):
         full_path = self.path_load
@@ -61,16 +91,11 @@ class SuperAgent:
         if self.replay_buffer.check_buffer_size() == False:
             return
         
-        state, reward, next_state, done, actors_state, actors_next_state, actors_action = self.replay_buffer.get_minibatch()
-        
-        states = tf.convert_to_tensor(state, dtype=tf.float32)
-        rewards = tf.convert_to_tensor(reward, dtype=tf.float32)
-        next_states = tf.convert_to_tensor(next_state, dtype=tf.float32)
-        
-        actors_states = [tf.convert_to_tensor(s, dtype=tf.float32) for s in actors_state]
-        actors_next_states = [tf.convert_to_tensor(s, dtype=tf.float32) for s in actors_next_state]
-        actors_actions = [tf.convert_to_tensor(s, dtype=tf.float32) for s in actors_action]
-        
+        # the minibatch arrays are float32 already, so feeding them to the graph
+        # is a plain copy
+        return self._train_step(*self.replay_buffer.get_minibatch())
+
+    def _train_step(self, states, rewards, next_states, done, actors_states, actors_next_states, actors_actions):
         with tf.GradientTape(persistent=True) as tape:
             target_actions = [self.agents[index].target_actor(actors_next_states[index]) for index in range(self.n_agents)]
             policy_actions = [self.agents[index].actor(actors_states[index]) for index in range(self.n_agents)]
@@ -49,10 +49,17 @@ def run(config):
                 'edges': EDGES,
                 'joint_agents': joint_agents,
                 'load_state': config.load_state}
+    if config.density_conditioned:
+        # one model trained with training_main.py --density_thresholds,
+        # told the threshold to evaluate through its observations
+        env_kwargs.update(density_threshold=config.density, condition_on_density=True)
     
 
     model_dir = Path('./models') / config.env_id / config.model_name
-    curr_run = f'{config.run_id}_{config.density:.2f}{"_joint" if joint_agents else ""}_{config.seed}' + config.model_id 
+    if config.density_conditioned:
+        curr_run = f'{config.run_id}_cond{"_joint" if joint_agents else ""}_{config.seed}' + config.model_id
+    else:
+        curr_run = f'{config.run_id}_{config.density:.2f}{"_joint" if joint_agents else ""}_{config.seed}' + config.model_id 
     # curr_run = f'{config.run_id}_{config.density}_{config.seed}' + config.model_id
     run_dir = model_dir / curr_run
     log_dir = run_dir / 'logs'
@@ -229,6 +236,9 @@ if __name__ == '__main__':
     parser.add_argument("--lr", default=0.01, type=float)
     parser.add_argument("--tau", default=0.01, type=float)
     parser.add_argument("--density", default=4.87, type=float)
+    parser.add_argument("--density_conditioned", action='store_true',
+                        help="Evaluate the density-conditioned model (trained with "
+                             "--density_thresholds) at --density")
     parser.add_argument("--num_seeds", default=5, type=int)
     parser.add_argument("--agent_alg",
                         default="MADDPG", type=str,
@@ -0,0 +1,173 @@
+"""
+Train one MADDPG learner per seed in a single process:
+
+    python train_ensemble.py --seeds 42,43,44,45,46
+
+Each seed gets its own rollout envs (seeded as training_main.py seeds them)
+and replay buffer, and all seeds are updated together with one vectorized
+update round per step (see algorithms.ensemble.MADDPGEnsemble). The models
+and scores are saved where training_main.py saves the run of each seed.
+"""
+import argparse
+import os
+import numpy as np
+import torch
+import wandb
+from gym.spaces import Box
+from tqdm import tqdm
+from algorithms.maddpg import MADDPG
+from algorithms.ensemble import MADDPGEnsemble
+from utils.buffer import ReplayBuffer
+from utils.env_wrappers import SubprocVecEnv
+from utils.inference import PolicyEngine
+from utils.rollout import EnsembleCollector
+from utils.checkpoint import CheckpointWriter
+from training_main import CustomVecEnv, make_env_fn, joint_agents, save, USE_CUDA
+
+
+def run(config, wandb_run):
+    seeds = [int(seed) for seed in config.seeds.split(',')]
+    model_dir = os.path.join('models', config.env_id, config.model_name)
+    run_dirs = [os.path.join(model_dir, f'maddpg_{4.87}_{seed}' + ('_joint' if joint_agents else ''))
+                for seed in seeds]
+    for run_dir in run_dirs:
+        os.makedirs(run_dir, exist_ok=True)
+    np.random.seed(seeds[0])
+    if not USE_CUDA:
+        torch.set_num_threads(config.n_training_threads)
+
+    # the envs of member m are those of a training_main.py run with seed m
+    env_fns = [make_env_fn(rank, seed, joint_agents=joint_agents, load_state=config.load_state)
+               for seed in seeds for rank in range(config.n_rollout_threads)]
+    if len(env_fns) == 1:
+        env = CustomVecEnv(env_fns)
+    else:
+        env = SubprocVecEnv(env_fns, auto_restart=config.auto_restart,
+                            timeout=config.worker_timeout)
+    env.agent_types = env.get_attr('agent_types')[0]
+    members = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        maddpg = MADDPG.init_from_env(env, tau=config.tau, lr=config.lr,
+                                      hidden_dim=config.hidden_dim)
+        if config.precision == 'bf16':
+            maddpg.autocast_dtype = torch.bfloat16
+        members.append(maddpg)
+    ensemble = MADDPGEnsemble(members)
+    obs_dims = [obsp.shape[0] for obsp in env.observation_space.spaces.values()]
+    ac_dims = [acsp.shape[0] if isinstance(acsp, Box) else acsp.n
+               for acsp in env.action_space.spaces]
+    replay_buffers = [ReplayBuffer(config.buffer_length, ensemble.nagents, obs_dims, ac_dims,
+                                   dtype=np.dtype(config.buffer_dtype))
+                      for _ in seeds]
+    engines = None
+    if config.batched_inference:
+        # acting through views of the stacked policy the ensemble updates
+        engines = [PolicyEngine(maddpg, stacked_policy=lambda m=m: ensemble.member_policy(m))
+                   for m, maddpg in enumerate(members)]
+    agent_names = env.get_attr('getAgentNames')[0]
+    collector = EnsembleCollector(env, members, agent_names, engines=engines)
+    checkpointer = CheckpointWriter()
+
+    t = 0
+    scores = [[] for _ in seeds]
+    smoothed_total_rewards = np.zeros(len(seeds))
+    n_envs = config.n_rollout_threads
+    device = 'gpu' if USE_CUDA else 'cpu'
+    for ep_i in tqdm(range(0, config.n_episodes, n_envs)):
+        total_rewards = np.zeros(len(seeds))
+        env0_steps = np.zeros(len(seeds))
+        val_losses, pol_losses = [], []
+        obs = env.reset()
+        ensemble.prep_rollouts(device='cpu')
+        explr_pct_remaining = max(0, config.n_exploration_eps - ep_i) / config.n_exploration_eps
+        ensemble.scale_noise(config.final_noise_scale + (config.init_noise_scale -
+                                                         config.final_noise_scale) * explr_pct_remaining)
+        ensemble.reset_noise()
+        for batches in collector.rollout(obs, config.episode_length):
+            for m, batch in enumerate(batches):
+                if batch is None:
+                    continue
+                env_ids, batch_obs, agent_actions, rewards, batch_next_obs, dones, _ = batch
+                replay_buffers[m].push(batch_obs, agent_actions, rewards, batch_next_obs,
+                                       dones, env_ids=env_ids)
+                # agent 0 of the member's env 0 (absent if its transition was dropped)
+                env0_rows = np.flatnonzero(env_ids == 0)
+                if len(env0_rows):
+                    total_rewards[m] += float(rewards[env0_rows[0]][0])
+                    env0_steps[m] += 1
+            t += n_envs
+            if (min(len(buffer) for buffer in replay_buffers) >= config.batch_size and
+                    (t % config.steps_per_update) < n_envs):
+                ensemble.prep_training(device=device)
+                for _ in range(n_envs):
+                    samples = [buffer.sample(config.batch_size, to_gpu=USE_CUDA)
+                               for buffer in replay_buffers]
+                    val_loss, pol_loss = ensemble.update(samples)
+                    ensemble.update_all_targets()
+                    val_losses.append(val_loss.mean(axis=1))
+                    pol_losses.append(pol_loss.mean(axis=1))
+                ensemble.prep_rollouts(device=device)
+        smoothed_total_rewards = (smoothed_total_rewards * 0.9 +
+                                  total_rewards / np.maximum(env0_steps, 1) * 0.1)
+        log = {'# Episodes': ep_i}
+        for m, seed in enumerate(seeds):
+            scores[m].append(smoothed_total_rewards[m])
+            log['Average reward/seed %i' % seed] = smoothed_total_rewards[m]
+            if val_losses:
+                log['Critic loss/seed %i' % seed] = np.mean([loss[m] for loss in val_losses])
+                log['Actor loss/seed %i' % seed] = np.mean([loss[m] for loss in pol_losses])
+        wandb_run.log(log)
+
+        if (ep_i % config.save_interval) < n_envs and save:
+            for maddpg, run_dir in zip(members, run_dirs):
+                os.makedirs(os.path.join(run_dir, 'incremental'), exist_ok=True)
+                maddpg.save(os.path.join(run_dir, 'incremental', 'model_ep%i.pt' % (ep_i + 1)),
+                            writer=checkpointer, links=[os.path.join(run_dir, 'model.pt')])
+    if save:
+        for maddpg, run_dir, member_scores in zip(members, run_dirs, scores):
+            maddpg.save(os.path.join(run_dir, 'model.pt'), writer=checkpointer)
+            np.savetxt(os.path.join(run_dir, 'scores.csv'), member_scores)
+    checkpointer.close()
+    env.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", default="42,43,44,45,46", type=str,
+                        help="Comma-separated seeds, one ensemble member each")
+    parser.add_argument("--env_id", default="simple", type=str)
+    parser.add_argument("--model_name", default="simple_model", type=str)
+    parser.add_argument("--n_rollout_threads", default=1, type=int,
+                        help="Rollout envs per seed")
+    parser.add_argument("--n_training_threads", default=4, type=int)
+    parser.add_argument("--buffer_length", default=int(1e6), type=int)
+    parser.add_argument("--buffer_dtype", default="float32", type=str,
+                        choices=['float32', 'float16'])
+    parser.add_argument("--n_episodes", default=1500, type=int)
+    parser.add_argument("--episode_length", default=20, type=int)
+    parser.add_argument("--steps_per_update", default=10, type=int)
+    parser.add_argument("--batch_size", default=1024, type=int)
+    parser.add_argument("--n_exploration_eps", default=500, type=int)
+    parser.add_argument("--init_noise_scale", default=0.3, type=float)
+    parser.add_argument("--final_noise_scale", default=0.0, type=float)
+    parser.add_argument("--save_interval", default=30, type=int)
+    parser.add_argument("--hidden_dim", default=64, type=int)
+    parser.add_argument("--lr", default=0.01, type=float)
+    parser.add_argument("--tau", default=0.01, type=float)
+    parser.add_argument("--precision", default="fp32", type=str, choices=['fp32', 'bf16'])
+    parser.add_argument("--batched_inference", action='store_true')
+    parser.add_argument("--load_state", action='store_true')
+    parser.add_argument("--auto_restart", action='store_true')
+    parser.add_argument("--worker_timeout", default=None, type=float)
+    config = parser.parse_args()
+
+    use_wandb = os.environ.get('WANDB_MODE', 'online')
+    if not save:
+        use_wandb = 'disabled'
+    wandb_run = wandb.init(
+        project=f"AdaptableLanesRevisionTRC{'MADDPG_'.lower()}",
+        tags=["MADDPG_final?", "RL", "ensemble"],
+        mode=use_wandb,
+    )
+    run(config, wandb_run)
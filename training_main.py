@@ -1,4 +1,5 @@
 import argparse
+import math
 import torch
 import time
 import os
@@ -6,7 +7,7 @@ import numpy as np
 from gym.spaces import Box, Discrete
 from pathlib import Path
 from torch.autograd import Variable
-from utils.buffer import ReplayBuffer
+from utils.buffer import ReplayBuffer, PrioritizedReplayBuffer
 from algorithms.maddpg import MADDPG
 
 import numpy as np
@@ -18,11 +19,19 @@ import warnings
 warnings.filterwarnings('ignore')
 import wandb
 from argparse import ArgumentParser
-from utils.env_wrappers import DummyVecEnv, SubprocVecEnv
+from utils.env_wrappers import DummyVecEnv, SubprocVecEnv, HybridVecEnv
+from utils.rollout import SequentialCollector, PipelinedCollector, FirstReadyCollector
+from utils.resources import ResourcePlan, RolloutAutoscaler, available_cores, pin_to_cores
+from utils.learner import AsyncLearner
+from utils.inference import PolicyEngine
+from utils.checkpoint import CheckpointWriter
+from utils.distributed import launch, broadcast_params, LockstepUpdates
 import time
 import os
 from tqdm import tqdm
 import csv
+import tempfile
+import shutil
 from gym_sumo.envs.utils import generateFlowFiles
 from gym_sumo.envs.utils import plot_scores
 from gym_sumo.envs.utils import print_status
@@ -66,23 +75,59 @@ class CustomVecEnv(DummyVecEnv):
             self._save_obs(env_idx, obs)
         return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos))
 
-def make_parallel_env(env_id, n_rollout_threads, seed, discrete_action, joint_agents=False, load_state=False):
+def make_env_fn(rank, seed, joint_agents=False, load_state=False, envs_per_worker=1, env_cores=None,
+                density_thresholds=None):
+    def init_env():
+        if env_cores is not None:
+            # before SUMO is started, so that the server inherits the cores
+            pin_to_cores(env_cores[rank])
+        # envs sharing a worker process need their own TraCI connection
+        label = f'env{rank}' if envs_per_worker > 1 else None
+        # with density_thresholds, each episode draws its threshold, which the
+        # agents observe
+        env = SUMOEnv(mode=mode, edges=EDGES, joint_agents=joint_agents, load_state=load_state,
+                      label=label, density_thresholds=density_thresholds,
+                      condition_on_density=density_thresholds is not None)
+        env.seed(seed + rank * 1000)
+        np.random.seed(seed + rank * 1000)
+        # env.sumo_seed = seed + rank * 1000
+        # set here so that restarted workers come back in the same mode
+        env.set_run_mode(run_mode)
+        return env
+    return init_env
+
+def make_parallel_env(env_id, n_rollout_threads, seed, discrete_action, joint_agents=False, load_state=False,
+                      envs_per_worker=1, auto_restart=False, worker_timeout=None, env_cores=None,
+                      density_thresholds=None):
     def get_env_fn(rank):
-        def init_env():
-            env = SUMOEnv(mode=mode, edges=EDGES, joint_agents=joint_agents, load_state=load_state)
-            env.seed(seed + rank * 1000)
-            np.random.seed(seed + rank * 1000)
-            # env.sumo_seed = seed + rank * 1000
-            return env
-        return init_env
+        return make_env_fn(rank, seed, joint_agents=joint_agents, load_state=load_state,
+                           envs_per_worker=envs_per_worker, env_cores=env_cores,
+                           density_thresholds=density_thresholds)
     if n_rollout_threads == 1:
         return CustomVecEnv([get_env_fn(0)])
+    elif envs_per_worker > 1:
+        return HybridVecEnv([get_env_fn(i) for i in range(n_rollout_threads)],
+                            envs_per_worker=envs_per_worker)
     else:
-        return SubprocVecEnv([get_env_fn(i) for i in range(n_rollout_threads)])
+        return SubprocVecEnv([get_env_fn(i) for i in range(n_rollout_threads)],
+                             auto_restart=auto_restart, timeout=worker_timeout)
 
 def run(config, wandb_run):
+    # set by run_distributed for data-parallel learners
+    rank = getattr(config, 'rank', 0)
+    world_size = getattr(config, 'world_size', 1)
+    distributed = world_size > 1
+    # only the first learner writes the model
+    save_model = save and rank == 0
+    buffer_suffix = '_rank%i' % rank if distributed else ''
     model_dir = Path('./models') / config.env_id / config.model_name
-    curr_run = f'maddpg_{4.87}_{config.seed}'
+    density_thresholds = None
+    if config.density_thresholds is not None:
+        density_thresholds = [float(d) for d in config.density_thresholds.split(',')]
+        # one model for all thresholds, see testing_main.py --density_conditioned
+        curr_run = f'maddpg_cond_{config.seed}'
+    else:
+        curr_run = f'maddpg_{4.87}_{config.seed}'
     if joint_agents:
         curr_run += '_joint'
     run_dir = model_dir / curr_run
@@ -90,17 +135,42 @@ def run(config, wandb_run):
     os.makedirs(log_dir, exist_ok=True)
     # logger = SummaryWriter(str(log_dir))
 
-    torch.manual_seed(config.seed)
-    np.random.seed(config.seed)
+    # learners get their own samples and exploration; their networks are
+    # synchronized below
+    torch.manual_seed(config.seed + rank)
+    np.random.seed(config.seed + rank)
     if not USE_CUDA:
         torch.set_num_threads(config.n_training_threads)
+    autoscaler = None
+    max_envs = config.n_rollout_threads
+    if config.autoscale:
+        if config.n_rollout_threads < 2 or config.envs_per_worker > 1:
+            raise ValueError("--autoscale needs one env per worker and n_rollout_threads > 1")
+        max_envs = config.max_rollout_threads
+        if max_envs is None:
+            # core budget: what is left next to the learner
+            max_envs = ((len(available_cores()) - config.n_training_threads)
+                        // config.cores_per_env)
+        max_envs = max(max_envs, config.n_rollout_threads)
+        autoscaler = RolloutAutoscaler(2 if config.pipelined else 1, max_envs)
+    plan = None
+    if config.pin_cores:
+        # planned for the largest pool, so that added workers get their own cores
+        plan = ResourcePlan(max_envs, config.n_training_threads,
+                            envs_per_worker=config.envs_per_worker,
+                            cores_per_env=config.cores_per_env)
+        plan.apply()
 
-    env = make_parallel_env(config.env_id, config.n_rollout_threads, config.seed,
-                            config.discrete_action, joint_agents=joint_agents, load_state=config.load_state)
+    # each learner drives its own shard of env workers
+    env = make_parallel_env(config.env_id, config.n_rollout_threads, config.seed + rank * 100000,
+                            config.discrete_action, joint_agents=joint_agents, load_state=config.load_state,
+                            envs_per_worker=config.envs_per_worker,
+                            auto_restart=config.auto_restart, worker_timeout=config.worker_timeout,
+                            env_cores=plan.env_cores if plan is not None else None,
+                            density_thresholds=density_thresholds)
     print(env.action_space)
     print(env.observation_space)
     
-    env.env_method('set_run_mode', run_mode)
     # env.setInitialParameters(False)
     env.agent_types = env.get_attr('agent_types')[0]
     maddpg = MADDPG.init_from_env(env, agent_alg=config.agent_alg,
@@ -108,113 +178,259 @@ def run(config, wandb_run):
                                   tau=config.tau,
                                   lr=config.lr,
                                   hidden_dim=config.hidden_dim)
-    replay_buffer = ReplayBuffer(config.buffer_length, maddpg.nagents,
-                                 [obsp.shape[0] for obsp in env.observation_space.spaces.values()],
-                                 [acsp.shape[0] if isinstance(acsp, Box) else acsp.n
-                                  for acsp in env.action_space.spaces])
-    t = 0
-    scores = []    
-    smoothed_total_reward = 0
-    pid = os.getpid()
-    trainResultFilePath = f"stat_train_{pid}.csv"  
-    with open(trainResultFilePath, 'w', newline='') as file:
-        writer = csv.writer(file)
-        written_headers = False
+    if distributed:
+        broadcast_params(maddpg)
+    if config.update_mode == 'fused':
+        maddpg.fuse()
+    if config.precision == 'bf16':
+        maddpg.autocast_dtype = torch.bfloat16
+    buffer_dir = config.buffer_dir
+    # a buffer directory created here is removed at the end of the run
+    own_buffer_dir = config.async_learner and buffer_dir is None
+    if own_buffer_dir:
+        # the learner process maps the same files; /dev/shm keeps them in RAM
+        buffer_dir = tempfile.mkdtemp(prefix='replay_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    learner = None
+    try:
+        buffer_kwargs = {'dtype': np.dtype(config.buffer_dtype),
+                         'memmap_dir': buffer_dir}
+        if config.prioritized:
+            buffer_cls = PrioritizedReplayBuffer
+            buffer_kwargs['alpha'] = config.per_alpha
+        else:
+            buffer_cls = ReplayBuffer
+        replay_buffer = buffer_cls(config.buffer_length, maddpg.nagents,
+                                   [obsp.shape[0] for obsp in env.observation_space.spaces.values()],
+                                   [acsp.shape[0] if isinstance(acsp, Box) else acsp.n
+                                    for acsp in env.action_space.spaces],
+                                   **buffer_kwargs)
+        if config.load_buffer is not None:
+            replay_buffer.load(config.load_buffer + buffer_suffix)
+        if config.async_learner:
+            learner = AsyncLearner(maddpg, replay_buffer, config.batch_size,
+                                   update_mode=config.update_mode,
+                                   publish_interval=config.publish_interval,
+                                   max_update_ratio=config.max_update_ratio,
+                                   n_threads=config.n_training_threads,
+                                   cores=plan.learner_cores if plan is not None else None)
 
-        for ep_i in tqdm(range(0, config.n_episodes, config.n_rollout_threads)):
-            total_reward = 0
-            print("Episodes %i-%i of %i" % (ep_i + 1,
-                                            ep_i + 1 + config.n_rollout_threads,
-                                            config.n_episodes))
-            obs = env.reset()
-            print('first time flag', env.get_attr('firstTimeFlag'))
-            step = 0
-            # obs.shape = (n_rollout_threads, nagent)(nobs), nobs differs per agent so not tensor
-            maddpg.prep_rollouts(device='cpu')
+        def learn(update, *args):
+            """
+            One learner step on a fresh sample; with prioritized replay the
+            samples are importance-weighted and their priorities refreshed. In
+            'per_agent' mode each agent draws its own sample, so the priorities
+            are per agent: each update sets those of its sample to that agent's
+            TD errors (the other modes use the mean over the agents).
+            """
+            if config.prioritized:
+                # anneal the importance-sampling correction to 1 over training
+                beta = config.per_beta + (1 - config.per_beta) * min(1.0, ep_i / config.n_episodes)
+                sample, weights, slots = replay_buffer.sample(config.batch_size,
+                                                              to_gpu=USE_CUDA, beta=beta)
+                val_loss, pol_loss, td_errors = update(sample, *args, parallel=distributed,
+                                                       weights=weights)
+                replay_buffer.update_priorities(slots, td_errors)
+            else:
+                sample = replay_buffer.sample(config.batch_size, to_gpu=USE_CUDA)
+                val_loss, pol_loss = update(sample, *args, parallel=distributed)
+            return val_loss, pol_loss
+
+        agent_names = env.get_attr('getAgentNames')[0]
+        engine = None
+        if config.batched_inference:
+            engine = PolicyEngine(maddpg, compile=config.compile_policies)
+        if config.ready_k > 0:
+            collector = FirstReadyCollector(env, maddpg, agent_names, k=config.ready_k,
+                                            engine=engine)
+        elif config.pipelined:
+            collector = PipelinedCollector(env, maddpg, agent_names, engine=engine)
+        else:
+            collector = SequentialCollector(env, maddpg, agent_names, engine=engine)
+        checkpointer = CheckpointWriter()
+        # data-parallel learners run every update round together
+        lockstep = LockstepUpdates() if distributed else None
+        t = 0
+        ep_i = 0
+        learner_rounds = 0
+        scores = []    
+        smoothed_total_reward = 0
+        pid = os.getpid()
+        trainResultFilePath = f"stat_train_{pid}.csv"  
+        with open(trainResultFilePath, 'w', newline='') as file:
+            writer = csv.writer(file)
+            written_headers = False
 
-            explr_pct_remaining = max(0, config.n_exploration_eps - ep_i) / config.n_exploration_eps
-            maddpg.scale_noise(config.final_noise_scale + (config.init_noise_scale - config.final_noise_scale) * explr_pct_remaining)
-            maddpg.reset_noise()
-            # obs = 
-            # oo = np.hstack(obs)
-            # obs = [i[np.newaxis,:] for i in obs]
-            for et_i in range(config.episode_length):
-                step += 1
-                torch_obs = [Variable(torch.Tensor(np.vstack(obs[agentname])),
-                                    requires_grad=False)
-                            for agentname in env.get_attr('getAgentNames')[0]]
-                # get actions as torch Variables
-                torch_agent_actions = maddpg.step(torch_obs, explore=True)
-                # convert actions to numpy arrays
-                agent_actions = [ac.data.numpy() for ac in torch_agent_actions]
-                # rearrange actions to be per environment
-                actions = [[ac[i] for ac in agent_actions] for i in range(config.n_rollout_threads)]
-                # env.envs[0].nextTimeSlot()
-                simple_actions = simplify_actions(actions)
-                # print(env.get_attr('edge_agents'))
-                next_obs, rewards, dones, infos = env.step(simple_actions)
-                replay_buffer.push(list(obs.values()), agent_actions, 
-                                   rewards, list(next_obs.values()), dones)
-                obs = next_obs
-                t += config.n_rollout_threads
-                total_reward += float(rewards[0][0])
+            progress = tqdm(total=config.n_episodes, disable=rank > 0)
+            while ep_i < config.n_episodes:
+                # the pool size can change between episodes with --autoscale
+                n_envs = env.num_envs
+                total_reward = 0
+                print("Episodes %i-%i of %i" % (ep_i + 1,
+                                                ep_i + 1 + n_envs,
+                                                config.n_episodes))
+                ep_start = time.time()
+                learn_time = 0.0
+                n_updates = 0
+                n_env_steps = 0
+                obs = env.reset()
+                print('first time flag', env.get_attr('firstTimeFlag'))
+                step = 0
+                env0_steps = 0
+                # obs.shape = (n_rollout_threads, nagent)(nobs), nobs differs per agent so not tensor
+                maddpg.prep_rollouts(device='cpu')
 
-                # rewardAgent_0, rewardAgent_1, rewardAgent_2 = env.env_method('rewardAnalysisStats')
-                # print(env.env_method('rewardAnalysisStats'))
+                explr_pct_remaining = max(0, config.n_exploration_eps - ep_i) / config.n_exploration_eps
+                maddpg.scale_noise(config.final_noise_scale + (config.init_noise_scale - config.final_noise_scale) * explr_pct_remaining)
+                maddpg.reset_noise()
+                # obs = 
+                # oo = np.hstack(obs)
+                # obs = [i[np.newaxis,:] for i in obs]
+                # with --pipelined each half of the env pool yields its own batch,
+                # and the updates below overlap with the other half stepping
+                for (env_ids, batch_obs, agent_actions, rewards,
+                     batch_next_obs, dones, infos) in collector.rollout(obs, config.episode_length):
+                    step += 1
+                    n_entries = len(env_ids)
+                    replay_buffer.push(batch_obs, agent_actions,
+                                       rewards, batch_next_obs, dones, env_ids=env_ids)
+                    t += n_entries
+                    n_env_steps += n_entries
+                    # agent 0 of env 0, which is not the first row of the batches of
+                    # the pipelined and first-ready collectors
+                    env0_rows = np.flatnonzero(env_ids == 0)
+                    if len(env0_rows):
+                        total_reward += float(rewards[env0_rows[0]][0])
+                        env0_steps += 1
+                    if learner is not None:
+                        # act with the latest policies published by the learner
+                        learner.sync(maddpg)
 
-                # for edge_agent in env.get_attr('edge_agents'):
-                #     print(edge_agent)
-                #     headers, values = edge_agent.testAnalysisStats()
-                #     if not written_headers:
-                #         writer.writerow(headers + ['RewardAgent_0', 'RewardAgent_1', 'RewardAgent_2'])
-                #         written_headers = True
-                #     writer.writerow(values + [rewardAgent_0, rewardAgent_1, rewardAgent_2])
+                    # rewardAgent_0, rewardAgent_1, rewardAgent_2 = env.env_method('rewardAnalysisStats')
+                    # print(env.env_method('rewardAnalysisStats'))
 
-                val_losses = []
-                pol_losses = []
-                if (len(replay_buffer) >= config.batch_size and
-                    (t % config.steps_per_update) < config.n_rollout_threads):
-                    if USE_CUDA:
-                        device = 'gpu'
-                        maddpg.prep_training(device=device)
-                    else:
-                        device = 'cpu'
-                        maddpg.prep_training(device=device)
-                    for u_i in range(config.n_rollout_threads):
-                        for a_i in range(maddpg.nagents):
-                            sample = replay_buffer.sample(config.batch_size,
-                                                        to_gpu=USE_CUDA)
-                            val_loss, pol_loss = maddpg.update(sample, a_i)
-                            val_losses.append(val_loss)
-                            pol_losses.append(pol_loss)
-                        maddpg.update_all_targets()
-                    maddpg.prep_rollouts(device=device)
-            ep_rews = replay_buffer.get_average_rewards(
-                config.episode_length * config.n_rollout_threads)
-            # for a_i, a_ep_rew in enumerate(ep_rews):
-            #     logger.add_scalar('agent%i/mean_episode_rewards' % a_i, a_ep_rew, ep_i)
+                    # for edge_agent in env.get_attr('edge_agents'):
+                    #     print(edge_agent)
+                    #     headers, values = edge_agent.testAnalysisStats()
+                    #     if not written_headers:
+                    #         writer.writerow(headers + ['RewardAgent_0', 'RewardAgent_1', 'RewardAgent_2'])
+                    #         written_headers = True
+                    #     writer.writerow(values + [rewardAgent_0, rewardAgent_1, rewardAgent_2])
+
+                    val_losses = []
+                    pol_losses = []
+                    n_rounds = 0
+                    if (learner is None and len(replay_buffer) >= config.batch_size and
+                        (t % config.steps_per_update) < n_entries):
+                        n_rounds = n_entries
+                    if lockstep is not None:
+                        n_rounds = lockstep.agree(n_rounds)
+                    if n_rounds:
+                        update_start = time.time()
+                        if USE_CUDA:
+                            device = 'gpu'
+                            maddpg.prep_training(device=device)
+                        else:
+                            device = 'cpu'
+                            maddpg.prep_training(device=device)
+                        for u_i in range(n_rounds):
+                            if config.update_mode != 'per_agent':
+                                # one sample per round, shared by all agents
+                                val_loss, pol_loss = learn(maddpg.update_fused if maddpg.fused
+                                                           else maddpg.update_round)
+                                val_losses.extend(val_loss)
+                                pol_losses.extend(pol_loss)
+                                maddpg.update_all_targets()
+                                n_updates += 1
+                                continue
+                            for a_i in range(maddpg.nagents):
+                                val_loss, pol_loss = learn(maddpg.update, a_i)
+                                val_losses.append(val_loss)
+                                pol_losses.append(pol_loss)
+                            maddpg.update_all_targets()
+                            n_updates += 1
+                        maddpg.prep_rollouts(device=device)
+                        learn_time += time.time() - update_start
+                if lockstep is not None:
+                    lockstep.finish()
+                if learner is not None:
+                    stats = learner.stats()
+                    val_losses, pol_losses = [stats['vf_loss']], [stats['pol_loss']]
+                    n_updates = stats['rounds'] - learner_rounds
+                    learner_rounds = stats['rounds']
+                ep_rews = replay_buffer.get_average_rewards(
+                    config.episode_length * n_envs)
+                # for a_i, a_ep_rew in enumerate(ep_rews):
+                #     logger.add_scalar('agent%i/mean_episode_rewards' % a_i, a_ep_rew, ep_i)
            
-            total_reward /= step
-            # show reward
-            smoothed_total_reward = smoothed_total_reward * 0.9 + total_reward * 0.1
-            scores.append(smoothed_total_reward)
+                total_reward /= max(env0_steps, 1)
+                # show reward
+                smoothed_total_reward = smoothed_total_reward * 0.9 + total_reward * 0.1
+                scores.append(smoothed_total_reward)
         
-            # wandb.log({'# Episodes': ep_i, 
-            #     "Average reward": round(np.mean(scores[-10:]), 2)})
-            wandb_run.log({'# Episodes': ep_i, 
-                "Average reward": smoothed_total_reward,
-                'Actor loss': np.mean(pol_losses),
-                'Critic loss': np.mean(val_losses)
-                })
+                # wandb.log({'# Episodes': ep_i, 
+                #     "Average reward": round(np.mean(scores[-10:]), 2)})
+                wandb_run.log({'# Episodes': ep_i, 
+                    "Average reward": smoothed_total_reward,
+                    'Actor loss': np.mean(pol_losses),
+                    'Critic loss': np.mean(val_losses),
+                    'Worker restarts': sum(getattr(env, 'restart_counts', [0])),
+                    'Rollout envs': n_envs
+                    })
+
+                if (ep_i % config.save_interval) < n_envs and save:
+                    if learner is not None:
+                        learner.pull(maddpg)
+                    if save_model:
+                        os.makedirs(run_dir / 'incremental', exist_ok=True)
+                        # written in the background; model.pt is a hard link to it
+                        maddpg.save(run_dir / 'incremental' / ('model_ep%i.pt' % (ep_i + 1)),
+                                    writer=checkpointer, links=[run_dir / 'model.pt'])
+                    if config.save_buffer:
+                        # only the chunks that changed since the last save are written
+                        replay_buffer.save(run_dir / ('replay_buffer' + buffer_suffix),
+                                           writer=checkpointer)
+                ep_i += n_envs
+                progress.update(n_envs)
 
-            if (ep_i % config.save_interval) < config.n_rollout_threads and save:
-                os.makedirs(run_dir / 'incremental', exist_ok=True)
-                maddpg.save(run_dir / 'incremental' / ('model_ep%i.pt' % (ep_i + 1)))
-                maddpg.save(run_dir / 'model.pt')
-        if save:
-            maddpg.save(run_dir / 'model.pt')
-        env.close()
+                if autoscaler is not None:
+                    autoscaler.record(n_envs, n_env_steps, n_updates,
+                                      time.time() - ep_start - learn_time, learn_time,
+                                      len(replay_buffer), config.batch_size,
+                                      max(config.steps_per_update, n_envs) / n_envs)
+                    target = autoscaler.target(n_envs)
+                    if target > n_envs:
+                        env.add_envs([make_env_fn(rank, config.seed, joint_agents=joint_agents,
+                                                  load_state=config.load_state,
+                                                  env_cores=plan.env_cores if plan is not None else None,
+                                                  density_thresholds=density_thresholds)
+                                      for rank in range(n_envs, target)])
+                    elif target < n_envs:
+                        env.remove_envs(n_envs - target)
+            progress.close()
+            if learner is not None:
+                learner.close(maddpg)
+            if save_model:
+                maddpg.save(run_dir / 'model.pt', writer=checkpointer)
+                # smoothed reward per episode, e.g. for benchmark_precision.py
+                np.savetxt(run_dir / 'scores.csv', scores)
+            if save and config.save_buffer:
+                replay_buffer.save(run_dir / ('replay_buffer' + buffer_suffix), writer=checkpointer)
+            checkpointer.close()
+            if any(getattr(env, 'restart_counts', [])):
+                print('Worker restarts per env:', env.restart_counts)
+            env.close()
+            if plan is not None:
+                print(plan.report())
+    finally:
+        if learner is not None:
+            # also after an error, so that the learner unmaps the buffer first
+            learner.close()
+        if own_buffer_dir:
+            shutil.rmtree(buffer_dir, ignore_errors=True)
 
+    if rank > 0:
+        return
     plt.plot(scores)
     plt.xlabel('episodes')
     plt.ylabel('ave rewards')
@@ -223,14 +439,27 @@ def run(config, wandb_run):
         # logger.export_scalars_to_json(str(log_dir / 'summary.json'))
         # logger.close()
 
-def simplify_actions(actions):
-    agent_actions = []
-    for action in actions:
-        if isinstance(action, list):
-            agent_actions.append(simplify_actions(action))
-        else:
-            agent_actions.append(np.argmax(action))
-    return agent_actions
+
+def run_distributed(rank, world_size, config):
+    """
+    Entry point of each data-parallel learner (see utils.distributed.launch):
+    the learners split the episodes and collect with their own env workers,
+    and average their gradients in every update
+    """
+    config.rank = rank
+    config.world_size = world_size
+    config.n_episodes = math.ceil(config.n_episodes / world_size)
+    config.n_exploration_eps = math.ceil(config.n_exploration_eps / world_size)
+    use_wandb = os.environ.get('WANDB_MODE', 'online')
+    if not save or rank > 0:
+        use_wandb = 'disabled'
+    wandb_run = wandb.init(
+        project=f"AdaptableLanesRevisionTRC{'MADDPG_'.lower()}",
+        tags=["MADDPG_final?", "RL"],
+        mode=use_wandb,
+    )
+    run(config, wandb_run)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -242,6 +471,32 @@ if __name__ == '__main__':
     parser.add_argument("--n_rollout_threads", default=1, type=int)
     parser.add_argument("--n_training_threads", default=4, type=int)
     parser.add_argument("--buffer_length", default=int(1e6), type=int)
+    parser.add_argument("--buffer_dtype", default="float32", type=str,
+                        choices=['float32', 'float16'],
+                        help="Storage type of observations and actions in the replay buffer")
+    parser.add_argument("--buffer_dir", default=None, type=str,
+                        help="Keep the replay buffer in memory-mapped files in this directory")
+    parser.add_argument("--save_buffer", action='store_true',
+                        help="Snapshot the replay buffer to <run dir>/replay_buffer along "
+                             "with the model")
+    parser.add_argument("--load_buffer", default=None, type=str,
+                        help="Resume from a replay buffer snapshot (a replay_buffer folder)")
+    parser.add_argument("--prioritized", action='store_true',
+                        help="Sample transitions by TD error (prioritized experience replay)")
+    parser.add_argument("--per_alpha", default=0.6, type=float,
+                        help="Prioritization exponent with --prioritized")
+    parser.add_argument("--per_beta", default=0.4, type=float,
+                        help="Initial importance-sampling exponent with --prioritized "
+                             "(annealed to 1)")
+    parser.add_argument("--async_learner", action='store_true',
+                        help="Run the updates in a separate process sharing the replay "
+                             "buffer, instead of pausing collection for them")
+    parser.add_argument("--publish_interval", default=10, type=int,
+                        help="Update rounds between policy weight updates sent to the "
+                             "collectors with --async_learner")
+    parser.add_argument("--max_update_ratio", default=0, type=float,
+                        help="If > 0, cap on update rounds per collected transition "
+                             "with --async_learner")
     parser.add_argument("--n_episodes", default=1500, type=int)
     parser.add_argument("--episode_length", default=20, type=int)
     parser.add_argument("--steps_per_update", default=10, type=int)
@@ -261,12 +516,83 @@ if __name__ == '__main__':
     parser.add_argument("--adversary_alg",
                         default="MADDPG", type=str,
                         choices=['MADDPG', 'DDPG'])
+    parser.add_argument("--update_mode", default="per_agent", type=str,
+                        choices=['per_agent', 'round', 'fused'],
+                        help="'round' updates all agents from one shared sample, "
+                             "computing policy outputs and critic inputs once; "
+                             "'fused' additionally stacks the agents' networks into "
+                             "one pass (needs MADDPG critics for all agents)")
     parser.add_argument("--discrete_action",
                         action='store_true')
+    parser.add_argument("--precision", default="fp32", type=str,
+                        choices=['fp32', 'bf16'],
+                        help="'bf16' runs the network matrix products of updates and "
+                             "rollouts in bfloat16 (float32 master weights)")
+    parser.add_argument("--batched_inference", action='store_true',
+                        help="Compute the rollout actions of all agents in one batched, "
+                             "grad-free forward pass")
+    parser.add_argument("--compile_policies", default=None, type=str,
+                        choices=['trace', 'compile'],
+                        help="Compile the batched rollout forward pass with "
+                             "TorchScript tracing or torch.compile")
     parser.add_argument("--load_state", action='store_true')
+    parser.add_argument("--pipelined", action='store_true',
+                        help="Step one half of the rollout envs while acting "
+                             "for the other half (needs n_rollout_threads > 1)")
+    parser.add_argument("--ready_k", default=0, type=int,
+                        help="If > 0, hand over transitions as soon as this many "
+                             "rollout envs are done and only re-step those")
+    parser.add_argument("--envs_per_worker", default=1, type=int,
+                        help="Number of SUMO instances driven by each rollout process")
+    parser.add_argument("--auto_restart", action='store_true',
+                        help="Respawn crashed or hung rollout workers instead of aborting")
+    parser.add_argument("--worker_timeout", default=None, type=float,
+                        help="Seconds a rollout worker may take to answer before it "
+                             "is considered hung (with --auto_restart)")
+    parser.add_argument("--pin_cores", action='store_true',
+                        help="Pin the learner and each rollout worker to dedicated cores "
+                             "and limit the workers' thread pools")
+    parser.add_argument("--cores_per_env", default=2, type=int,
+                        help="Cores given to each rollout env (Python driver + SUMO) with --pin_cores")
+    parser.add_argument("--autoscale", action='store_true',
+                        help="Add or remove rollout workers between episodes depending on "
+                             "whether collection or learning is the bottleneck")
+    parser.add_argument("--max_rollout_threads", default=None, type=int,
+                        help="Largest pool with --autoscale (default: free cores / cores_per_env)")
+    parser.add_argument("--density_thresholds", default=None, type=str,
+                        help="Comma-separated density thresholds (e.g. 1.75,4.87,9.27,16.69,35.64) "
+                             "to draw one from per episode and condition the policies and "
+                             "critics on, instead of training for 4.87 only")
+    parser.add_argument("--n_learners", default=1, type=int,
+                        help="Data-parallel learner processes per node, each with its "
+                             "own rollout envs and replay buffer, averaging gradients")
+    parser.add_argument("--nnodes", default=1, type=int,
+                        help="Number of nodes running learners (same command on each)")
+    parser.add_argument("--node_rank", default=0, type=int)
+    parser.add_argument("--master_addr", default="127.0.0.1", type=str,
+                        help="Address of node 0 for the learners' process group")
+    parser.add_argument("--master_port", default=29500, type=int)
 
     config = parser.parse_args()
 
+    # a single env is stepped in-process, without the asynchronous stepping
+    # these collectors need
+    if config.pipelined and config.n_rollout_threads < 2:
+        parser.error("--pipelined needs --n_rollout_threads > 1")
+    if config.ready_k > 0 and config.n_rollout_threads < max(2, config.ready_k):
+        parser.error("--ready_k needs --n_rollout_threads > 1 and at least ready_k envs")
+    # HybridVecEnv workers are not supervised
+    if config.envs_per_worker > 1 and (config.auto_restart or config.worker_timeout is not None):
+        parser.error("--auto_restart and --worker_timeout need --envs_per_worker 1")
+    if config.n_learners * config.nnodes > 1:
+        if config.autoscale or config.async_learner or config.pin_cores:
+            raise ValueError("--autoscale, --async_learner and --pin_cores are not supported "
+                             "with several learners")
+        launch(run_distributed, config.n_learners, nnodes=config.nnodes,
+               node_rank=config.node_rank, master_addr=config.master_addr,
+               master_port=config.master_port, args=(config,))
+        sys.exit()
+
     use_wandb = os.environ.get('WANDB_MODE', 'online') # can be online, offline, or disabled
     if not save:
         use_wandb = 'disabled'
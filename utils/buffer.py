@@ -1,12 +1,14 @@
 import numpy as np
+import torch
 from torch import Tensor
-from torch.autograd import Variable
+from .storage import Minibatch, TransitionStorage
 
 class ReplayBuffer(object):
     """
     Replay Buffer for multi-agent RL with parallel rollouts
     """
-    def __init__(self, max_steps, num_agents, obs_dims, ac_dims):
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims, dtype=np.float32,
+                 memmap_dir=None):
         """
         Inputs:
             max_steps (int): Maximum number of timepoints to store in buffer
@@ -14,85 +16,245 @@ class ReplayBuffer(object):
             obs_dims (list of ints): number of obervation dimensions for each
                                      agent
             ac_dims (list of ints): number of action dimensions for each agent
+            dtype (np.dtype): Storage type of observations and actions
+            memmap_dir (str): If given, keep the buffer in memory-mapped files
+                              in this directory instead of RAM
         """
         self.max_steps = max_steps
         self.num_agents = num_agents
-        self.obs_buffs = []
-        self.ac_buffs = []
-        self.rew_buffs = []
-        self.next_obs_buffs = []
-        self.done_buffs = []
-        for odim, adim in zip(obs_dims, ac_dims):
-            self.obs_buffs.append(np.zeros((max_steps, odim)))
-            self.ac_buffs.append(np.zeros((max_steps, adim)))
-            self.rew_buffs.append(np.zeros(max_steps))
-            self.next_obs_buffs.append(np.zeros((max_steps, odim)))
-            self.done_buffs.append(np.zeros(max_steps))
-
-
-        self.filled_i = 0  # index of first empty location in buffer (last index when full)
-        self.curr_i = 0  # current index to write to (ovewrite oldest data)
+        self.storage = TransitionStorage(max_steps, obs_dims, ac_dims, dtype=dtype,
+                                         memmap_dir=memmap_dir)
+        self._batches = {}  # (batch size, to_gpu) -> preallocated minibatch
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_batches'] = {}  # tensors sharing memory with the arrays
+        return state
 
     def __len__(self):
-        return self.filled_i
-
-    def push(self, observations, actions, rewards, next_observations, dones):
-        nentries = len(observations[0])  # handle multiple parallel environments
-        if self.curr_i + nentries > self.max_steps:
-            rollover = self.max_steps - self.curr_i # num of indices to roll over
-            for agent_i in range(self.num_agents):
-                self.obs_buffs[agent_i] = np.roll(self.obs_buffs[agent_i],
-                                                  rollover, axis=0)
-                self.ac_buffs[agent_i] = np.roll(self.ac_buffs[agent_i],
-                                                 rollover, axis=0)
-                self.rew_buffs[agent_i] = np.roll(self.rew_buffs[agent_i],
-                                                  rollover)
-                self.next_obs_buffs[agent_i] = np.roll(
-                    self.next_obs_buffs[agent_i], rollover, axis=0)
-                self.done_buffs[agent_i] = np.roll(self.done_buffs[agent_i],
-                                                   rollover)
-            self.curr_i = 0
-            self.filled_i = self.max_steps
-        for agent_i in range(self.num_agents):
-            # self.obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-            #     observations[:, agent_i])
-            self.obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = observations[agent_i]
-            # actions are already batched by agent, so they are indexed differently
-            self.ac_buffs[agent_i][self.curr_i:self.curr_i + nentries] = actions[agent_i]
-            self.rew_buffs[agent_i][self.curr_i:self.curr_i + nentries] = rewards[:, agent_i]
-            # self.next_obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-            #     next_observations[:, agent_i])
-            self.next_obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = next_observations[agent_i]
-            self.done_buffs[agent_i][self.curr_i:self.curr_i + nentries] = dones[:, agent_i]
-        self.curr_i += nentries
-        if self.filled_i < self.max_steps:
-            self.filled_i += nentries
-        if self.curr_i == self.max_steps:
-            self.curr_i = 0
-
-    def sample(self, N, to_gpu=False, norm_rews=True):
-        inds = np.random.choice(np.arange(self.filled_i), size=N,
-                                replace=False)
-        if to_gpu:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False).cuda()
-        else:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False)
+        return len(self.storage)
+
+    def push(self, observations, actions, rewards, next_observations, dones, env_ids=None):
+        """
+        Inputs:
+            observations, next_observations (list of np.ndarray): Per-agent
+                observation batches, one row per env
+            actions (list of np.ndarray): Per-agent action batches
+            rewards, dones (np.ndarray): (envs, agents)
+            env_ids (np.ndarray): Env of each row, lets consecutive transitions
+                                  share their observations (default: row i is env i)
+        """
+        self.storage.push(np.concatenate(observations, axis=1),
+                          np.concatenate(actions, axis=1),
+                          rewards,
+                          np.concatenate(next_observations, axis=1),
+                          dones,
+                          env_ids=env_ids)
+
+    def sample_indices(self, N, replace=False):
+        """
+        Draw N indices of stored transitions in O(N)
+        Inputs:
+            N (int): Number of indices
+            replace (bool): Whether or not an index may be drawn twice
+        """
+        return self.storage.sample_indices(N, replace=replace)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, replace=False):
+        # a push from another process must not move the transitions between
+        # drawing and gathering them
+        with self.storage.locked():
+            inds = self.sample_indices(N, replace=replace)
+            return self._get(inds, to_gpu=to_gpu, norm_rews=norm_rews)
+
+    def _minibatch(self, N, to_gpu):
+        """
+        Preallocated minibatch of N transitions: the arrays the storage
+        gathers into, tensors sharing their memory (torch.from_numpy), the
+        tensors handed out (on the GPU if to_gpu) and their per-agent views
+        """
+        key = (N, to_gpu)
+        if key not in self._batches:
+            batch = Minibatch(self.storage, N)
+            tensors = [torch.from_numpy(arr) for arr in batch.arrays]
+            outputs = [t.cuda() for t in tensors] if to_gpu else tensors
+            obs, acs, rews, next_obs, dones = outputs
+            obs_slices, ac_slices = self.storage.obs_slices, self.storage.ac_slices
+            views = ([obs[:, obs_slices[i]] for i in range(self.num_agents)],
+                     [acs[:, ac_slices[i]] for i in range(self.num_agents)],
+                     [rews[:, i] for i in range(self.num_agents)],
+                     [next_obs[:, obs_slices[i]] for i in range(self.num_agents)],
+                     [dones[:, i] for i in range(self.num_agents)])
+            self._batches[key] = (batch, tensors, outputs, views)
+        return self._batches[key]
+
+    def _get(self, inds, to_gpu=False, norm_rews=True):
+        """
+        Per-agent tensors of the transitions inds (0 being the oldest). The
+        tensors are reused: they are overwritten by the next sample of the
+        same size.
+        """
+        batch, tensors, outputs, views = self._minibatch(len(inds), to_gpu)
+        rews = self.storage.gather(inds, batch)[2]
         if norm_rews:
-            ret_rews = [cast((self.rew_buffs[i][inds] -
-                              self.rew_buffs[i][:self.filled_i].mean()) /
-                             self.rew_buffs[i][:self.filled_i].std())
-                        for i in range(self.num_agents)]
-        else:
-            ret_rews = [cast(self.rew_buffs[i][inds]) for i in range(self.num_agents)]
-        return ([cast(self.obs_buffs[i][inds]) for i in range(self.num_agents)],
-                [cast(self.ac_buffs[i][inds]) for i in range(self.num_agents)],
-                ret_rews,
-                [cast(self.next_obs_buffs[i][inds]) for i in range(self.num_agents)],
-                [cast(self.done_buffs[i][inds]) for i in range(self.num_agents)])
+            # running statistics of the whole buffer, O(batch) to apply
+            rew_stats = self.storage.rew_stats
+            np.subtract(rews, rew_stats.mean, out=rews)
+            np.divide(rews, rew_stats.std, out=rews)
+        if to_gpu:
+            for output, tensor in zip(outputs, tensors):
+                output.copy_(tensor)
+        return tuple(list(agent_views) for agent_views in views)
+
+    def save(self, folder_path, writer=None):
+        """
+        Snapshot the stored transitions to folder_path (see
+        TransitionStorage.save)
+        Inputs:
+            folder_path (str): Folder to write to
+            writer (CheckpointWriter): If given, written in the background
+        """
+        self.storage.save(folder_path, writer=writer)
+
+    def load(self, folder_path):
+        """
+        Restore transitions saved with save, e.g. to resume training
+        """
+        self.storage.load(folder_path)
 
     def get_average_rewards(self, N):
-        if self.filled_i == self.max_steps:
-            inds = np.arange(self.curr_i - N, self.curr_i)  # allow for negative indexing
-        else:
-            inds = np.arange(max(0, self.curr_i - N), self.curr_i)
-        return [self.rew_buffs[i][inds].mean() for i in range(self.num_agents)]
+        inds = np.arange(max(0, len(self) - N), len(self))
+        rews = self.storage.rews[self.storage.positions(inds)]
+        return [rews[:, i].mean() for i in range(self.num_agents)]
+
+
+class SumTree(object):
+    """
+    Array-based binary tree whose inner nodes hold the sum of their children,
+    with batched leaf updates and batched prefix-sum search (O(batch * log n))
+    """
+    def __init__(self, capacity):
+        self.n_leaves = 1
+        while self.n_leaves < capacity:
+            self.n_leaves *= 2
+        self.tree = np.zeros(2 * self.n_leaves)  # root at 1, leaves from n_leaves on
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, inds):
+        return self.tree[self.n_leaves + np.asarray(inds)]
+
+    def update(self, inds, values):
+        """
+        Set leaves inds to values and recompute the sums above them
+        """
+        nodes = self.n_leaves + np.asarray(inds)
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """
+        Leaves whose prefix-sum interval contains each of values
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.n_leaves:
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer sampling transitions proportionally to priority ** alpha
+    (prioritized experience replay, Schaul et al. 2016); new transitions get
+    the highest priority seen so far, and the learner refreshes the
+    priorities of sampled transitions with their TD errors
+    """
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims, alpha=0.6, eps=1e-6,
+                 **kwargs):
+        """
+        Inputs:
+            alpha (float): How much prioritization is used (0: uniform)
+            eps (float): Added to priorities so that no transition starves
+            (other inputs as for ReplayBuffer)
+        """
+        super(PrioritizedReplayBuffer, self).__init__(max_steps, num_agents, obs_dims,
+                                                      ac_dims, **kwargs)
+        self.alpha = alpha
+        self.eps = eps
+        self.tree = SumTree(max_steps)  # leaf i = storage slot i
+        self.max_priority = 1.0
+
+    def push(self, observations, actions, rewards, next_observations, dones, env_ids=None):
+        storage = self.storage
+        start, size = storage.head - storage.size, storage.size
+        super(PrioritizedReplayBuffer, self).push(observations, actions, rewards,
+                                                  next_observations, dones, env_ids=env_ids)
+        nentries = len(observations[0])
+        dropped = size + nentries - storage.size
+        if dropped > 0:
+            self.tree.update((start + np.arange(dropped)) % storage.capacity, 0.0)
+        new_slots = storage.positions(np.arange(storage.size - nentries, storage.size))
+        self.tree.update(new_slots, self.max_priority ** self.alpha)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, beta=0.4):
+        """
+        Inputs:
+            beta (float): Importance-sampling correction (1: full correction)
+        Outputs:
+            sample: as returned by ReplayBuffer.sample
+            weights (PyTorch Tensor): Importance weights, normalized to max 1
+            slots (np.ndarray): Storage slots of the sampled transitions, for
+                                update_priorities
+        """
+        storage = self.storage
+        while True:
+            # one draw per equal-mass segment (stratified sampling)
+            bounds = self.tree.total * (np.arange(N) + np.random.uniform(size=N)) / N
+            slots = np.minimum(self.tree.find(bounds), storage.capacity - 1)
+            live = ((self.tree[slots] > 0) &
+                    storage.is_live(storage.obs_ids[slots]) &
+                    storage.is_live(storage.next_obs_ids[slots]))
+            if live.all():
+                break
+            # transitions that lost their observation row early
+            self.tree.update(slots[~live], 0.0)
+        inds = (slots - (storage.head - storage.size)) % storage.capacity
+        probs = self.tree[slots] / self.tree.total
+        weights = (len(storage) * probs) ** -beta
+        weights = Tensor(weights / weights.max())
+        if to_gpu:
+            weights = weights.cuda()
+        return self._get(inds, to_gpu=to_gpu, norm_rews=norm_rews), weights, slots
+
+    def load(self, folder_path):
+        super(PrioritizedReplayBuffer, self).load(folder_path)
+        # priorities are not saved, loaded transitions start at the highest one
+        self.tree = SumTree(self.max_steps)
+        self.tree.update(self.storage.positions(np.arange(len(self))),
+                         self.max_priority ** self.alpha)
+
+    def update_priorities(self, slots, td_errors):
+        """
+        Inputs:
+            slots (np.ndarray): Storage slots returned by sample
+            td_errors (np.ndarray): Absolute TD errors of the sampled
+                                    transitions (as returned by the MADDPG
+                                    updates)
+        """
+        priorities = td_errors + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        live = self.tree[slots] > 0  # not dropped since they were sampled
+        self.tree.update(slots[live], priorities[live] ** self.alpha)
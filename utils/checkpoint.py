@@ -0,0 +1,107 @@
+import os
+import queue
+import shutil
+import threading
+
+
+def atomic_write(path, write_fn):
+    """
+    Write a file through write_fn(tmp_path) into a temporary file next to
+    path and rename it into place, so that path always holds either the old
+    or the complete new contents
+    """
+    path = os.fspath(path)
+    root, ext = os.path.splitext(path)
+    tmp_path = '%s.tmp%i%s' % (root, os.getpid(), ext)  # keeps the extension
+    try:
+        write_fn(tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_link(src, dst):
+    """
+    Atomically make dst a hard link to src (a copy where hard links are not
+    supported)
+    """
+    src, dst = os.fspath(src), os.fspath(dst)
+    tmp_path = '%s.tmp%i' % (dst, os.getpid())
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def save_file(path, write_fn, links=()):
+    """
+    atomic_write path, then atomically point each of links to it
+    """
+    atomic_write(path, write_fn)
+    for link in links:
+        atomic_link(path, link)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread so that serialization and disk
+    I/O do not stall training. Callers snapshot the state to save in memory
+    (so that training may go on modifying it) and submit a function writing
+    the snapshot. At most max_pending writes are queued; submit blocks
+    beyond that. An error of a write is raised by the next submit, wait or
+    close.
+    """
+    def __init__(self, max_pending=2):
+        """
+        Inputs:
+            max_pending (int): Maximum number of queued writes
+        """
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) in the background
+        """
+        self._raise()
+        self.queue.put((fn, args))
+
+    def wait(self):
+        """
+        Block until all submitted writes are done
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        """
+        Finish the submitted writes and stop the thread
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
@@ -0,0 +1,66 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from .misc import init_processes
+
+
+def _worker(local_rank, fn, n_procs, node_rank, world_size, master_addr, master_port, args):
+    rank = node_rank * n_procs + local_rank
+    init_processes(rank, world_size, lambda rank, size: fn(rank, size, *args),
+                   master_addr=master_addr, master_port=master_port)
+
+
+def launch(fn, n_procs, nnodes=1, node_rank=0, master_addr='127.0.0.1',
+           master_port=29500, args=()):
+    """
+    Start n_procs processes on this node, each calling fn(rank, world_size,
+    *args) inside a gloo process group spanning nnodes nodes (the same
+    command is run on every node with its own node_rank; node 0 hosts the
+    rendezvous at master_addr:master_port). Returns when all local processes
+    are done.
+    """
+    mp.spawn(_worker, args=(fn, n_procs, node_rank, nnodes * n_procs, master_addr,
+                            master_port, args),
+             nprocs=n_procs, join=True)
+
+
+def broadcast_params(maddpg, src=0):
+    """
+    Give the networks of all processes the parameters of process src, so
+    that data-parallel learners start (and, with averaged gradients, stay)
+    identical
+    """
+    for agent in maddpg.agents:
+        for net in (agent.policy, agent.critic, agent.target_policy, agent.target_critic):
+            for param in net.parameters():
+                dist.broadcast(param.data, src)
+
+
+class LockstepUpdates(object):
+    """
+    Lets data-parallel learners agree on the number of update rounds after
+    each collected batch, since every round all-reduces gradients and must
+    be run by all processes. The processes may yield different numbers of
+    batches per episode (dropped transitions after a worker restart,
+    first-ready collection), so each process calls agree() once per batch
+    and finish() at the end of the episode; finish() keeps answering the
+    others' agreements (with no updates) until every process is done.
+    """
+    def agree(self, wanted):
+        """
+        Inputs:
+            wanted (int): Update rounds this process would run now
+        Outputs:
+            rounds (int): Update rounds to run (the minimum over processes)
+        """
+        # [rounds, -collecting], reduced with MIN
+        msg = torch.tensor([wanted, -1], dtype=torch.long)
+        dist.all_reduce(msg, op=dist.ReduceOp.MIN)
+        return int(msg[0])
+
+    def finish(self):
+        while True:
+            msg = torch.tensor([0, 0], dtype=torch.long)
+            dist.all_reduce(msg, op=dist.ReduceOp.MIN)
+            if msg[1] == 0:
+                return
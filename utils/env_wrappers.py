@@ -1,5 +1,10 @@
 import multiprocessing as mp
+import os
+import signal
+import threading
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, List, Optional, Sequence, Tuple, Type, Union
 
 import gym
@@ -16,6 +21,17 @@ from stable_baselines3.common.vec_env.base_vec_env import (
 from stable_baselines3.common.vec_env.util import copy_obs_dict, dict_to_obs, obs_space_info
 
 
+def _descendants(pid: int) -> List[int]:
+    """Pids of all processes below ``pid`` (from /proc; empty where that is not available)."""
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [pid for child in children for pid in _descendants(child)]
+
 
 def _worker(
     remote: mp.connection.Connection, parent_remote: mp.connection.Connection, env_fn_wrapper: CloudpickleWrapper
@@ -63,6 +79,84 @@ def _worker(
             break
 
 
+def _multi_worker(
+    remote: mp.connection.Connection, parent_remote: mp.connection.Connection, env_fn_wrappers: List[CloudpickleWrapper]
+) -> None:
+    """
+    Worker hosting several environments. Steps and resets run in one thread per
+    environment: each thread mostly waits on the socket of its own SUMO server,
+    so the servers simulate concurrently while this process handles the results.
+    Step results are sent back per environment as soon as they are available,
+    tagged with the slot of the environment in this worker.
+    """
+    # Import here to avoid a circular import
+    from stable_baselines3.common.env_util import is_wrapped
+
+    parent_remote.close()
+    envs = [env_fn_wrapper.var() for env_fn_wrapper in env_fn_wrappers]
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            remote.send(message)
+
+    def step(slot, action):
+        env = envs[slot]
+        try:
+            observation, reward, done, info = env.step(action)
+            if all(done):
+                # save final observation where user can get it, then reset
+                info["terminal_observation"] = observation
+                observation = env.reset()
+        except Exception as exc:
+            send(("error", slot, repr(exc)))
+            return
+        send(("step", slot, (observation, reward, done, info)))
+
+    with ThreadPoolExecutor(max_workers=len(envs)) as executor:
+        while True:
+            try:
+                cmd, data = remote.recv()
+                if cmd == "step":
+                    for slot, action in data:
+                        executor.submit(step, slot, action)
+                elif cmd == "seed":
+                    send(("reply", [envs[slot].seed(seed) for slot, seed in data]))
+                elif cmd == "reset":
+                    send(("reply", list(executor.map(lambda slot: envs[slot].reset(), data))))
+                elif cmd == "render":
+                    slots, mode = data
+                    send(("reply", [envs[slot].render(mode) for slot in slots]))
+                elif cmd == "close":
+                    executor.shutdown(wait=True)
+                    for env in envs:
+                        env.close()
+                    remote.close()
+                    break
+                elif cmd == "get_spaces":
+                    send(("reply", (envs[0].observation_space, envs[0].action_space)))
+                elif cmd == "env_method":
+                    slots, method_name, method_args, method_kwargs = data
+                    send(("reply", [getattr(envs[slot], method_name)(*method_args, **method_kwargs) for slot in slots]))
+                elif cmd == "get_attr":
+                    slots, attr_name = data
+                    send(("reply", [getattr(envs[slot], attr_name) for slot in slots]))
+                elif cmd == "set_attr":
+                    slots, attr_name, value = data
+                    send(("reply", [setattr(envs[slot], attr_name, value) for slot in slots]))
+                elif cmd == "is_wrapped":
+                    slots, wrapper_class = data
+                    send(("reply", [is_wrapped(envs[slot], wrapper_class) for slot in slots]))
+                else:
+                    raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+            except EOFError:
+                break
+
+
+class _WorkerFailure(Exception):
+    """Raised when a supervised worker died or did not answer in time."""
+
+
 class SubprocVecEnv(VecEnv):
     """
     Creates a multiprocess vectorized wrapper for multiple environments, distributing each environment to its own
@@ -71,6 +165,12 @@ class SubprocVecEnv(VecEnv):
     For performance reasons, if your environment is not IO bound, the number of environments should not exceed the
     number of logical cores on your CPU.
 
+    With ``auto_restart=True`` the workers are supervised: a worker that died (e.g. SUMO crashed and took the
+    env down) or that did not answer a command within ``timeout`` seconds is killed and respawned from the same
+    env function, i.e. with the same seed stream. A step interrupted this way returns the observation of the
+    reset of the new env, zero rewards and ``info["worker_restarted"] = True``, so the partial transition can be
+    discarded by the caller. Restarts are counted per env in ``restart_counts``.
+
     .. warning::
 
         Only 'forkserver' and 'spawn' start methods are thread-safe,
@@ -85,12 +185,31 @@ class SubprocVecEnv(VecEnv):
     :param start_method: method used to start the subprocesses.
            Must be one of the methods returned by multiprocessing.get_all_start_methods().
            Defaults to 'forkserver' on available platforms, and 'spawn' otherwise.
+    :param auto_restart: respawn dead or hung workers instead of failing
+    :param timeout: seconds a supervised worker may take to answer a command (None: wait forever).
+        The first answer after a (re)start is not timed, as it includes building the env.
+    :param max_restarts: number of restarts allowed per env before giving up
     """
 
-    def __init__(self, env_fns: List[Callable[[], gym.Env]], start_method: Optional[str] = None):
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        start_method: Optional[str] = None,
+        auto_restart: bool = False,
+        timeout: Optional[float] = None,
+        max_restarts: int = 10,
+    ):
         self.waiting = False
+        self.pending = set()  # indices of the envs with a step in flight
         self.closed = False
+        self.auto_restart = auto_restart
+        self.timeout = timeout
+        self.max_restarts = max_restarts
         n_envs = len(env_fns)
+        self.restart_counts = [0] * n_envs
+        self._sent_at = [0.0] * n_envs
+        self._booting = set()  # workers that have not answered since they were started
+        self._step_shapes = {}  # env index -> shapes of the rewards and dones of its last step
 
         if start_method is None:
             # Fork is not a thread safe method (see issue #217)
@@ -98,53 +217,434 @@ class SubprocVecEnv(VecEnv):
             # a `if __name__ == "__main__":`)
             forkserver_available = "forkserver" in mp.get_all_start_methods()
             start_method = "forkserver" if forkserver_available else "spawn"
+        self._ctx = mp.get_context(start_method)
+
+        self.env_fns = [CloudpickleWrapper(env_fn) for env_fn in env_fns]
+        self.remotes = [None] * n_envs
+        self.processes = [None] * n_envs
+        for env_idx in range(n_envs):
+            self._start_worker(env_idx)
+
+        observation_space, action_space = self._request(0, "get_spaces", None)
+        VecEnv.__init__(self, len(env_fns), observation_space, action_space)
+
+    def _start_worker(self, env_idx: int) -> None:
+        remote, work_remote = self._ctx.Pipe()
+        args = (work_remote, remote, self.env_fns[env_idx])
+        # daemon=True: if the main process crashes, we should not cause things to hang
+        process = self._ctx.Process(target=_worker, args=args, daemon=True)  # pytype:disable=attribute-error
+        process.start()
+        work_remote.close()
+        self.remotes[env_idx] = remote
+        self.processes[env_idx] = process
+        self._booting.add(env_idx)
+
+    def _restart(self, env_idx: int) -> None:
+        """Kill the worker of an env and start a fresh one from the same env function."""
+        if self.restart_counts[env_idx] >= self.max_restarts:
+            raise RuntimeError(f"Environment {env_idx} failed after {self.max_restarts} restarts")
+        process = self.processes[env_idx]
+        # e.g. the SUMO server started by traci, which would otherwise keep running (and its port)
+        children = _descendants(process.pid)
+        process.terminate()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.remotes[env_idx].close()
+        self.pending.discard(env_idx)
+        self.restart_counts[env_idx] += 1
+        self._start_worker(env_idx)
+
+    def _send(self, env_idx: int, cmd: str, data: Any) -> None:
+        self._sent_at[env_idx] = time.monotonic()
+        try:
+            self.remotes[env_idx].send((cmd, data))
+        except (BrokenPipeError, ConnectionResetError):
+            if not self.auto_restart:
+                raise
+            # the worker is dead; reported by the next _recv
+
+    def _recv(self, env_idx: int) -> Any:
+        remote = self.remotes[env_idx]
+        if not self.auto_restart:
+            return remote.recv()
+        remaining = None
+        if self.timeout is not None and env_idx not in self._booting:
+            remaining = max(0.0, self.timeout - (time.monotonic() - self._sent_at[env_idx]))
+        try:
+            if remote.poll(remaining):
+                answer = remote.recv()
+                self._booting.discard(env_idx)
+                return answer
+        except (EOFError, ConnectionResetError, BrokenPipeError):
+            pass
+        raise _WorkerFailure(env_idx)
+
+    def _request(self, env_idx: int, cmd: str, data: Any) -> Any:
+        """Send a command and wait for its answer, restarting the worker once if needed."""
+        self._send(env_idx, cmd, data)
+        try:
+            return self._recv(env_idx)
+        except _WorkerFailure:
+            self._restart(env_idx)
+        self._send(env_idx, cmd, data)
+        try:
+            return self._recv(env_idx)
+        except _WorkerFailure:
+            raise RuntimeError(f"Environment {env_idx} failed again right after a restart")
+
+    def _recv_or_retry(self, env_idx: int, cmd: str, data: Any) -> Any:
+        """Collect the answer to a command that was already sent, re-issuing it on a fresh worker on failure."""
+        try:
+            return self._recv(env_idx)
+        except _WorkerFailure:
+            self._restart(env_idx)
+            return self._request(env_idx, cmd, data)
+
+    def add_envs(self, env_fns: List[Callable[[], gym.Env]]) -> None:
+        """
+        Grow the pool with new workers, appended after the existing environments.
+        Only allowed while no step is in flight.
+
+        :param env_fns: Environments to run in the new subprocesses
+        """
+        assert not self.pending, "cannot resize the pool while envs are stepping"
+        for env_fn in env_fns:
+            env_idx = self.num_envs
+            self.env_fns.append(CloudpickleWrapper(env_fn))
+            self.remotes.append(None)
+            self.processes.append(None)
+            self.restart_counts.append(0)
+            self._sent_at.append(0.0)
+            self._start_worker(env_idx)
+            self.num_envs += 1
+
+    def remove_envs(self, n_envs: int) -> None:
+        """
+        Shrink the pool by closing the last ``n_envs`` workers.
+        Only allowed while no step is in flight.
+        """
+        assert not self.pending, "cannot resize the pool while envs are stepping"
+        assert 0 <= n_envs < self.num_envs, "at least one environment must remain"
+        for _ in range(n_envs):
+            env_idx = self.num_envs - 1
+            self._send(env_idx, "close", None)
+            self.processes[env_idx].join()
+            for buf in (self.env_fns, self.remotes, self.processes, self.restart_counts, self._sent_at):
+                buf.pop()
+            self._booting.discard(env_idx)
+            self._step_shapes.pop(env_idx, None)
+            self.num_envs -= 1
+
+    def step_async(self, actions: np.ndarray, indices: VecEnvIndices = None) -> None:
+        """
+        Send actions to the workers without waiting for the results.
+
+        :param actions: one action per target environment, in the order of ``indices``
+        :param indices: environments to step; all of them by default. Only the
+            targeted workers are busy afterwards, so disjoint subsets of the pool
+            can be in flight at the same time (see ``utils.rollout``).
+        """
+        indices = self._get_indices(indices)
+        for env_idx, action in zip(indices, actions):
+            if env_idx in self.pending:
+                raise RuntimeError(f"Environment {env_idx} is already stepping")
+            self._send(env_idx, "step", action)
+            self.pending.add(env_idx)
+        self.waiting = True
+
+    def step_wait(self, indices: VecEnvIndices = None) -> VecEnvStepReturn:
+        """
+        Wait for the results of a previous ``step_async`` call.
+
+        :param indices: environments to collect; all of them by default.
+            Must match (a subset of) the indices passed to ``step_async``.
+        """
+        indices = self._get_indices(indices)
+        results = []
+        for env_idx in indices:
+            try:
+                result = self._recv(env_idx)
+                self._step_shapes[env_idx] = (np.shape(result[1]), np.shape(result[2]))
+                results.append(result)
+            except _WorkerFailure:
+                results.append(self._restarted_step(env_idx))
+        self.pending.difference_update(indices)
+        self.waiting = len(self.pending) > 0
+        obs, rews, dones, infos = zip(*results)
+        return _flatten_obs(obs, self.observation_space), np.stack(rews), np.stack(dones), infos
+
+    def _restarted_step(self, env_idx: int) -> Tuple[Any, np.ndarray, np.ndarray, dict]:
+        """Replace the result of a step lost with its worker by a flagged, empty transition."""
+        self._restart(env_idx)
+        observation = self._request(env_idx, "reset", None)
+        if env_idx in self._step_shapes:
+            # shaped like the env's real steps
+            rew_shape, done_shape = self._step_shapes[env_idx]
+        else:
+            n_agents = len(self.observation_space.spaces) if isinstance(self.observation_space, spaces.Dict) else 1
+            rew_shape = done_shape = (n_agents,)
+        return observation, np.zeros(rew_shape), np.zeros(done_shape, dtype=bool), {"worker_restarted": True}
+
+    def step_wait_any(
+        self, k: int = 1, timeout: Optional[float] = None
+    ) -> Tuple[np.ndarray, VecEnvObs, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        """
+        Wait until at least ``k`` of the pending environments have finished
+        their step, and return the results of every environment that is done
+        by then. The other environments keep stepping, so the caller can send
+        new actions to the returned ones only (``step_async(..., indices=env_ids)``)
+        and throughput follows the average step time rather than the slowest worker.
+
+        :param k: minimum number of results to wait for (capped to the number of pending envs)
+        :param timeout: give up waiting after this many seconds; fewer than ``k``
+            (possibly zero) results are returned in that case
+        :return: env_ids, observations, rewards, dones and infos of the finished environments
+        """
+        waiting = sorted(self.pending)
+        k = min(k, len(waiting))
+        supervised = self.auto_restart and self.timeout is not None
+        ready = []
+        while len(ready) < k:
+            remaining = [env_idx for env_idx in waiting if env_idx not in ready]
+            wait_for = timeout
+            timed = [env_idx for env_idx in remaining if env_idx not in self._booting]
+            if supervised and timed:
+                # also wake up when the oldest pending command times out
+                deadline = min(self._sent_at[env_idx] for env_idx in timed) + self.timeout
+                until_deadline = max(0.0, deadline - time.monotonic())
+                wait_for = until_deadline if timeout is None else min(timeout, until_deadline)
+            conns = mp.connection.wait([self.remotes[env_idx] for env_idx in remaining], wait_for)
+            done = [env_idx for env_idx in remaining if self.remotes[env_idx] in conns]
+            if not done and supervised:
+                # hung workers count as done: step_wait restarts them and flags their transition
+                now = time.monotonic()
+                done = [env_idx for env_idx in timed if now - self._sent_at[env_idx] >= self.timeout]
+            if not done:
+                break
+            ready.extend(done)
+        env_ids = np.array(sorted(ready), dtype=int)
+        if len(env_ids) == 0:
+            return env_ids, None, None, None, ()
+        obs, rews, dones, infos = self.step_wait(indices=env_ids)
+        return env_ids, obs, rews, dones, infos
+
+    def seed(self, seed: Optional[int] = None) -> List[Union[None, int]]:
+        if seed is None:
+            seed = np.random.randint(0, 2**32 - 1)
+        return self._broadcast(range(self.num_envs), "seed", [seed + idx for idx in range(self.num_envs)])
+
+    def reset(self) -> VecEnvObs:
+        obs = self._broadcast(range(self.num_envs), "reset", [None] * self.num_envs)
+        return _flatten_obs(obs, self.observation_space)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.waiting:
+            for env_idx in self.pending:
+                try:
+                    self._recv(env_idx)
+                except _WorkerFailure:
+                    pass
+            self.pending.clear()
+        for env_idx in range(len(self.remotes)):
+            self._send(env_idx, "close", None)
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def get_images(self) -> Sequence[np.ndarray]:
+        # gather images from subprocesses
+        # `mode` will be taken into account later
+        return self._broadcast(range(self.num_envs), "render", ["rgb_array"] * self.num_envs)
+
+    def get_attr(self, attr_name: str, indices: VecEnvIndices = None) -> List[Any]:
+        """Return attribute from vectorized environment (see base class)."""
+        indices = self._get_indices(indices)
+        return self._broadcast(indices, "get_attr", [attr_name] * len(indices))
+
+    def set_attr(self, attr_name: str, value: Any, indices: VecEnvIndices = None) -> None:
+        """Set attribute inside vectorized environments (see base class)."""
+        indices = self._get_indices(indices)
+        self._broadcast(indices, "set_attr", [(attr_name, value)] * len(indices))
+
+    def env_method(self, method_name: str, *method_args, indices: VecEnvIndices = None, **method_kwargs) -> List[Any]:
+        """Call instance methods of vectorized environments."""
+        indices = self._get_indices(indices)
+        return self._broadcast(indices, "env_method", [(method_name, method_args, method_kwargs)] * len(indices))
+
+    def env_is_wrapped(self, wrapper_class: Type[gym.Wrapper], indices: VecEnvIndices = None) -> List[bool]:
+        """Check if worker environments are wrapped with a given wrapper"""
+        indices = self._get_indices(indices)
+        return self._broadcast(indices, "is_wrapped", [wrapper_class] * len(indices))
+
+    def _broadcast(self, indices: Sequence[int], cmd: str, data: Sequence[Any]) -> List[Any]:
+        """Send a command to several workers, then collect the answers in order."""
+        for env_idx, env_data in zip(indices, data):
+            self._send(env_idx, cmd, env_data)
+        return [self._recv_or_retry(env_idx, cmd, env_data) for env_idx, env_data in zip(indices, data)]
+
+
+class HybridVecEnv(VecEnv):
+    """
+    Multiprocess vectorized wrapper hosting several environments per process
+    (N workers x M envs). Each worker drives its environments from one thread
+    each, so for SUMO every worker keeps M TraCI connections busy while paying
+    for a single Python interpreter (numpy, scipy, sumolib, gym, ...).
+    The environments must be able to share a process, e.g. ``SUMOEnv`` created
+    with a unique ``label``.
+
+    Exposes the same stepping interface as ``SubprocVecEnv`` (``step_async`` /
+    ``step_wait`` with indices, ``step_wait_any``), so it can be used with the
+    collectors of ``utils.rollout``. Environment ``i`` lives in worker
+    ``i // envs_per_worker``.
+
+    :param env_fns: Environments to run in subprocesses
+    :param envs_per_worker: number of environments hosted by each process
+    :param start_method: method used to start the subprocesses (see ``SubprocVecEnv``)
+    """
+
+    def __init__(
+        self, env_fns: List[Callable[[], gym.Env]], envs_per_worker: int = 2, start_method: Optional[str] = None
+    ):
+        self.waiting = False
+        self.closed = False
+        self.pending = set()  # indices of the envs with a step in flight
+        self.envs_per_worker = envs_per_worker
+        self._results = {}  # step results received but not collected yet, by env index
+
+        if start_method is None:
+            forkserver_available = "forkserver" in mp.get_all_start_methods()
+            start_method = "forkserver" if forkserver_available else "spawn"
         ctx = mp.get_context(start_method)
 
-        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(n_envs)])
+        groups = [env_fns[i : i + envs_per_worker] for i in range(0, len(env_fns), envs_per_worker)]
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(len(groups))])
         self.processes = []
-        for work_remote, remote, env_fn in zip(self.work_remotes, self.remotes, env_fns):
-            args = (work_remote, remote, CloudpickleWrapper(env_fn))
+        for work_remote, remote, group in zip(self.work_remotes, self.remotes, groups):
+            args = (work_remote, remote, [CloudpickleWrapper(env_fn) for env_fn in group])
             # daemon=True: if the main process crashes, we should not cause things to hang
-            process = ctx.Process(target=_worker, args=args, daemon=True)  # pytype:disable=attribute-error
+            process = ctx.Process(target=_multi_worker, args=args, daemon=True)  # pytype:disable=attribute-error
             process.start()
             self.processes.append(process)
             work_remote.close()
 
-        self.remotes[0].send(("get_spaces", None))
-        observation_space, action_space = self.remotes[0].recv()
+        observation_space, action_space = self._call(0, "get_spaces", None)
         VecEnv.__init__(self, len(env_fns), observation_space, action_space)
 
-    def step_async(self, actions: np.ndarray) -> None:
-        for remote, action in zip(self.remotes, actions):
-            remote.send(("step", action))
+    def _locate(self, env_idx: int) -> Tuple[int, int]:
+        return env_idx // self.envs_per_worker, env_idx % self.envs_per_worker
+
+    def _group(self, indices: VecEnvIndices) -> "OrderedDict[int, List[int]]":
+        """Group env indices by worker, keeping their order: {worker: [env_idx, ...]}"""
+        groups = OrderedDict()
+        for env_idx in self._get_indices(indices):
+            groups.setdefault(self._locate(env_idx)[0], []).append(env_idx)
+        return groups
+
+    def _recv(self, worker: int) -> Tuple[bool, Any]:
+        """
+        Read one message from a worker. Step results are stored until collected
+        by ``step_wait``.
+
+        :return: whether the message was the reply to a command, and its payload
+        """
+        message = self.remotes[worker].recv()
+        if message[0] == "reply":
+            return True, message[1]
+        _, slot, result = message
+        env_idx = worker * self.envs_per_worker + slot
+        if message[0] == "error":
+            raise RuntimeError(f"Environment {env_idx} failed: {result}")
+        self._results[env_idx] = result
+        return False, None
+
+    def _wait_reply(self, worker: int) -> Any:
+        # step results of other envs of this worker may arrive first
+        while True:
+            is_reply, payload = self._recv(worker)
+            if is_reply:
+                return payload
+
+    def _call(self, worker: int, cmd: str, data: Any) -> Any:
+        self.remotes[worker].send((cmd, data))
+        return self._wait_reply(worker)
+
+    def step_async(self, actions: np.ndarray, indices: VecEnvIndices = None) -> None:
+        indices = self._get_indices(indices)
+        commands = OrderedDict()
+        for env_idx, action in zip(indices, actions):
+            if env_idx in self.pending:
+                raise RuntimeError(f"Environment {env_idx} is already stepping")
+            worker, slot = self._locate(env_idx)
+            commands.setdefault(worker, []).append((slot, action))
+            self.pending.add(env_idx)
+        for worker, data in commands.items():
+            self.remotes[worker].send(("step", data))
         self.waiting = True
 
-    def step_wait(self) -> VecEnvStepReturn:
-        results = [remote.recv() for remote in self.remotes]
-        self.waiting = False
+    def step_wait(self, indices: VecEnvIndices = None) -> VecEnvStepReturn:
+        indices = self._get_indices(indices)
+        for env_idx in indices:
+            while env_idx not in self._results:
+                self._recv(self._locate(env_idx)[0])
+        results = [self._results.pop(env_idx) for env_idx in indices]
+        self.pending.difference_update(indices)
+        self.waiting = len(self.pending) > 0
         obs, rews, dones, infos = zip(*results)
         return _flatten_obs(obs, self.observation_space), np.stack(rews), np.stack(dones), infos
 
+    def step_wait_any(
+        self, k: int = 1, timeout: Optional[float] = None
+    ) -> Tuple[np.ndarray, VecEnvObs, np.ndarray, np.ndarray, Tuple[dict, ...]]:
+        """
+        Same as ``SubprocVecEnv.step_wait_any``, at the granularity of single
+        environments rather than workers.
+        """
+        k = min(k, len(self.pending))
+        while len(self.pending.intersection(self._results)) < k:
+            busy = {self._locate(env_idx)[0] for env_idx in self.pending.difference(self._results)}
+            conns = mp.connection.wait([self.remotes[worker] for worker in sorted(busy)], timeout)
+            if not conns:
+                break
+            for remote in conns:
+                self._recv(self.remotes.index(remote))
+        env_ids = np.array(sorted(self.pending.intersection(self._results)), dtype=int)
+        if len(env_ids) == 0:
+            return env_ids, None, None, None, ()
+        obs, rews, dones, infos = self.step_wait(indices=env_ids)
+        return env_ids, obs, rews, dones, infos
+
     def seed(self, seed: Optional[int] = None) -> List[Union[None, int]]:
         if seed is None:
             seed = np.random.randint(0, 2**32 - 1)
-        for idx, remote in enumerate(self.remotes):
-            remote.send(("seed", seed + idx))
-        return [remote.recv() for remote in self.remotes]
+        seeds = []
+        for worker, env_ids in self._group(None).items():
+            data = [(self._locate(env_idx)[1], seed + env_idx) for env_idx in env_ids]
+            seeds += self._call(worker, "seed", data)
+        return seeds
 
     def reset(self) -> VecEnvObs:
-        for remote in self.remotes:
-            remote.send(("reset", None))
-        obs = [remote.recv() for remote in self.remotes]
-
+        groups = self._group(None)
+        for worker, env_ids in groups.items():
+            self.remotes[worker].send(("reset", [self._locate(env_idx)[1] for env_idx in env_ids]))
+        obs = []
+        for worker in groups:
+            obs += self._wait_reply(worker)
         return _flatten_obs(obs, self.observation_space)
 
     def close(self) -> None:
         if self.closed:
             return
         if self.waiting:
-            for remote in self.remotes:
-                remote.recv()
+            self.step_wait(indices=sorted(self.pending))
         for remote in self.remotes:
             remote.send(("close", None))
         for process in self.processes:
@@ -152,52 +652,32 @@ class SubprocVecEnv(VecEnv):
         self.closed = True
 
     def get_images(self) -> Sequence[np.ndarray]:
-        for pipe in self.remotes:
-            # gather images from subprocesses
-            # `mode` will be taken into account later
-            pipe.send(("render", "rgb_array"))
-        imgs = [pipe.recv() for pipe in self.remotes]
-        return imgs
+        return self._gather("render", ("rgb_array",), None)
 
     def get_attr(self, attr_name: str, indices: VecEnvIndices = None) -> List[Any]:
         """Return attribute from vectorized environment (see base class)."""
-        target_remotes = self._get_target_remotes(indices)
-        for remote in target_remotes:
-            remote.send(("get_attr", attr_name))
-        return [remote.recv() for remote in target_remotes]
+        return self._gather("get_attr", (attr_name,), indices)
 
     def set_attr(self, attr_name: str, value: Any, indices: VecEnvIndices = None) -> None:
         """Set attribute inside vectorized environments (see base class)."""
-        target_remotes = self._get_target_remotes(indices)
-        for remote in target_remotes:
-            remote.send(("set_attr", (attr_name, value)))
-        for remote in target_remotes:
-            remote.recv()
+        self._gather("set_attr", (attr_name, value), indices)
 
     def env_method(self, method_name: str, *method_args, indices: VecEnvIndices = None, **method_kwargs) -> List[Any]:
         """Call instance methods of vectorized environments."""
-        target_remotes = self._get_target_remotes(indices)
-        for remote in target_remotes:
-            remote.send(("env_method", (method_name, method_args, method_kwargs)))
-        return [remote.recv() for remote in target_remotes]
+        return self._gather("env_method", (method_name, method_args, method_kwargs), indices)
 
     def env_is_wrapped(self, wrapper_class: Type[gym.Wrapper], indices: VecEnvIndices = None) -> List[bool]:
         """Check if worker environments are wrapped with a given wrapper"""
-        target_remotes = self._get_target_remotes(indices)
-        for remote in target_remotes:
-            remote.send(("is_wrapped", wrapper_class))
-        return [remote.recv() for remote in target_remotes]
+        return self._gather("is_wrapped", (wrapper_class,), indices)
 
-    def _get_target_remotes(self, indices: VecEnvIndices) -> List[Any]:
-        """
-        Get the connection object needed to communicate with the wanted
-        envs that are in subprocesses.
-
-        :param indices: refers to indices of envs.
-        :return: Connection object to communicate between processes.
-        """
+    def _gather(self, cmd: str, args: Tuple, indices: VecEnvIndices) -> List[Any]:
+        """Run a synchronous command on the target environments, worker by worker"""
         indices = self._get_indices(indices)
-        return [self.remotes[i] for i in indices]
+        results = {}
+        for worker, env_ids in self._group(indices).items():
+            slots = [self._locate(env_idx)[1] for env_idx in env_ids]
+            results.update(zip(env_ids, self._call(worker, cmd, (slots,) + args)))
+        return [results[env_idx] for env_idx in indices]
 
 
 def _flatten_obs(obs: Union[List[VecEnvObs], Tuple[VecEnvObs]], space: spaces.Space) -> VecEnvObs:
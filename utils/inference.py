@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+from .networks import StackedMLPNetwork
+
+
+class PolicyEngine(object):
+    """
+    Grad-free action selection for rollouts: the policies of all agents are
+    evaluated for all envs in one batched forward pass of a
+    StackedMLPNetwork under torch.inference_mode, and exploration (Gumbel
+    noise or OU noise) and the decoding of the actions into env actions are
+    vectorized, instead of one autograd-tracked forward pass, Gumbel-softmax
+    sample and Python argmax per agent.
+
+    A fused MADDPG (see MADDPG.fuse) is evaluated through its own stacked
+    policy, an ensemble member through the one given by stacked_policy.
+    Otherwise the engine keeps a stacked copy of the policies and
+    refreshes it whenever their parameters were modified or moved (e.g. by an
+    optimizer step, load_params, AsyncLearner.sync or prep_rollouts). Writes
+    through p.data bypass the version counters the engine checks, so code
+    updating the policies in place must write through the parameters (under
+    torch.no_grad).
+    """
+    def __init__(self, maddpg, compile=None, stacked_policy=None):
+        """
+        Inputs:
+            maddpg (MADDPG): Learner whose policies choose the actions
+            compile (str): None, 'trace' (TorchScript trace of the stacked
+                           forward pass) or 'compile' (torch.compile)
+            stacked_policy (callable): If given, returns the stacked network
+                                       of maddpg's policies to act with (e.g.
+                                       MADDPGEnsemble.member_policy), used
+                                       instead of a copy
+        """
+        if compile not in (None, 'trace', 'compile'):
+            raise ValueError("Unknown compile mode: %s" % compile)
+        self.maddpg = maddpg
+        self.compile = compile
+        self.discrete_action = maddpg.discrete_action
+        self.out_dims = [pi.fc3.out_features for pi in maddpg.policies]
+        self.stacked_policy = stacked_policy
+        self._copy = None
+        if not maddpg.fused and stacked_policy is None:
+            self._copy = StackedMLPNetwork(maddpg.policies, link=False)
+        self._versions = None
+        self._compiled = (None, None)  # (stacked network, compiled forward)
+
+    @property
+    def stacked(self):
+        if self.maddpg.fused:
+            return self.maddpg.stacked_policy
+        if self.stacked_policy is not None:
+            return self.stacked_policy()
+        versions = [(p.data_ptr(), p._version)
+                    for pi in self.maddpg.policies for p in pi.parameters()]
+        if versions != self._versions:
+            self._copy.load(self.maddpg.policies)
+            self._versions = versions
+        return self._copy
+
+    def _forward(self, net, X):
+        if self.compile is None:
+            return net(X)
+        if self._compiled[0] is not net:
+            # the compiled function shares the parameters of net, recompiled
+            # only when net itself is replaced (e.g. moved to another device)
+            if self.compile == 'trace':
+                forward = torch.jit.trace(net, X)
+            else:
+                forward = torch.compile(net)
+            self._compiled = (net, forward)
+        return self._compiled[1](X)
+
+    def act(self, observations, explore=False):
+        """
+        Inputs:
+            observations (list of np.ndarray): Per-agent observation batches,
+                                               one row per env
+            explore (bool): Whether or not to add exploration noise
+        Outputs:
+            agent_actions (list of np.ndarray): Per-agent action batches
+                                                (one-hot for discrete actions)
+            env_actions (list of lists): Per-env discrete actions for
+                                         env.step (argmax of each agent's action)
+        """
+        net = self.stacked
+        X = torch.from_numpy(np.concatenate(observations, axis=1).astype(np.float32, copy=False))
+        with torch.inference_mode(), self.maddpg.autocast(self.maddpg.pol_dev):
+            out = self._forward(net, net.gather_inputs(X))
+            if self.discrete_action:
+                if explore:
+                    # argmax of the Gumbel-perturbed logits, the hard sample
+                    # of gumbel_softmax
+                    U = torch.rand_like(out)
+                    out = out - torch.log(-torch.log(U + 1e-20) + 1e-20)
+            else:
+                if explore:
+                    noise = np.zeros((net.n, 1, out.shape[2]), dtype=np.float32)
+                    for a, agent in enumerate(self.maddpg.agents):
+                        noise[a, 0, :self.out_dims[a]] = agent.exploration.noise()
+                    out = out + torch.from_numpy(noise)
+                out = out.clamp(-1, 1)
+            choices = net.mask_logits(out).argmax(-1).numpy()  # (agents, envs)
+            out = out.numpy()
+        if self.discrete_action:
+            agent_actions = [np.eye(dim, dtype=np.float32)[choices[a]]
+                             for a, dim in enumerate(self.out_dims)]
+        else:
+            agent_actions = [out[a, :, :dim] for a, dim in enumerate(self.out_dims)]
+        return agent_actions, choices.T.tolist()
@@ -0,0 +1,202 @@
+import io
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from .buffer import PrioritizedReplayBuffer
+from .resources import pin_to_cores
+
+
+def _policy_params(maddpg):
+    return [p for pi in maddpg.policies for p in pi.parameters()]
+
+
+def _copy_params(params, flat, to_flat):
+    """
+    Copy parameters into (to_flat=True) or out of a flat tensor, in place
+    (through the parameters themselves rather than .data, so that their
+    version counters tell a PolicyEngine to refresh its copy)
+    """
+    offset = 0
+    with torch.no_grad():
+        for p in params:
+            n = p.numel()
+            if to_flat:
+                flat[offset:offset + n].copy_(p.reshape(-1))
+            else:
+                p.copy_(flat[offset:offset + n].view(p.shape))
+            offset += n
+
+
+def _dump_params(maddpg):
+    # serialized, as tensors sent through a pipe would only be shared with the
+    # (exiting) learner process
+    buf = io.BytesIO()
+    torch.save([a.get_params() for a in maddpg.agents], buf)
+    return buf.getvalue()
+
+
+def _load_params(maddpg, data):
+    for agent, params in zip(maddpg.agents, torch.load(io.BytesIO(data))):
+        agent.load_params(params)
+
+
+def _learner_loop(remote, maddpg, replay_buffer, weights, version, lock, batch_size,
+                  update_mode, publish_interval, max_update_ratio, n_threads, cores):
+    torch.set_num_threads(n_threads)
+    pin_to_cores(cores)
+    maddpg.prep_training(device='cpu')
+    rounds = 0
+    vf_losses, pol_losses = [], []
+    while True:
+        if remote.poll():
+            cmd = remote.recv()
+            if cmd == 'stats':
+                remote.send({'rounds': rounds,
+                             'vf_loss': np.mean(vf_losses) if vf_losses else np.nan,
+                             'pol_loss': np.mean(pol_losses) if pol_losses else np.nan})
+                vf_losses, pol_losses = [], []
+            elif cmd in ('params', 'close'):
+                remote.send(_dump_params(maddpg))
+                if cmd == 'close':
+                    break
+            continue
+        storage = replay_buffer.storage
+        if (len(replay_buffer) < batch_size or
+                (max_update_ratio > 0 and rounds >= max_update_ratio * storage.pushed)):
+            # wait for the collectors
+            time.sleep(0.01)
+            continue
+        if update_mode == 'per_agent':
+            for a_i in range(maddpg.nagents):
+                vf_loss, pol_loss = maddpg.update(replay_buffer.sample(batch_size), a_i)
+                vf_losses.append(vf_loss)
+                pol_losses.append(pol_loss)
+        else:
+            update = maddpg.update_fused if maddpg.fused else maddpg.update_round
+            vf_loss, pol_loss = update(replay_buffer.sample(batch_size))
+            vf_losses.extend(vf_loss)
+            pol_losses.extend(pol_loss)
+        maddpg.update_all_targets()
+        rounds += 1
+        if rounds % publish_interval == 0:
+            with lock:
+                _copy_params(_policy_params(maddpg), weights, to_flat=True)
+                version.value += 1
+    remote.close()
+
+
+class AsyncLearner(object):
+    """
+    Runs the MADDPG updates in a separate process, so that collection and
+    learning no longer wait for each other. The collectors keep pushing into
+    the replay buffer, whose memory-mapped storage the learner process
+    samples from, and the learner publishes its policy weights every
+    publish_interval update rounds into shared memory, from where sync()
+    copies them into the acting MADDPG instance.
+    """
+    def __init__(self, maddpg, replay_buffer, batch_size, update_mode='per_agent',
+                 publish_interval=10, max_update_ratio=0, n_threads=1, cores=None,
+                 start_method=None):
+        """
+        Inputs:
+            maddpg (MADDPG): Learner to train (a copy is moved to the learner
+                             process; this instance only acts)
+            replay_buffer (ReplayBuffer): Buffer created with a memmap_dir
+            batch_size (int): Batch size for model training
+            update_mode (str): 'per_agent', 'round' or 'fused' (see
+                               MADDPG.update, update_round, update_fused)
+            publish_interval (int): Update rounds between two weight updates
+                                    of the acting policies
+            max_update_ratio (float): If > 0, maximum number of update rounds
+                                      per pushed transition
+            n_threads (int): Torch threads of the learner process
+            cores (list of ints): Cores to pin the learner process to
+            start_method (str): multiprocessing start method (default:
+                                'forkserver' where available, else 'spawn')
+        """
+        if replay_buffer.storage.memmap_dir is None:
+            raise ValueError("The asynchronous learner needs a memory-mapped replay buffer")
+        if isinstance(replay_buffer, PrioritizedReplayBuffer):
+            raise ValueError("Prioritized replay is not supported with the asynchronous learner")
+        if start_method is None:
+            forkserver_available = "forkserver" in mp.get_all_start_methods()
+            start_method = "forkserver" if forkserver_available else "spawn"
+        ctx = mp.get_context(start_method)
+        # the collectors push while the learner process samples
+        replay_buffer.storage.lock = ctx.Lock()
+        params = _policy_params(maddpg)
+        self.weights = torch.zeros(sum(p.numel() for p in params)).share_memory_()
+        self.version = ctx.Value('l', 0)
+        self.lock = ctx.Lock()
+        self._synced_version = 0
+        self.remote, work_remote = ctx.Pipe()
+        args = (work_remote, maddpg, replay_buffer, self.weights, self.version, self.lock,
+                batch_size, update_mode, publish_interval, max_update_ratio, n_threads, cores)
+        self.process = ctx.Process(target=_learner_loop, args=args, daemon=True)
+        self.process.start()
+        work_remote.close()
+        self.closed = False
+
+    def _check(self):
+        if not self.process.is_alive():
+            raise RuntimeError("The learner process exited unexpectedly (exit code %s)"
+                               % self.process.exitcode)
+
+    def _request(self, cmd):
+        """
+        Send cmd to the learner process and return its answer
+        """
+        self._check()
+        try:
+            self.remote.send(cmd)
+            return self.remote.recv()
+        except (EOFError, BrokenPipeError):
+            # the learner died while answering
+            self.process.join(timeout=1)
+            self._check()
+            raise
+
+    def sync(self, maddpg):
+        """
+        Copy the latest published policies into maddpg, if there are new ones
+        Outputs:
+            updated (bool): Whether or not the policies changed
+        """
+        if self.version.value == self._synced_version:
+            self._check()
+            return False
+        with self.lock:
+            _copy_params(_policy_params(maddpg), self.weights, to_flat=False)
+            self._synced_version = self.version.value
+        return True
+
+    def stats(self):
+        """
+        Update rounds done so far and mean losses since the last call
+        """
+        return self._request('stats')
+
+    def pull(self, maddpg):
+        """
+        Load all parameters of the learner (critics, targets and optimizer
+        states included) into maddpg, e.g. before saving it
+        """
+        _load_params(maddpg, self._request('params'))
+
+    def close(self, maddpg=None):
+        """
+        Stop the learner process, loading its final parameters into maddpg
+        if given
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if not self.process.is_alive():
+            # crashed; nothing to load (the error is raised by sync or stats)
+            self.process.join()
+            return
+        data = self._request('close')
+        if maddpg is not None:
+            _load_params(maddpg, data)
+        self.process.join()
@@ -18,6 +18,33 @@ def soft_update(target, source, tau):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
 
+def flatten_params(params):
+    """
+    Move parameters into one contiguous buffer, of which they become views
+    Inputs:
+        params (iterable of torch.nn.Parameter): Parameters to flatten
+    Outputs:
+        flat (torch.Tensor): 1-D buffer holding all parameters
+    """
+    params = list(params)
+    flat = torch.cat([p.data.reshape(-1) for p in params])
+    offset = 0
+    for p in params:
+        p.data = flat[offset:offset + p.numel()].view(p.shape)
+        offset += p.numel()
+    return flat
+
+def soft_update_flat(target, source, tau):
+    """
+    soft_update for parameters flattened with flatten_params (in the same
+    order): one fused operation instead of one per parameter tensor
+    Inputs:
+        target (torch.Tensor): Flat buffer to move towards source
+        source (torch.Tensor): Flat buffer to copy from
+        tau (float, 0 < x < 1): Weight factor for update
+    """
+    target.lerp_(source, tau)
+
 # https://github.com/ikostrikov/pytorch-ddpg-naf/blob/master/ddpg.py#L15
 def hard_update(target, source):
     """
@@ -29,21 +56,43 @@ def hard_update(target, source):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
+def clone_to_cpu(obj):
+    """
+    Copy of a (nested dict/list/tuple of) tensors, e.g. state dicts, with all
+    tensors cloned to CPU, leaving the original where it is
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: clone_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_to_cpu(v) for v in obj)
+    return obj
+
 # https://github.com/seba-1511/dist_tuto.pth/blob/gh-pages/train_dist.py
 def average_gradients(model):
-    """ Gradient averaging. """
+    """ Gradient averaging (one all-reduce over all gradients of model). """
     size = float(dist.get_world_size())
-    for param in model.parameters():
-        dist.all_reduce(param.grad.data, op=dist.reduce_op.SUM, group=0)
-        param.grad.data /= size
+    grads = [param.grad.data for param in model.parameters() if param.grad is not None]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= size
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
 
 # https://github.com/seba-1511/dist_tuto.pth/blob/gh-pages/train_dist.py
-def init_processes(rank, size, fn, backend='gloo'):
+def init_processes(rank, size, fn, backend='gloo', master_addr='127.0.0.1',
+                   master_port=29500):
     """ Initialize the distributed environment. """
-    os.environ['MASTER_ADDR'] = '127.0.0.1'
-    os.environ['MASTER_PORT'] = '29500'
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
     dist.init_process_group(backend, rank=rank, world_size=size)
-    fn(rank, size)
+    try:
+        fn(rank, size)
+    finally:
+        dist.destroy_process_group()
 
 def onehot_from_logits(logits, eps=0.0):
     """
@@ -51,7 +100,7 @@ def onehot_from_logits(logits, eps=0.0):
     (based on given epsilon)
     """
     # get best (according to current policy) actions in one-hot form
-    argmax_acs = (logits == logits.max(1, keepdim=True)[0]).float()
+    argmax_acs = (logits == logits.max(-1, keepdim=True)[0]).float()
     if eps == 0.0:
         return argmax_acs
     # get random actions in one-hot form
@@ -71,7 +120,7 @@ def sample_gumbel(shape, eps=1e-20, tens_type=torch.FloatTensor):
 def gumbel_softmax_sample(logits, temperature):
     """ Draw a sample from the Gumbel-Softmax distribution"""
     y = logits + sample_gumbel(logits.shape, tens_type=type(logits.data))
-    return F.softmax(y / temperature, dim=1)
+    return F.softmax(y / temperature, dim=-1)
 
 # modified for PyTorch from https://github.com/ericjang/gumbel-softmax/blob/master/Categorical%20VAE.ipynb
 def gumbel_softmax(logits, temperature=1.0, hard=False):
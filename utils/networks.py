@@ -1,6 +1,12 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def identity(x):
+    # module-level (unlike a lambda) so that networks can be pickled, e.g. to
+    # send them to another process
+    return x
+
 class MLPNetwork(nn.Module):
     """
     MLP network (can be used as value or policy)
@@ -21,7 +27,7 @@ class MLPNetwork(nn.Module):
             self.in_fn.weight.data.fill_(1)
             self.in_fn.bias.data.fill_(0)
         else:
-            self.in_fn = lambda x: x
+            self.in_fn = identity
         self.fc1 = nn.Linear(input_dim, hidden_dim)
         self.fc2 = nn.Linear(hidden_dim, hidden_dim)
         self.fc3 = nn.Linear(hidden_dim, out_dim)
@@ -31,7 +37,7 @@ class MLPNetwork(nn.Module):
             self.fc3.weight.data.uniform_(-3e-3, 3e-3)
             self.out_fn = F.tanh
         else:  # logits for discrete action (will softmax later)
-            self.out_fn = lambda x: x
+            self.out_fn = identity
 
     def forward(self, X):
         """
@@ -43,4 +49,147 @@ class MLPNetwork(nn.Module):
         h1 = self.nonlin(self.fc1(self.in_fn(X)))
         h2 = self.nonlin(self.fc2(h1))
         out = self.out_fn(self.fc3(h2))
-        return out
\ No newline at end of file
+        # back to the input type if computed at lower precision (autocast)
+        return out.to(X.dtype)
+
+class StackedMLPNetwork(nn.Module):
+    """
+    The MLP networks of several agents evaluated together with batched matrix
+    products (one kernel per layer instead of one per agent and layer).
+    Inputs and outputs are zero-padded to the largest network; the original
+    networks' parameters become views of the stacked parameters, so they keep
+    working (and stay in sync) on their own.
+    """
+    def __init__(self, nets, link=True):
+        """
+        Inputs:
+            nets (list of MLPNetwork): Networks to stack (same hidden size,
+                                       nonlinearity and output function)
+            link (bool): Whether or not to make the parameters of nets views
+                         of the stacked parameters (otherwise the stacked
+                         network is a copy, see load)
+        """
+        super(StackedMLPNetwork, self).__init__()
+        self.n = len(nets)
+        self.in_dims = [net.fc1.in_features for net in nets]
+        self.out_dims = [net.fc3.out_features for net in nets]
+        in_max, out_max = max(self.in_dims), max(self.out_dims)
+        hidden_dim = nets[0].fc1.out_features
+        self.W1 = nn.Parameter(torch.zeros(self.n, hidden_dim, in_max))
+        self.b1 = nn.Parameter(torch.zeros(self.n, hidden_dim))
+        self.W2 = nn.Parameter(torch.zeros(self.n, hidden_dim, hidden_dim))
+        self.b2 = nn.Parameter(torch.zeros(self.n, hidden_dim))
+        self.W3 = nn.Parameter(torch.zeros(self.n, out_max, hidden_dim))
+        self.b3 = nn.Parameter(torch.zeros(self.n, out_max))
+        self.load(nets)
+        self.nonlin = nets[0].nonlin
+        self.out_fn = nets[0].out_fn
+        # column of the joint (concatenated) input feeding each padded input;
+        # padding reads an extra zero column
+        sum_in = sum(self.in_dims)
+        in_index = torch.full((self.n, in_max), sum_in, dtype=torch.long)
+        # position in the flattened padded output of each joint output column
+        out_index = []
+        out_mask = torch.zeros(self.n, out_max, dtype=torch.bool)
+        own_outputs = torch.zeros(self.n, 1, sum(self.out_dims), dtype=torch.bool)
+        start_in = start_out = 0
+        for a in range(self.n):
+            in_index[a, :self.in_dims[a]] = torch.arange(start_in, start_in + self.in_dims[a])
+            out_index.extend(a * out_max + k for k in range(self.out_dims[a]))
+            out_mask[a, :self.out_dims[a]] = True
+            own_outputs[a, 0, start_out:start_out + self.out_dims[a]] = True
+            start_in += self.in_dims[a]
+            start_out += self.out_dims[a]
+        self.register_buffer('in_index', in_index)
+        self.register_buffer('out_index', torch.tensor(out_index, dtype=torch.long))
+        self.register_buffer('out_mask', out_mask)
+        self.register_buffer('own_outputs', own_outputs)
+        if link:
+            self.link(nets)
+
+    def load(self, nets):
+        """
+        Copy the parameters of nets into the stacked parameters
+        """
+        with torch.no_grad():
+            for a, net in enumerate(nets):
+                self.W1[a, :, :self.in_dims[a]] = net.fc1.weight
+                self.b1[a] = net.fc1.bias
+                self.W2[a] = net.fc2.weight
+                self.b2[a] = net.fc2.bias
+                self.W3[a, :self.out_dims[a]] = net.fc3.weight
+                self.b3[a, :self.out_dims[a]] = net.fc3.bias
+
+    def link(self, nets):
+        """
+        Make the parameters of nets views of the stacked parameters (again,
+        e.g. after the stacked network was moved to another device)
+        """
+        for a, net in enumerate(nets):
+            net.fc1.weight.data = self.W1.data[a, :, :self.in_dims[a]]
+            net.fc1.bias.data = self.b1.data[a]
+            net.fc2.weight.data = self.W2.data[a]
+            net.fc2.bias.data = self.b2.data[a]
+            net.fc3.weight.data = self.W3.data[a, :self.out_dims[a]]
+            net.fc3.bias.data = self.b3.data[a, :self.out_dims[a]]
+
+    def share(self, stacked, start):
+        """
+        Make the stacked parameters views of the networks start to start + n
+        of another stacked network (with the same dimensions), e.g. to
+        evaluate one member of an ensemble on its own
+        """
+        for name in ('W1', 'b1', 'W2', 'b2', 'W3', 'b3'):
+            getattr(self, name).data = getattr(stacked, name).data[start:start + self.n]
+
+    def gather_inputs(self, X):
+        """
+        Inputs:
+            X (PyTorch Matrix): Batch of joint inputs, i.e. the inputs of all
+                                networks concatenated (batch, sum of in dims)
+        Outputs:
+            out (PyTorch Tensor): Padded per-network inputs (n, batch, max in dim)
+        """
+        X = torch.cat((X, X.new_zeros(X.shape[0], 1)), dim=1)
+        return X[:, self.in_index].transpose(0, 1)
+
+    def scatter_outputs(self, out):
+        """
+        Inverse of gather_inputs for the outputs: (n, batch, max out dim) ->
+        (batch, sum of out dims), dropping the padding
+        """
+        return out.transpose(0, 1).reshape(out.shape[1], -1)[:, self.out_index]
+
+    def mask_logits(self, out):
+        """
+        Set the padded outputs to -inf so that they never win an argmax and get
+        no probability mass in a softmax
+        """
+        return out.masked_fill(~self.out_mask.unsqueeze(1), float('-inf'))
+
+    def forward(self, X):
+        """
+        Inputs:
+            X (PyTorch Tensor): Padded per-network inputs (n, batch, max in
+                                dim), or one (batch, max in dim) batch fed to
+                                all networks
+        Outputs:
+            out (PyTorch Tensor): Padded outputs (n, batch, max out dim)
+        """
+        if X.dim() == 2:
+            X = X.unsqueeze(0).expand(self.n, -1, -1)
+        h1 = self.nonlin(torch.baddbmm(self.b1.unsqueeze(1), X, self.W1.transpose(1, 2)))
+        h2 = self.nonlin(torch.baddbmm(self.b2.unsqueeze(1), h1, self.W2.transpose(1, 2)))
+        out = self.out_fn(torch.baddbmm(self.b3.unsqueeze(1), h2, self.W3.transpose(1, 2)))
+        # back to the input type if computed at lower precision (autocast)
+        return out.to(X.dtype)
+
+    def clip_grad_norm_(self, max_norm):
+        """
+        Per-network equivalent of torch.nn.utils.clip_grad_norm_
+        """
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        norms = torch.stack([g.pow(2).flatten(1).sum(1) for g in grads]).sum(0).sqrt()
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(scale.view(-1, *[1] * (g.dim() - 1)))
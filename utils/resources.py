@@ -0,0 +1,213 @@
+import os
+import math
+
+# thread pools of the numerical libraries loaded by the rollout workers
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS')
+
+
+def available_cores():
+    """
+    Cores this process may run on (respects cgroup/taskset restrictions)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def pin_to_cores(cores):
+    """
+    Restrict the calling thread (and the processes and threads it starts
+    afterwards, e.g. a SUMO server) to the given cores. No-op where CPU
+    affinity is not supported.
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+def read_cpu_times():
+    """
+    Cumulative (busy, total) jiffies per core from /proc/stat, or None if it
+    is not available (non-Linux)
+    """
+    try:
+        with open('/proc/stat') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    times = {}
+    for line in lines:
+        fields = line.split()
+        if not fields or not fields[0].startswith('cpu') or fields[0] == 'cpu':
+            continue
+        values = [int(v) for v in fields[1:]]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        total = sum(values[:8])  # guest time is already counted in user/nice
+        times[int(fields[0][3:])] = (total - idle, total)
+    return times
+
+
+class ResourcePlan(object):
+    """
+    Static assignment of the node's cores to the learner and the rollout
+    workers. Each worker gets dedicated cores for its Python driver and the
+    SUMO server(s) it starts, the learner keeps its own cores, and the thread
+    pools of the worker processes are limited to one thread so that the
+    workers do not oversubscribe the node.
+    """
+    def __init__(self, n_envs, learner_threads, envs_per_worker=1,
+                 cores_per_env=2, cores=None):
+        """
+        Inputs:
+            n_envs (int): Number of rollout environments
+            learner_threads (int): Number of cores reserved for the learner
+            envs_per_worker (int): Number of environments per worker process
+            cores_per_env (int): Cores wanted per environment (Python driver
+                                 and SUMO server)
+            cores (list of ints): Cores to plan for (default: all available)
+        """
+        cores = available_cores() if cores is None else sorted(cores)
+        self.cores = cores
+        self.n_envs = n_envs
+        self.envs_per_worker = envs_per_worker
+        n_workers = int(math.ceil(n_envs / envs_per_worker))
+        n_learner = max(1, min(learner_threads, len(cores) - 1))
+        self.learner_cores = cores[:n_learner]
+        rest = cores[n_learner:] or cores  # single core: everything is shared
+        wanted = envs_per_worker * cores_per_env
+        per_worker = max(1, min(wanted, len(rest) // n_workers))
+        # with fewer cores than wanted, workers share cores round robin
+        self.worker_cores = [[rest[(w * per_worker + c) % len(rest)]
+                              for c in range(per_worker)]
+                             for w in range(n_workers)]
+        self._start_times = None
+
+    @property
+    def env_cores(self):
+        """
+        Cores of each environment (those of the worker hosting it)
+        """
+        return [self.worker_cores[i // self.envs_per_worker]
+                for i in range(self.n_envs)]
+
+    def apply(self, threads_per_worker=1):
+        """
+        Pin the calling (learner) process and set the thread-count environment
+        variables inherited by the worker processes. Must be called before the
+        workers are started; the learner's own thread pools are already
+        initialized and keep their size (see torch.set_num_threads).
+        """
+        pin_to_cores(self.learner_cores)
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(threads_per_worker)
+        self._start_times = read_cpu_times()
+
+    def utilization(self):
+        """
+        Busy fraction of each planned core since apply() was called, or None
+        if it cannot be measured
+        """
+        end_times = read_cpu_times()
+        if self._start_times is None or end_times is None:
+            return None
+        usage = {}
+        for core in self.cores:
+            if core not in self._start_times or core not in end_times:
+                continue
+            busy = end_times[core][0] - self._start_times[core][0]
+            total = end_times[core][1] - self._start_times[core][1]
+            usage[core] = busy / total if total > 0 else 0.0
+        return usage
+
+    def report(self):
+        """
+        Text summary of the plan and of the per-core utilization
+        """
+        usage = self.utilization()
+        fmt = lambda cores: ' '.join('%i:%3.0f%%' % (c, 100 * usage[c]) if usage and c in usage
+                                     else str(c) for c in cores)
+        lines = ['learner       %s' % fmt(self.learner_cores)]
+        for w, cores in enumerate(self.worker_cores):
+            lines.append('worker %-6i %s' % (w, fmt(cores)))
+        if usage:
+            lines.append('mean busy     %.0f%%' % (100 * sum(usage.values()) / len(usage)))
+        return '\n'.join(lines)
+
+
+class RolloutAutoscaler(object):
+    """
+    Chooses the number of rollout workers between episodes. Each episode
+    reports how many env steps and learner updates were done and how long
+    collection and learning took. The pool grows while the replay buffer
+    cannot serve a batch yet or while collection is the bottleneck (the envs
+    push fewer env steps per second of collection than the learner's update
+    rounds per second of learning need at the configured replay ratio), as
+    long as the last added worker paid off. It shrinks when the last
+    added worker did not raise the overall throughput by at least min_gain.
+    """
+    def __init__(self, min_envs, max_envs, min_gain=0.05, smoothing=0.3):
+        """
+        Inputs:
+            min_envs (int): Smallest pool size
+            max_envs (int): Largest pool size (the core budget)
+            min_gain (float): Relative throughput gain a worker must bring
+            smoothing (float): Weight of the newest measurement in the
+                               running throughput estimates
+        """
+        self.min_envs = min_envs
+        self.max_envs = max(min_envs, max_envs)
+        self.min_gain = min_gain
+        self.smoothing = smoothing
+        self.throughput = {}  # pool size -> env steps per second of wall time
+        self.collection_bound = False
+        self.starving = True
+
+    def record(self, n_envs, env_steps, updates, collect_time, learn_time,
+               buffer_len, batch_size, steps_per_round):
+        """
+        Inputs:
+            n_envs (int): Pool size during the episode
+            env_steps (int): Transitions pushed to the replay buffer
+            updates (int): Learner update rounds performed (a round of
+                           per-agent updates counts once)
+            collect_time (float): Seconds spent collecting
+            learn_time (float): Seconds spent in learner updates
+            buffer_len (int): Replay buffer size at the end of the episode
+            batch_size (int): Learner batch size
+            steps_per_round (float): Env steps the replay ratio asks for per
+                                     update round
+        """
+        elapsed = collect_time + learn_time
+        if elapsed <= 0 or env_steps == 0:
+            return
+        rate = env_steps / elapsed
+        old = self.throughput.get(n_envs)
+        self.throughput[n_envs] = rate if old is None else (
+            (1 - self.smoothing) * old + self.smoothing * rate)
+        if updates > 0 and learn_time > 0:
+            fill_rate = env_steps / max(collect_time, 1e-9)
+            demand = steps_per_round * updates / learn_time
+            self.collection_bound = fill_rate < demand
+        else:
+            self.collection_bound = True
+        self.starving = buffer_len < batch_size
+
+    def target(self, n_envs):
+        """
+        Pool size to use for the next episode
+        """
+        current = self.throughput.get(n_envs)
+        smaller = self.throughput.get(n_envs - 1)
+        larger = self.throughput.get(n_envs + 1)
+        if (current is not None and smaller is not None and n_envs > self.min_envs
+                and current < smaller * (1 + self.min_gain)):
+            return n_envs - 1  # the last worker does not pay off
+        if n_envs >= self.max_envs:
+            return self.max_envs
+        if (current is not None and larger is not None
+                and larger < current * (1 + self.min_gain)):
+            return n_envs  # already tried a larger pool
+        if self.starving or self.collection_bound:
+            return n_envs + 1
+        return n_envs
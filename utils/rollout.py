@@ -0,0 +1,230 @@
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+class RolloutCollector(object):
+    """
+    Base class for collecting MADDPG transitions from a vectorized env. Each
+    collector yields batches of transitions in the layout expected by
+    ReplayBuffer.push, so the learner side of the training loop does not
+    depend on how the envs are stepped.
+    """
+    def __init__(self, env, maddpg, agent_names, explore=True, engine=None):
+        """
+        Inputs:
+            env (VecEnv): Vectorized environment to collect from
+            maddpg (MADDPG): Learner whose policies choose the actions
+            agent_names (list of str): Observation keys, in agent order
+            explore (bool): Whether or not to add exploration noise
+            engine (PolicyEngine): If given, computes the actions of all
+                                   agents in one batched, grad-free pass
+        """
+        self.env = env
+        self.maddpg = maddpg
+        self.agent_names = agent_names
+        self.explore = explore
+        self.engine = engine
+
+    def act(self, obs, indices):
+        """
+        Compute actions for a subset of the environments
+        Inputs:
+            obs (dict): Latest observations of all envs, keyed by agent name
+            indices (np.ndarray): Environments to compute actions for
+        Outputs:
+            agent_actions (list of np.ndarray): Per-agent action batches, as
+                                                stored in the replay buffer
+            env_actions (list of lists): Per-env discrete actions for env.step
+        """
+        if self.engine is not None:
+            return self.engine.act([obs[name][indices] for name in self.agent_names],
+                                   explore=self.explore)
+        torch_obs = [Variable(torch.Tensor(obs[name][indices]), requires_grad=False)
+                     for name in self.agent_names]
+        torch_agent_actions = self.maddpg.step(torch_obs, explore=self.explore)
+        agent_actions = [ac.data.numpy() for ac in torch_agent_actions]
+        env_actions = [[int(np.argmax(ac[i])) for ac in agent_actions]
+                       for i in range(len(indices))]
+        return agent_actions, env_actions
+
+    def rollout(self, obs, n_steps):
+        """
+        Step every environment n_steps times, starting from obs (as returned
+        by env.reset()). Yields tuples of
+            (indices, obs, agent_actions, rewards, next_obs, dones, infos)
+        where obs and next_obs are lists of per-agent arrays for the envs in
+        indices.
+        """
+        raise NotImplementedError
+
+    def _batch(self, obs, indices, agent_actions, next_obs, rewards, dones, infos):
+        """
+        Build the batch of transitions of the envs in indices and overwrite
+        their rows of obs with next_obs. Transitions interrupted by a worker
+        restart (see SubprocVecEnv) are dropped; None is returned when no
+        transition is left.
+        """
+        batch_obs = [obs[name][indices] for name in self.agent_names]
+        batch_next_obs = [next_obs[name] for name in self.agent_names]
+        for name in self.agent_names:
+            obs[name][indices] = next_obs[name]
+        keep = np.array([not info.get('worker_restarted', False) for info in infos])
+        if keep.all():
+            return indices, batch_obs, agent_actions, rewards, batch_next_obs, dones, infos
+        if not keep.any():
+            return None
+        select = lambda arrs: [arr[keep] for arr in arrs]
+        return (indices[keep], select(batch_obs), select(agent_actions), rewards[keep],
+                select(batch_next_obs), dones[keep],
+                tuple(info for info, k in zip(infos, keep) if k))
+
+
+class SequentialCollector(RolloutCollector):
+    """
+    Lock-step collection: infer actions for all envs, then step all envs and
+    wait for the slowest one.
+    """
+    def rollout(self, obs, n_steps):
+        obs = {name: np.copy(obs[name]) for name in self.agent_names}
+        indices = np.arange(self.env.num_envs)
+        for _ in range(n_steps):
+            agent_actions, env_actions = self.act(obs, indices)
+            next_obs, rewards, dones, infos = self.env.step(env_actions)
+            batch = self._batch(obs, indices, agent_actions, next_obs, rewards, dones, infos)
+            if batch is not None:
+                yield batch
+
+
+class PipelinedCollector(RolloutCollector):
+    """
+    Double-buffered collection over a SubprocVecEnv. The env pool is split in
+    two halves: while one half steps SUMO in the background, the policies
+    compute the actions of the other half, and the transitions of a half are
+    handed to the caller as soon as that half is done. Work done by the caller
+    between two batches (e.g. learner updates) also overlaps with stepping.
+    """
+    def __init__(self, env, maddpg, agent_names, explore=True, engine=None):
+        if env.num_envs < 2:
+            raise ValueError("Pipelined collection needs at least two environments")
+        super(PipelinedCollector, self).__init__(env, maddpg, agent_names,
+                                                 explore=explore, engine=engine)
+
+    @property
+    def halves(self):
+        # recomputed on every rollout, as the pool may be resized between them
+        half = self.env.num_envs // 2
+        return [np.arange(half), np.arange(half, self.env.num_envs)]
+
+    def rollout(self, obs, n_steps):
+        obs = {name: np.copy(obs[name]) for name in self.agent_names}
+        halves = self.halves
+        in_flight = None
+        for _ in range(n_steps):
+            for indices in halves:
+                # infer for this half while the other one is still stepping
+                agent_actions, env_actions = self.act(obs, indices)
+                self.env.step_async(env_actions, indices=indices)
+                if in_flight is not None:
+                    batch = self._collect(obs, *in_flight)
+                    if batch is not None:
+                        yield batch
+                in_flight = (indices, agent_actions)
+        batch = self._collect(obs, *in_flight)
+        if batch is not None:
+            yield batch
+
+    def _collect(self, obs, indices, agent_actions):
+        next_obs, rewards, dones, infos = self.env.step_wait(indices=indices)
+        return self._batch(obs, indices, agent_actions, next_obs, rewards, dones, infos)
+
+
+class FirstReadyCollector(RolloutCollector):
+    """
+    Straggler-tolerant collection over a SubprocVecEnv. All envs are stepped
+    asynchronously; as soon as at least k of them are done, their transitions
+    are handed to the caller and only those envs receive new actions. Slow
+    workers (high-flow slots, uncached netconvert runs) then no longer hold
+    back the fast ones.
+    """
+    def __init__(self, env, maddpg, agent_names, k=1, explore=True, engine=None):
+        """
+        Inputs:
+            k (int): Minimum number of finished envs per yielded batch
+        """
+        super(FirstReadyCollector, self).__init__(env, maddpg, agent_names,
+                                                  explore=explore, engine=engine)
+        self.k = k
+
+    def rollout(self, obs, n_steps):
+        obs = {name: np.copy(obs[name]) for name in self.agent_names}
+        steps_left = np.full(self.env.num_envs, n_steps)
+        actions = {}
+        self._dispatch(obs, np.arange(self.env.num_envs), actions)
+        while self.env.pending:
+            env_ids, next_obs, rewards, dones, infos = self.env.step_wait_any(self.k)
+            env_actions = [actions.pop(env_idx) for env_idx in env_ids]
+            agent_actions = [np.stack(acs) for acs in zip(*env_actions)]
+            batch = self._batch(obs, env_ids, agent_actions, next_obs, rewards, dones, infos)
+            steps_left[env_ids] -= 1
+            # keep the finished workers busy while the caller handles the batch
+            self._dispatch(obs, env_ids[steps_left[env_ids] > 0], actions)
+            if batch is not None:
+                yield batch
+
+    def _dispatch(self, obs, indices, actions):
+        if len(indices) == 0:
+            return
+        agent_actions, env_actions = self.act(obs, indices)
+        for row, env_idx in enumerate(indices):
+            actions[env_idx] = [ac[row] for ac in agent_actions]
+        self.env.step_async(env_actions, indices=indices)
+
+
+class EnsembleCollector(object):
+    """
+    Lock-step collection for the members of an MADDPGEnsemble over one env
+    pool, in which member m owns the envs m * n_envs to (m + 1) * n_envs - 1.
+    Each member acts for its own envs, then the whole pool is stepped at
+    once, so that the SUMO instances of all members run in parallel. Yields
+    one batch per member (None where all of its transitions were dropped),
+    with env indices local to the member.
+    """
+    def __init__(self, env, members, agent_names, explore=True, engines=None):
+        """
+        Inputs:
+            env (VecEnv): Pool of n_members * n_envs environments
+            members (list of MADDPG): Learners choosing the actions
+            agent_names (list of str): Observation keys, in agent order
+            explore (bool): Whether or not to add exploration noise
+            engines (list of PolicyEngine): If given, one per member
+        """
+        if env.num_envs % len(members):
+            raise ValueError("The env pool must have the same number of envs per member")
+        self.env = env
+        self.n_envs = env.num_envs // len(members)
+        engines = engines or [None] * len(members)
+        self.collectors = [RolloutCollector(env, maddpg, agent_names, explore=explore,
+                                            engine=engine)
+                           for maddpg, engine in zip(members, engines)]
+        self.agent_names = agent_names
+
+    def rollout(self, obs, n_steps):
+        obs = {name: np.copy(obs[name]) for name in self.agent_names}
+        shards = [np.arange(m * self.n_envs, (m + 1) * self.n_envs)
+                  for m in range(len(self.collectors))]
+        for _ in range(n_steps):
+            actions = [collector.act(obs, indices)
+                       for collector, indices in zip(self.collectors, shards)]
+            next_obs, rewards, dones, infos = self.env.step(
+                [ac for _, env_actions in actions for ac in env_actions])
+            batches = []
+            for collector, indices, (agent_actions, _) in zip(self.collectors, shards, actions):
+                rows = slice(indices[0], indices[-1] + 1)
+                batch = collector._batch(obs, indices, agent_actions,
+                                         {name: next_obs[name][rows] for name in self.agent_names},
+                                         rewards[rows], dones[rows], infos[rows])
+                if batch is not None:
+                    batch = (batch[0] - indices[0],) + batch[1:]
+                batches.append(batch)
+            yield batches
@@ -0,0 +1,604 @@
+import os
+import re
+import json
+import contextlib
+import numpy as np
+from .checkpoint import atomic_write
+
+CHUNK_SIZE = 65536  # transitions or observation rows per snapshot chunk
+
+
+def sample_indices(n, N, replace=False):
+    """
+    Draw N indices out of range(n) in O(N) (instead of permuting range(n))
+    Inputs:
+        n (int): Number of candidates
+        N (int): Number of indices
+        replace (bool): Whether or not an index may be drawn twice
+    """
+    if replace:
+        return np.random.randint(0, n, size=N)
+    if 2 * N > n:
+        # rejection would redraw too often
+        return np.random.permutation(n)[:N]
+    inds = np.unique(np.random.randint(0, n, size=N))
+    while len(inds) < N:
+        inds = np.unique(np.concatenate(
+            (inds, np.random.randint(0, n, size=N - len(inds)))))
+    return inds
+
+
+class RunningMeanStd(object):
+    """
+    Streaming mean and (population) standard deviation of a set of vectors
+    that supports removing members again (Welford / Chan et al. updates on
+    batches), so that statistics of a circular buffer cost O(batch) to keep
+    up to date
+    """
+    def __init__(self, dim, state=None):
+        """
+        Inputs:
+            dim (int): Size of the vectors
+            state (np.ndarray): Array of 1 + 2 * dim floats to keep the
+                                statistics in (e.g. shared memory)
+        """
+        self.dim = dim
+        self.state = np.zeros(1 + 2 * dim) if state is None else state
+
+    @property
+    def count(self):
+        return int(self.state[0])
+
+    @property
+    def mean(self):
+        return self.state[1:1 + self.dim]
+
+    @property
+    def M2(self):
+        # sum of squared deviations
+        return self.state[1 + self.dim:]
+
+    def reset(self):
+        self.state[:] = 0
+
+    def add(self, x):
+        """
+        Inputs:
+            x (np.ndarray): Batch of vectors (batch, *shape)
+        """
+        n_b = len(x)
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=0, dtype=np.float64)
+        M2_b = ((x - mean_b) ** 2).sum(axis=0)
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        self.M2[:] = self.M2 + M2_b + delta ** 2 * self.count * n_b / n
+        self.mean[:] = self.mean + delta * n_b / n
+        self.state[0] = n
+
+    def remove(self, x):
+        """
+        Inverse of add for vectors that were added before
+        """
+        n_b = len(x)
+        if n_b == 0:
+            return
+        n = self.count - n_b
+        if n <= 0:
+            self.reset()
+            return
+        mean_b = x.mean(axis=0, dtype=np.float64)
+        M2_b = ((x - mean_b) ** 2).sum(axis=0)
+        mean = (self.count * self.mean - n_b * mean_b) / n
+        delta = mean_b - mean
+        self.M2[:] = np.maximum(self.M2 - M2_b - delta ** 2 * n * n_b / self.count, 0.0)
+        self.mean[:] = mean
+        self.state[0] = n
+
+    @property
+    def std(self):
+        return np.sqrt(self.M2 / max(self.count, 1))
+
+
+class Minibatch(object):
+    """
+    Preallocated float32 arrays that TransitionStorage.gather fills with
+    sampled transitions, so that assembling minibatches of a given size does
+    not allocate once the arrays exist. Per-agent observations and actions
+    are column views of the joint arrays. The arrays are overwritten by the
+    next gather.
+    """
+    def __init__(self, storage, batch_size):
+        """
+        Inputs:
+            storage (TransitionStorage): Storage to gather from
+            batch_size (int): Number of transitions per batch
+        """
+        self.batch_size = batch_size
+        self.index = np.empty((3, batch_size), dtype=np.int64)
+        n_obs = storage.obs.shape[1]
+        self.obs = np.empty((batch_size, n_obs), dtype=np.float32)
+        self.acs = np.empty((batch_size, storage.acs.shape[1]), dtype=np.float32)
+        self.rews = np.empty((batch_size, storage.num_agents), dtype=np.float32)
+        self.next_obs = np.empty((batch_size, n_obs), dtype=np.float32)
+        self.dones = np.empty((batch_size, storage.num_agents), dtype=np.float32)
+        self._staging = {}
+
+    @property
+    def arrays(self):
+        return self.obs, self.acs, self.rews, self.next_obs, self.dones
+
+    def staging(self, dtype, shape):
+        """
+        Reusable array of the given storage type and shape
+        """
+        key = (np.dtype(dtype), shape)
+        if key not in self._staging:
+            self._staging[key] = np.empty(shape, dtype=dtype)
+        return self._staging[key]
+
+
+class TransitionStorage(object):
+    """
+    Compact circular storage of multi-agent transitions. The joint observation
+    (all agents' observations concatenated, i.e. the centralized critic's
+    state) is stored once per time step in an observation table: a transition
+    refers to the rows of its observation and next observation, and the
+    next observation of a transition is the observation of the following
+    transition of the same env whenever they are equal, so within an episode
+    every observation is stored once. Per-agent observations are column
+    slices of the joint rows. Arrays use a configurable dtype and can be
+    memory-mapped files instead of RAM.
+
+    Memory-mapped storage is shared between processes: a pickled copy (e.g.
+    passed to a multiprocessing.Process) reopens the same files, with one
+    process pushing and any number of processes sampling. Set lock to a
+    multiprocessing lock before the copies are made so that a push and the
+    sampling of a batch (see locked) never overlap.
+    """
+    ARRAYS = ('obs', 'acs', 'rews', 'dones', 'obs_ids', 'next_obs_ids', 'meta', 'rew_state')
+    TRANSITION_ARRAYS = ('acs', 'rews', 'dones', 'obs_ids', 'next_obs_ids')
+    MANIFEST = 'storage_manifest.json'
+
+    def __init__(self, capacity, obs_dims, ac_dims, dtype=np.float32,
+                 obs_capacity=None, memmap_dir=None):
+        """
+        Inputs:
+            capacity (int): Maximum number of transitions
+            obs_dims (list of ints): Observation dimensions of each agent
+            ac_dims (list of ints): Action dimensions of each agent
+            dtype (np.dtype): Storage type of observations and actions
+            obs_capacity (int): Rows of the observation table (default:
+                                1.25 * capacity). Each episode needs one row
+                                more than it has transitions; when the table
+                                is too small, the oldest transitions are
+                                dropped early.
+            memmap_dir (str): If given, arrays are memory-mapped files in this
+                              directory
+        """
+        self.capacity = capacity
+        self.obs_capacity = obs_capacity or capacity + capacity // 4
+        self.num_agents = len(obs_dims)
+        self.dtype = np.dtype(dtype)
+        self.memmap_dir = memmap_dir
+        self.obs_slices = self._slices(obs_dims)
+        self.ac_slices = self._slices(ac_dims)
+        self.obs = self._alloc('obs', (self.obs_capacity, sum(obs_dims)), self.dtype)
+        self.acs = self._alloc('acs', (capacity, sum(ac_dims)), self.dtype)
+        self.rews = self._alloc('rews', (capacity, self.num_agents), np.float32)
+        self.dones = self._alloc('dones', (capacity, self.num_agents), np.bool_)
+        # global (ever increasing) observation row ids, row = id % obs_capacity
+        self.obs_ids = self._alloc('obs_ids', (capacity,), np.int64)
+        self.next_obs_ids = self._alloc('next_obs_ids', (capacity,), np.int64)
+        # head: next transition slot, size: number of live transitions (ending
+        # at head), next_obs_id: global id of the next observation row,
+        # pushed: transitions pushed so far; in an array so that they are
+        # shared along with the data
+        self.meta = self._alloc('meta', (4,), np.int64)
+        # statistics of the live rewards, kept up to date as entries come and go
+        self.rew_state = self._alloc('rew_state', (1 + 2 * self.num_agents,), np.float64)
+        self.rew_stats = RunningMeanStd(self.num_agents, state=self.rew_state)
+        self.streams = {}  # env id -> global row id of its latest next observation
+        self.lock = None  # shared with the sampling processes, see locked
+        # folder -> {(kind, chunk index): first id in the file} of the
+        # complete chunks saved there (see snapshot)
+        self._saved = {}
+
+    def _meta_property(index):
+        def fget(self):
+            return int(self.meta[index])
+        def fset(self, value):
+            self.meta[index] = value
+        return property(fget, fset)
+
+    head = _meta_property(0)
+    size = _meta_property(1)
+    next_obs_id = _meta_property(2)
+    pushed = _meta_property(3)
+    del _meta_property
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memmap_dir is not None:
+            # reopened from the files by __setstate__
+            for name in self.ARRAYS + ('rew_stats',):
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.memmap_dir is not None:
+            for name in self.ARRAYS:
+                setattr(self, name, np.memmap(os.path.join(self.memmap_dir, name + '.dat'),
+                                              dtype=self._dtypes[name], mode='r+',
+                                              shape=self._shapes[name]))
+            self.rew_stats = RunningMeanStd(self.num_agents, state=self.rew_state)
+
+    @staticmethod
+    def _slices(dims):
+        bounds = np.cumsum([0] + list(dims))
+        return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def _alloc(self, name, shape, dtype):
+        self._shapes = getattr(self, '_shapes', {})
+        self._dtypes = getattr(self, '_dtypes', {})
+        self._shapes[name], self._dtypes[name] = shape, np.dtype(dtype)
+        if self.memmap_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        os.makedirs(self.memmap_dir, exist_ok=True)
+        return np.memmap(os.path.join(self.memmap_dir, name + '.dat'),
+                         dtype=dtype, mode='w+', shape=shape)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.obs, self.acs, self.rews, self.dones,
+                                          self.obs_ids, self.next_obs_ids))
+
+    def locked(self):
+        """
+        Context holding lock, if set: a push is not visible to a sampler
+        holding it until the push is complete, and the transitions it draws
+        are not overwritten before it has gathered them
+        """
+        return self.lock if self.lock is not None else contextlib.nullcontext()
+
+    def positions(self, inds):
+        """
+        Storage slots of live transitions, 0 being the oldest
+        """
+        return (self.head - self.size + np.asarray(inds)) % self.capacity
+
+    def is_live(self, obs_id):
+        """
+        Whether observation rows (global ids) have not been overwritten yet
+        """
+        return obs_id > self.next_obs_id - self.obs_capacity
+
+    def push(self, obs, acs, rews, next_obs, dones, env_ids=None):
+        """
+        Inputs:
+            obs, next_obs (np.ndarray): Joint observations (batch, sum of obs dims)
+            acs (np.ndarray): Joint actions (batch, sum of action dims)
+            rews, dones (np.ndarray): Per-agent rewards and dones (batch, agents)
+            env_ids (iterable): Env of each row, used to link consecutive
+                                transitions (default: row i is env i)
+        """
+        with self.locked():
+            self._push(obs, acs, rews, next_obs, dones, env_ids)
+
+    def _push(self, obs, acs, rews, next_obs, dones, env_ids):
+        nentries = len(obs)
+        env_ids = range(nentries) if env_ids is None else env_ids
+        obs = np.asarray(obs).astype(self.dtype, copy=False)
+        next_obs = np.asarray(next_obs).astype(self.dtype, copy=False)
+        obs_ids = np.empty(nentries, dtype=np.int64)
+        new_rows = []
+        for row, env_idx in enumerate(env_ids):
+            prev = self.streams.get(int(env_idx))
+            if (prev is not None and self.is_live(prev) and
+                    np.array_equal(self.obs[prev % self.obs_capacity], obs[row])):
+                obs_ids[row] = prev
+            else:  # first step of an episode (or of the env)
+                obs_ids[row] = self.next_obs_id + len(new_rows)
+                new_rows.append(row)
+        n_new = len(new_rows)
+        self._write_obs(self.next_obs_id, obs[new_rows])
+        next_obs_ids = self.next_obs_id + n_new + np.arange(nentries)
+        self._write_obs(next_obs_ids[0], next_obs)
+        self.next_obs_id += n_new + nentries
+        for env_idx, obs_id in zip(env_ids, next_obs_ids):
+            self.streams[int(env_idx)] = int(obs_id)
+
+        overwritten = self.size + nentries - self.capacity
+        if overwritten > 0:
+            self.rew_stats.remove(self.rews[self.positions(np.arange(overwritten))])
+        slots = (self.head + np.arange(nentries)) % self.capacity
+        self.acs[slots] = acs
+        self.rews[slots] = rews
+        self.dones[slots] = dones
+        self.obs_ids[slots] = obs_ids
+        self.next_obs_ids[slots] = next_obs_ids
+        self.rew_stats.add(self.rews[slots])
+        self.head = (self.head + nentries) % self.capacity
+        self.size = min(self.size + nentries, self.capacity)
+        self.pushed += nentries
+        self._evict_dead()
+
+    def _evict_dead(self):
+        """
+        Drop the oldest transitions whose observation was overwritten
+        """
+        evicted = 0
+        while evicted < self.size and not self.is_live(self.obs_ids[self.positions(evicted)]):
+            evicted += 1
+        if evicted:
+            self.rew_stats.remove(self.rews[self.positions(np.arange(evicted))])
+            self.size -= evicted
+
+    def sample_indices(self, N, replace=False):
+        """
+        Draw N live transitions in O(N). The oldest transitions are dropped as
+        soon as their observation row is overwritten; a transition that
+        continued an env stream after a long pause can lose its row earlier
+        and is redrawn (with replacement).
+        """
+        inds = sample_indices(self.size, N, replace=replace)
+        while True:
+            slots = self.positions(inds)
+            live = (self.is_live(self.obs_ids[slots]) &
+                    self.is_live(self.next_obs_ids[slots]))
+            if live.all():
+                return inds
+            inds = np.concatenate((inds[live],
+                                   np.random.randint(0, self.size, size=N - live.sum())))
+
+    def _write_obs(self, first_id, rows):
+        """
+        Write rows to the observation table from global row id first_id on
+        (at most two slice writes)
+        """
+        start = first_id % self.obs_capacity
+        first = min(len(rows), self.obs_capacity - start)
+        self.obs[start:start + first] = rows[:first]
+        if first < len(rows):
+            self.obs[:len(rows) - first] = rows[first:]
+
+    def rows(self, inds, out=None):
+        """
+        Storage slots, observation rows and next observation rows of the
+        transitions inds (0 being the oldest live one)
+        Inputs:
+            inds (np.ndarray): Transitions
+            out (np.ndarray): int64 array (3, len(inds)) to write them into
+        """
+        out = np.empty((3, len(inds)), dtype=np.int64) if out is None else out
+        slots, obs_rows, next_obs_rows = out
+        np.add(inds, self.head - self.size, out=slots)
+        np.remainder(slots, self.capacity, out=slots)
+        np.take(self.obs_ids, slots, out=obs_rows, mode='clip')
+        np.remainder(obs_rows, self.obs_capacity, out=obs_rows)
+        np.take(self.next_obs_ids, slots, out=next_obs_rows, mode='clip')
+        np.remainder(next_obs_rows, self.obs_capacity, out=next_obs_rows)
+        return out
+
+    def get(self, inds):
+        """
+        Transitions inds (0 being the oldest live one)
+        Outputs:
+            obs, acs, rews, next_obs, dones (np.ndarray): Joint arrays, split
+            them per agent with obs_slices and ac_slices
+        """
+        slots, obs_rows, next_obs_rows = self.rows(inds)
+        return (self.obs[obs_rows],
+                self.acs[slots],
+                self.rews[slots],
+                self.obs[next_obs_rows],
+                self.dones[slots])
+
+    def gather(self, inds, batch):
+        """
+        Like get, but gathers into the preallocated arrays of batch
+        Inputs:
+            inds (np.ndarray): batch.batch_size transitions
+            batch (Minibatch): Arrays to fill
+        Outputs:
+            obs, acs, rews, next_obs, dones (np.ndarray): batch's float32 arrays
+        """
+        slots, obs_rows, next_obs_rows = self.rows(inds, out=batch.index)
+        for name, src, rows in (('obs', self.obs, obs_rows),
+                                ('acs', self.acs, slots),
+                                ('rews', self.rews, slots),
+                                ('next_obs', self.obs, next_obs_rows),
+                                ('dones', self.dones, slots)):
+            dst = getattr(batch, name)
+            if src.dtype == dst.dtype:
+                np.take(src, rows, axis=0, out=dst, mode='clip')
+            else:
+                # np.take does not cast, go through a buffer of the storage type
+                staging = batch.staging(src.dtype, dst.shape)
+                np.take(src, rows, axis=0, out=staging, mode='clip')
+                dst[...] = staging
+        return batch.arrays
+
+    def _chunks(self, lo, hi, chunk_size):
+        """
+        (chunk index, start, end) of the chunks covering ids [lo, hi)
+        """
+        return [(k, max(lo, k * chunk_size), min(hi, (k + 1) * chunk_size))
+                for k in range(lo // chunk_size, -(-hi // chunk_size))]
+
+    def snapshot(self, folder_path=None, chunk_size=CHUNK_SIZE):
+        """
+        In-memory copy of the live contents, for write_snapshot. Transitions
+        (by push order) and observation rows (by global id) are cut into
+        chunks of chunk_size; chunks that were complete when last saved to
+        folder_path are not copied again, as their files are still valid.
+        Chunk files are named after the ids they hold, which never change
+        their contents, so a snapshot never overwrites a file that another
+        manifest refers to with different data.
+        """
+        saved = self._saved.get(folder_path, {})
+        seq_lo, seq_hi = self.pushed - self.size, self.pushed
+        id_lo = self.next_obs_id
+        if self.size:
+            slots = self.positions(np.arange(self.size))
+            id_lo = max(int(min(self.obs_ids[slots].min(), self.next_obs_ids[slots].min())),
+                        self.next_obs_id - self.obs_capacity + 1)
+        arrays, chunks = {}, []
+        for kind, names, lo, hi in (('transitions', self.TRANSITION_ARRAYS, seq_lo, seq_hi),
+                                    ('obs', ('obs',), id_lo, self.next_obs_id)):
+            for k, start, end in self._chunks(lo, hi, chunk_size):
+                complete = end == (k + 1) * chunk_size
+                if complete and (kind, k) in saved:
+                    # the file holds ids from saved[kind, k] on
+                    chunks.append(self._chunk_entry(kind, k, saved[kind, k], end))
+                    continue
+                chunk = self._chunk_entry(kind, k, start, end)
+                chunks.append(chunk)
+                if kind == 'obs':
+                    rows = np.arange(start, end) % self.obs_capacity
+                else:
+                    rows = (self.head - self.pushed + np.arange(start, end)) % self.capacity
+                for name in names:
+                    arrays[self._chunk_file(name, chunk)] = getattr(self, name)[rows]
+        manifest = {'version': 3, 'chunk_size': chunk_size,
+                    'obs_dim': self.obs.shape[1], 'ac_dim': self.acs.shape[1],
+                    'num_agents': self.num_agents,
+                    'transitions': [seq_lo, seq_hi], 'obs': [id_lo, self.next_obs_id],
+                    'pushed': self.pushed, 'next_obs_id': self.next_obs_id,
+                    'streams': [[k, v] for k, v in self.streams.items()],
+                    'chunks': chunks}
+        return arrays, manifest
+
+    @staticmethod
+    def _chunk_entry(kind, k, start, end):
+        return {'kind': kind, 'index': k, 'start': start, 'end': end,
+                'stem': '%06i_%i_%i' % (k, start, end)}
+
+    @staticmethod
+    def _chunk_file(name, chunk):
+        if 'stem' in chunk:
+            return '%s_%s.npy' % (name, chunk['stem'])
+        # version 2 snapshots
+        return '%s_%06i.npy' % (name, chunk['index'])
+
+    @classmethod
+    def write_snapshot(cls, folder_path, snapshot):
+        """
+        Write a snapshot to folder_path: the new chunk files, then the
+        manifest (atomically, so that a folder always holds a complete
+        snapshot: the old manifest's files are left alone until the new
+        manifest is in place), then remove the chunk files no longer
+        referenced
+        """
+        arrays, manifest = snapshot
+        os.makedirs(folder_path, exist_ok=True)
+        for filename, arr in arrays.items():
+            atomic_write(os.path.join(folder_path, filename),
+                         lambda path: np.save(path, arr))
+        def write_manifest(path):
+            with open(path, 'w') as f:
+                json.dump(manifest, f)
+        atomic_write(os.path.join(folder_path, cls.MANIFEST), write_manifest)
+        names = {'obs': ('obs',), 'transitions': cls.TRANSITION_ARRAYS}
+        referenced = {cls._chunk_file(name, chunk)
+                      for chunk in manifest['chunks'] for name in names[chunk['kind']]}
+        # chunk files only (the old full-capacity format is left alone),
+        # including those of earlier snapshots that failed before their manifest
+        chunk_file = re.compile(r'(%s)_\d{6}(_\d+_\d+)?\.npy$' % '|'.join(cls.ARRAYS))
+        for filename in os.listdir(folder_path):
+            if chunk_file.match(filename) and filename not in referenced:
+                os.remove(os.path.join(folder_path, filename))
+
+    def _write_snapshot(self, folder_path, snapshot):
+        self.write_snapshot(folder_path, snapshot)
+        # the chunk files are on disk now; later snapshots may refer to the
+        # complete ones
+        chunk_size = snapshot[1]['chunk_size']
+        self._saved[folder_path] = {
+            (chunk['kind'], chunk['index']): chunk['start']
+            for chunk in snapshot[1]['chunks']
+            if chunk['end'] == (chunk['index'] + 1) * chunk_size}
+
+    def save(self, folder_path, writer=None, chunk_size=CHUNK_SIZE):
+        """
+        Write the live contents to folder_path (only the filled region, as
+        chunk files listed in a manifest; repeated saves to the same folder
+        only write the chunks that changed)
+        Inputs:
+            folder_path (str): Folder to write to
+            writer (CheckpointWriter): If given, a snapshot is written in the
+                                       background
+            chunk_size (int): Transitions (and observation rows) per chunk
+        """
+        snapshot = self.snapshot(folder_path, chunk_size=chunk_size)
+        if writer is None:
+            self._write_snapshot(folder_path, snapshot)
+        else:
+            writer.submit(self._write_snapshot, folder_path, snapshot)
+
+    def load(self, folder_path):
+        """
+        Restore contents written by save (into the existing, possibly
+        memory-mapped, arrays). Chunk files are memory-mapped, so only the
+        live data is read, once. If the snapshot holds more transitions than
+        fit, the oldest ones are dropped.
+        """
+        manifest_path = os.path.join(folder_path, self.MANIFEST)
+        if not os.path.exists(manifest_path):
+            return self._load_full(folder_path)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest['obs_dim'], manifest['ac_dim']) != (self.obs.shape[1], self.acs.shape[1]):
+            raise ValueError("Snapshot in %s has other observation or action dimensions"
+                             % folder_path)
+        seq_hi = manifest['transitions'][1]
+        seq_lo = max(manifest['transitions'][0], seq_hi - self.capacity)
+        id_hi = manifest['obs'][1]
+        # older rows would share their slot with newer ones
+        id_lo = max(manifest['obs'][0], id_hi - self.obs_capacity + 1)
+        n = seq_hi - seq_lo
+        for chunk in manifest['chunks']:
+            if chunk['kind'] == 'transitions':
+                start, end = max(chunk['start'], seq_lo), min(chunk['end'], seq_hi)
+                if start >= end:
+                    continue
+                for name in self.TRANSITION_ARRAYS:
+                    arr = np.load(os.path.join(folder_path, self._chunk_file(name, chunk)),
+                                  mmap_mode='r')
+                    getattr(self, name)[start - seq_lo:end - seq_lo] = \
+                        arr[start - chunk['start']:end - chunk['start']]
+            else:
+                start, end = max(chunk['start'], id_lo), min(chunk['end'], id_hi)
+                if start < end:
+                    arr = np.load(os.path.join(folder_path, self._chunk_file('obs', chunk)),
+                                  mmap_mode='r')
+                    self._write_obs(start, arr[start - chunk['start']:end - chunk['start']])
+        self.head, self.size = n % self.capacity, n
+        self.next_obs_id = manifest['next_obs_id']
+        self.pushed = manifest['pushed']
+        self.streams = {k: v for k, v in manifest['streams']}
+        self._saved = {}
+        self.rew_stats.reset()
+        self.rew_stats.add(self.rews[:n])
+        self._evict_dead()
+
+    def _load_full(self, folder_path):
+        """
+        Load the full-capacity format written by earlier versions
+        """
+        for name in ('obs', 'acs', 'rews', 'dones', 'obs_ids', 'next_obs_ids'):
+            getattr(self, name)[...] = np.load(os.path.join(folder_path, name + '.npy'))
+        with open(os.path.join(folder_path, 'storage_info.json')) as f:
+            info = json.load(f)
+        self.head, self.size = info['head'], info['size']
+        self.next_obs_id = info['next_obs_id']
+        self.pushed = info.get('pushed', self.size)
+        self.streams = {k: v for k, v in info['streams']}
+        self._saved = {}
+        self.rew_stats.reset()
+        self.rew_stats.add(self.rews[self.positions(np.arange(self.size))])